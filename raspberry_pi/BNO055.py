@@ -206,6 +206,59 @@ OPERATION_MODE_M4G                   = 0X0A
 OPERATION_MODE_NDOF_FMC_OFF          = 0X0B
 OPERATION_MODE_NDOF                  = 0X0C
 
+# Fusion data block fields, in register order: name, start address, layout
+# of the raw registers (little-endian) and the divisor that scales them.  A contiguous
+# span of them can be read in one transaction, see BNO055.read_fusion.
+FUSION_FIELDS = (
+    ('accelerometer',       BNO055_ACCEL_DATA_X_LSB_ADDR,        struct.Struct('<3h'), 100.0),
+    ('magnetometer',        BNO055_MAG_DATA_X_LSB_ADDR,          struct.Struct('<3h'), 16.0),
+    ('gyroscope',           BNO055_GYRO_DATA_X_LSB_ADDR,         struct.Struct('<3h'), 900.0),
+    ('euler',               BNO055_EULER_H_LSB_ADDR,             struct.Struct('<3h'), 16.0),
+    ('quaternion',          BNO055_QUATERNION_DATA_W_LSB_ADDR,   struct.Struct('<4h'), float(1<<14)),
+    ('linear_acceleration', BNO055_LINEAR_ACCEL_DATA_X_LSB_ADDR, struct.Struct('<3h'), 100.0),
+    ('gravity',             BNO055_GRAVITY_DATA_X_LSB_ADDR,      struct.Struct('<3h'), 100.0),
+    ('temp',                BNO055_TEMP_ADDR,                    struct.Struct('<b'),  1),
+    ('calibration',         BNO055_CALIB_STAT_ADDR,              struct.Struct('<B'),  None),
+)
+FUSION_NAMES = tuple(field[0] for field in FUSION_FIELDS)
+FUSION_BLOCK_SIZE = BNO055_CALIB_STAT_ADDR + 1 - BNO055_ACCEL_DATA_X_LSB_ADDR
+
+
+def decode_fusion_stream(data, names=FUSION_NAMES):
+    """Decode a recording of whole fusion blocks (see BNO055.read_fusion_block)
+    stored back to back, and return a dict of NumPy arrays keyed by name, one
+    row per block.  Vectors are scaled and ordered the same as read_fusion, so
+    'quaternion' rows are X, Y, Z, W.  'temp' is int8 and 'calibration' is an
+    N x 4 uint8 array of system, gyro, accel and mag status.  Any partial block
+    at the end is ignored.  Requires NumPy.
+    """
+    import numpy as np
+    count = len(data) // FUSION_BLOCK_SIZE
+    raw = np.frombuffer(data, dtype=np.uint8, count=count*FUSION_BLOCK_SIZE)
+    raw = raw.reshape(count, FUSION_BLOCK_SIZE)
+    # Every 16-bit field starts at an even offset in the block, so the whole
+    # recording can be viewed as rows of little-endian int16 words.
+    words = np.frombuffer(data, dtype='<i2', count=count*FUSION_BLOCK_SIZE//2)
+    words = words.reshape(count, FUSION_BLOCK_SIZE//2)
+    result = {}
+    for name, address, layout, divisor in FUSION_FIELDS:
+        if name not in names:
+            continue
+        offset = address - BNO055_ACCEL_DATA_X_LSB_ADDR
+        if name == 'temp':
+            result[name] = raw[:, offset].view(np.int8)
+        elif name == 'calibration':
+            cal_status = raw[:, offset]
+            result[name] = np.column_stack(((cal_status >> 6) & 0x03, (cal_status >> 4) & 0x03,
+                                            (cal_status >> 2) & 0x03, cal_status & 0x03))
+        else:
+            width = layout.size // 2
+            values = words[:, offset//2:offset//2 + width] / divisor
+            if name == 'quaternion':
+                values = values[:, [1, 2, 3, 0]]
+            result[name] = values
+    return result
+
 
 logger = logging.getLogger(__name__)
 
@@ -631,12 +684,7 @@ class BNO055(object):
         # Read count number of 16-bit signed values starting from the provided
         # address. Returns a tuple of the values that were read.
         data = self._read_bytes(address, count*2)
-        result = [0]*count
-        for i in range(count):
-            result[i] = ((data[i*2+1] << 8) | data[i*2]) & 0xFFFF
-            if result[i] > 32767:
-                result[i] -= 65536
-        return result
+        return struct.unpack_from('<%dh' % count, data)
 
     def read_euler(self):
         """Return the current absolute orientation as a tuple of heading, roll,
@@ -692,3 +740,47 @@ class BNO055(object):
     def read_temp(self):
         """Return the current temperature in Celsius."""
         return self._read_signed_byte(BNO055_TEMP_ADDR)
+
+    def read_fusion(self, names=FUSION_NAMES):
+        """Read several of the fusion data registers in a single transaction
+        and return a dict of their values, keyed by name (see FUSION_NAMES).
+        One contiguous span is read, from the first to the last field asked
+        for, so over the UART every field costs one round trip in total
+        instead of one each.  Values are scaled and ordered the same as the
+        matching read_* function, and 'calibration' is the same 4 tuple as
+        get_calibration_status.
+        """
+        fields = [field for field in FUSION_FIELDS if field[0] in names]
+        if not fields:
+            return {}
+        start = fields[0][1]
+        end = fields[-1][1] + fields[-1][2].size
+        data = self._read_bytes(start, end - start)
+        result = {}
+        for name, address, layout, divisor in fields:
+            raw = layout.unpack_from(data, address - start)
+            if name == 'quaternion':
+                w, x, y, z = raw
+                result[name] = (x/divisor, y/divisor, z/divisor, w/divisor)
+            elif name == 'calibration':
+                cal_status = raw[0]
+                result[name] = ((cal_status >> 6) & 0x03, (cal_status >> 4) & 0x03,
+                                (cal_status >> 2) & 0x03, cal_status & 0x03)
+            elif name == 'temp':
+                result[name] = raw[0]
+            else:
+                result[name] = tuple(value/divisor for value in raw)
+        return result
+
+    def read_all_fusion(self):
+        """Read every sensor and fusion output, plus the temperature and the
+        calibration status, in one 46 byte read starting at
+        BNO055_ACCEL_DATA_X_LSB_ADDR.  See read_fusion for the result.
+        """
+        return self.read_fusion(FUSION_NAMES)
+
+    def read_fusion_block(self):
+        """Return the raw FUSION_BLOCK_SIZE bytes that read_all_fusion decodes,
+        for recording.  Decode a recording with decode_fusion_stream.
+        """
+        return bytes(self._read_bytes(BNO055_ACCEL_DATA_X_LSB_ADDR, FUSION_BLOCK_SIZE))
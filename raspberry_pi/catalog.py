@@ -0,0 +1,330 @@
+""" @file catalog.py
+Star and deep-sky catalogs for picking targets. A Catalog holds the J2000
+RA/Dec of every object in NumPy arrays and turns all of them into altitude
+and azimuth in one vectorized pass, so questions like "what is above 30
+degrees right now" take milliseconds even for tens of thousands of objects.
+
+Positions are precessed to the date (IAU 1976) but nutation, aberration and
+refraction are left out. That is good to within about an arcminute, which is
+plenty for choosing targets. Slews still go through PyEphem.
+check_against_ephem() measures the difference on a sample, and
+tests/test_catalog.py holds it under an arcminute (it is about 30").
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import time
+import numpy as np
+
+# === CONSTANTS ===
+J2000       = 2451545.0   # [days], Julian date of the J2000 epoch
+UNIX_EPOCH  = 2440587.5   # [days], Julian date of 1970-01-01 00:00 UTC
+ARCSEC      = np.pi / (180.0 * 3600.0) # [rad]
+
+
+# === FUNCTIONS AND CLASSES ===
+def julian_date(when=None):
+    """ @arg @c when Seconds since the epoch, or None for now
+
+    @return @c jd The Julian date
+    """
+    if when is None:
+        when = time.time()
+    return when / 86400.0 + UNIX_EPOCH
+
+
+def sidereal_time(jd, lon):
+    """ @arg @c jd  The Julian date (UT)
+    @arg @c lon The observer's longitude, in radians, +E
+
+    @return @c lst The local mean sidereal time, in radians
+    """
+    t = (jd - J2000) / 36525.0
+    gmst = (280.46061837 + 360.98564736629 * (jd - J2000)
+            + 0.000387933 * t * t - t * t * t / 38710000.0)
+    return np.radians(gmst % 360.0) + lon
+
+
+def precess(ra, dec, jd):
+    """ Precesses J2000 coordinates to the mean equator of a date.
+
+    @arg @c ra  Right ascensions, in radians (arrays are fine)
+    @arg @c dec Declinations, in radians
+    @arg @c jd  The Julian date to precess to
+
+    @return @c ra_dec The precessed right ascensions and declinations, in radians
+    """
+    t = (jd - J2000) / 36525.0
+    zeta = (2306.2181 * t + 0.30188 * t * t + 0.017998 * t ** 3) * ARCSEC
+    z = (2306.2181 * t + 1.09468 * t * t + 0.018203 * t ** 3) * ARCSEC
+    theta = (2004.3109 * t - 0.42665 * t * t - 0.041833 * t ** 3) * ARCSEC
+    cos_dec = np.cos(dec)
+    sin_dec = np.sin(dec)
+    cos_ra = np.cos(ra + zeta)
+    a = cos_dec * np.sin(ra + zeta)
+    b = np.cos(theta) * cos_dec * cos_ra - np.sin(theta) * sin_dec
+    c = np.sin(theta) * cos_dec * cos_ra + np.cos(theta) * sin_dec
+    return (np.arctan2(a, b) + z) % (2 * np.pi), np.arcsin(np.clip(c, -1.0, 1.0))
+
+
+def unprecess(ra, dec, jd):
+    """ The inverse of precess(): takes coordinates of a date back to J2000.
+
+    @arg @c ra  Right ascensions of date, in radians
+    @arg @c dec Declinations of date, in radians
+    @arg @c jd  The Julian date they are for
+
+    @return @c ra_dec The J2000 right ascensions and declinations, in radians
+    """
+    t = (jd - J2000) / 36525.0
+    zeta = (2306.2181 * t + 0.30188 * t * t + 0.017998 * t ** 3) * ARCSEC
+    z = (2306.2181 * t + 1.09468 * t * t + 0.018203 * t ** 3) * ARCSEC
+    theta = (2004.3109 * t - 0.42665 * t * t - 0.041833 * t ** 3) * ARCSEC
+    cos_dec = np.cos(dec)
+    sin_dec = np.sin(dec)
+    cos_ra = np.cos(ra - z)
+    a = cos_dec * np.sin(ra - z)
+    b = np.cos(theta) * cos_dec * cos_ra + np.sin(theta) * sin_dec
+    c = -np.sin(theta) * cos_dec * cos_ra + np.cos(theta) * sin_dec
+    return (np.arctan2(a, b) - zeta) % (2 * np.pi), np.arcsin(np.clip(c, -1.0, 1.0))
+
+
+def altaz(ra, dec, lst, lat):
+    """ Turns equatorial coordinates of date into horizontal ones.
+
+    @arg @c ra  Right ascensions of date, in radians
+    @arg @c dec Declinations of date, in radians
+    @arg @c lst The local sidereal time, in radians
+    @arg @c lat The observer's latitude, in radians, +N
+
+    @return @c alt_az The altitudes and azimuths (from north, through east), in radians
+    """
+    hour = lst - ra
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    sin_dec = np.sin(dec)
+    cos_dec = np.cos(dec)
+    cos_hour = np.cos(hour)
+    alt = np.arcsin(np.clip(sin_dec * sin_lat + cos_dec * cos_lat * cos_hour, -1.0, 1.0))
+    az = np.arctan2(-cos_dec * np.sin(hour), sin_dec * cos_lat - cos_dec * sin_lat * cos_hour)
+    return alt, az % (2 * np.pi)
+
+
+def radec(alt, az, lst, lat):
+    """ The inverse of altaz(): turns horizontal coordinates into equatorial
+    ones of date.
+
+    @arg @c alt The altitudes, in radians
+    @arg @c az  The azimuths (from north, through east), in radians
+    @arg @c lst The local sidereal time, in radians
+    @arg @c lat The observer's latitude, in radians, +N
+
+    @return @c ra_dec The right ascensions and declinations of date, in radians
+    """
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    sin_alt = np.sin(alt)
+    cos_alt = np.cos(alt)
+    cos_az = np.cos(az)
+    dec = np.arcsin(np.clip(sin_alt * sin_lat + cos_alt * cos_lat * cos_az, -1.0, 1.0))
+    hour = np.arctan2(-cos_alt * np.sin(az), sin_alt * cos_lat - cos_alt * sin_lat * cos_az)
+    return (lst - hour) % (2 * np.pi), dec
+
+
+def separation(alt1, az1, alt2, az2):
+    """ @return @c angle The angle between two horizontal positions, in radians.
+            Any of the arguments can be arrays.
+    """
+    cos_angle = (np.sin(alt1) * np.sin(alt2)
+                 + np.cos(alt1) * np.cos(alt2) * np.cos(az1 - az2))
+    return np.arccos(np.clip(cos_angle, -1.0, 1.0))
+
+
+class Catalog:
+    """ @class Catalog
+    A list of fixed objects, held as parallel NumPy arrays.
+    """
+
+    def __init__(self, ra, dec, mag, names=None, ids=None):
+        """ Creates a new Catalog. Arrays that already have the right type,
+        eg. fields of a memory-mapped file, are used without a copy.
+
+        @arg @c ra    J2000 right ascensions, in radians
+        @arg @c dec   J2000 declinations, in radians
+        @arg @c mag   Visual magnitudes
+        @arg @c names The name of each object, or None to go by id
+        @arg @c ids   A number for each object, or None to number them in order
+        """
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.mag = np.asarray(mag, dtype=np.float32)
+        self.names = list(names) if names is not None else None
+        self.ids = np.asarray(ids) if ids is not None else np.arange(len(self.ra))
+        self._index = None
+
+    def __len__(self):
+        return len(self.ra)
+
+    @classmethod
+    def from_ephem_stars(cls):
+        """ @return @c catalog The bright stars PyEphem ships with, in ephem.stars
+        """
+        import ephem.stars
+        names = sorted(ephem.stars.stars)
+        ra, dec, mag = [], [], []
+        for name in names:
+            star = ephem.star(name)
+            star.compute()
+            ra.append(float(star._ra))
+            dec.append(float(star._dec))
+            mag.append(float(star.mag))
+        return cls(ra, dec, mag, names)
+
+    def name(self, index):
+        """ @return @c name The name of the object at <index>, or its id if it has none
+        """
+        if self.names is not None:
+            return self.names[index]
+        return str(self.ids[index])
+
+    def find(self, name):
+        """ @arg @c name An object name (not case sensitive) or id
+
+        @return @c index Its index in the catalog, or None
+        """
+        if self.names is None:
+            if not name.isdigit():
+                return None
+            found = np.nonzero(self.ids == int(name))[0]
+            return int(found[0]) if len(found) else None
+        if self._index is None:
+            self._index = dict((n.lower(), i) for i, n in enumerate(self.names))
+        return self._index.get(name.lower())
+
+    def body(self, index):
+        """ @return @c body An ephem.FixedBody for the object at <index>, named by name()
+        """
+        import ephem
+        body = ephem.FixedBody()
+        body._ra = float(self.ra[index])
+        body._dec = float(self.dec[index])
+        body._epoch = ephem.J2000
+        body.name = self.name(index)
+        return body
+
+    def altaz(self, observer, when=None):
+        """ Computes where every object in the catalog is.
+
+        @arg @c observer An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c when     Seconds since the epoch, or None for now
+
+        @return @c alt_az Arrays of altitude and azimuth, in degrees
+        """
+        lat, lon = _lat_lon(observer)
+        jd = julian_date(when)
+        ra, dec = precess(self.ra, self.dec, jd)
+        alt, az = altaz(ra, dec, sidereal_time(jd, lon), lat)
+        return np.degrees(alt), np.degrees(az)
+
+    def j2000(self, observer, alt, az, when=None):
+        """ Finds the J2000 coordinates of a point in the sky, eg. to search
+        the catalog around it.
+
+        @arg @c observer An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c alt      The altitude of the point, in degrees
+        @arg @c az       The azimuth of the point, in degrees
+        @arg @c when     Seconds since the epoch, or None for now
+
+        @return @c ra_dec The J2000 right ascension and declination, in radians
+        """
+        lat, lon = _lat_lon(observer)
+        jd = julian_date(when)
+        ra, dec = radec(np.radians(alt), np.radians(az), sidereal_time(jd, lon), lat)
+        return unprecess(ra, dec, jd)
+
+    def visible(self, observer, min_alt=30.0, max_mag=None, when=None):
+        """ Lists what is up, brightest first.
+
+        @arg @c observer An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c min_alt  The lowest altitude to count, in degrees
+        @arg @c max_mag  The faintest magnitude to count, or None for all
+        @arg @c when     Seconds since the epoch, or None for now
+
+        @return @c visible The catalog indices, and the altitudes and azimuths
+                (in degrees) of every object above min_alt
+        """
+        alt, az = self.altaz(observer, when)
+        keep = alt >= min_alt
+        if max_mag is not None:
+            keep &= self.mag <= max_mag
+        index = np.nonzero(keep)[0]
+        index = index[np.argsort(self.mag[index], kind='stable')]
+        return index, alt[index], az[index]
+
+    def nearest(self, observer, alt, az, count=1, min_alt=0.0, when=None):
+        """ Finds the objects closest to a point in the sky.
+
+        @arg @c observer An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c alt      The altitude of the point, in degrees
+        @arg @c az       The azimuth of the point, in degrees
+        @arg @c count    How many objects to return
+        @arg @c min_alt  Objects lower than this are skipped, in degrees
+        @arg @c when     Seconds since the epoch, or None for now
+
+        @return @c nearest The catalog indices, closest first, and their
+                distances from the point in degrees
+        """
+        alts, azs = self.altaz(observer, when)
+        up = np.nonzero(alts >= min_alt)[0]
+        dist = np.degrees(separation(np.radians(alt), np.radians(az),
+                                     np.radians(alts[up]), np.radians(azs[up])))
+        count = min(count, len(up))
+        if count == 0:
+            return up, dist
+        best = np.argpartition(dist, count - 1)[:count]
+        best = best[np.argsort(dist[best])]
+        return up[best], dist[best]
+
+
+def _lat_lon(observer):
+    # accepts an ephem.Observer or a (lat, lon) pair, in radians
+    if isinstance(observer, tuple):
+        return observer
+    return float(observer.lat), float(observer.lon)
+
+
+def check_against_ephem(catalog, observer, count=20, when=None):
+    """ Compares Catalog.altaz() with PyEphem for a sample of objects.
+    Refraction is turned off on the copy given to PyEphem, since altaz()
+    leaves it out.
+
+    @arg @c catalog  The Catalog to check
+    @arg @c observer An ephem.Observer
+    @arg @c count    How many objects to compare, spread over the catalog
+    @arg @c when     Seconds since the epoch, or None for now
+
+    @return @c errors The angle between the two results for each sampled object, in arcseconds
+    """
+    import ephem
+    from datetime import datetime
+    if when is None:
+        when = time.time()
+    obs = observer.copy()
+    obs.pressure = 0
+    obs.date = ephem.Date(datetime.utcfromtimestamp(when))
+    alt, az = catalog.altaz(observer, when)
+    sample = np.linspace(0, len(catalog) - 1, min(count, len(catalog))).astype(int)
+    errors = []
+    for i in sample:
+        body = ephem.FixedBody()
+        body._ra = catalog.ra[i]
+        body._dec = catalog.dec[i]
+        body._epoch = ephem.J2000
+        body.compute(obs)
+        errors.append(separation(np.radians(alt[i]), np.radians(az[i]),
+                                 float(body.alt), float(body.az)) / ARCSEC)
+    return np.array(errors)
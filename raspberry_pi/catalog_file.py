@@ -0,0 +1,178 @@
+""" @file catalog_file.py
+A compact binary file format for star catalogs. A file is a 16 byte header
+followed by fixed-width little-endian records (RECORD_DTYPE), so it can be
+memory-mapped straight into NumPy. Loading is near-instant whatever the size
+of the catalog, pages are only read from the SD card when a query touches
+them, and processes that map the same file share its memory.
+
+The header is the 8 byte MAGIC, the record count (uint32) and the record size
+(uint32).
+
+Run as a script to convert a text catalog, or to compare loading it both ways:
+    python catalog_file.py hygdata.csv stars.cat
+    python catalog_file.py --bench hygdata.csv stars.cat
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import csv
+import struct
+import numpy as np
+from catalog import Catalog
+
+# === CONSTANTS ===
+MAGIC = b'SCOPECAT'
+HEADER = struct.Struct('<8sII')
+RECORD_DTYPE = np.dtype([('ra', '<f8'),   # [rad], J2000
+                         ('dec', '<f8'),  # [rad], J2000
+                         ('mag', '<f4'),  # visual magnitude
+                         ('id', '<u4')])  # the id from the source catalog
+
+
+# === FUNCTIONS AND CLASSES ===
+def write_catalog(path, ra, dec, mag, ids):
+    """ Writes a binary catalog.
+
+    @arg @c path The file to write
+    @arg @c ra   J2000 right ascensions, in radians
+    @arg @c dec  J2000 declinations, in radians
+    @arg @c mag  Visual magnitudes
+    @arg @c ids  A number for each object
+    """
+    records = np.empty(len(ra), dtype=RECORD_DTYPE)
+    records['ra'] = ra
+    records['dec'] = dec
+    records['mag'] = mag
+    records['id'] = ids
+    with open(path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, len(records), RECORD_DTYPE.itemsize))
+        records.tofile(out)
+
+
+def map_records(path):
+    """ Memory-maps the records of a binary catalog, read only.
+
+    @arg @c path The file to map
+
+    @return @c records A NumPy array of RECORD_DTYPE backed by the file
+
+    @throws ValueError if the file isn't a binary catalog
+    """
+    with open(path, 'rb') as src:
+        magic, count, size = HEADER.unpack(src.read(HEADER.size))
+    if magic != MAGIC or size != RECORD_DTYPE.itemsize:
+        raise ValueError(path + ' is not a binary star catalog')
+    if count == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+
+def load_catalog(path):
+    """ @arg @c path A binary catalog file
+
+    @return @c catalog A catalog.Catalog whose arrays are views of the mapped file
+    """
+    records = map_records(path)
+    return Catalog(records['ra'], records['dec'], records['mag'], ids=records['id'])
+
+
+def read_text(path, ra='ra', dec='dec', mag='mag', ids='id', ra_hours=True, delimiter=','):
+    """ Parses a text catalog with a header row, eg. the HYG database.
+
+    @arg @c path      The text file
+    @arg @c ra        The name of the right ascension column
+    @arg @c dec       The name of the declination column, in degrees
+    @arg @c mag       The name of the magnitude column
+    @arg @c ids       The name of the id column
+    @arg @c ra_hours  True if right ascension is in hours, False if in degrees
+    @arg @c delimiter The column separator
+
+    @return @c columns Arrays of RA and Dec (J2000, radians), magnitude and id
+    """
+    ra_list, dec_list, mag_list, id_list = [], [], [], []
+    with open(path) as src:
+        for row in csv.DictReader(src, delimiter=delimiter):
+            try:
+                values = (float(row[ra]) * (15.0 if ra_hours else 1.0), float(row[dec]),
+                          float(row[mag]), int(row[ids]))
+            except ValueError:
+                continue # a row with a blank or bad field
+            ra_list.append(values[0])
+            dec_list.append(values[1])
+            mag_list.append(values[2])
+            id_list.append(values[3])
+    return (np.radians(ra_list), np.radians(dec_list),
+            np.array(mag_list, dtype=np.float32), np.array(id_list, dtype=np.uint32))
+
+
+def convert_text(src, dst, **columns):
+    """ Converts a text catalog to a binary one. See read_text() for the column options.
+
+    @return @c count The number of objects written
+    """
+    ra, dec, mag, ids = read_text(src, **columns)
+    write_catalog(dst, ra, dec, mag, ids)
+    return len(ra)
+
+
+def _memory():
+    # [KiB], the resident set size now and its peak, from /proc (Linux only).
+    # Unlike ru_maxrss, the peak starts over in a new process image instead
+    # of carrying on from the parent's.
+    rss = peak = 0
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('VmHWM:'):
+                peak = int(line.split()[1])
+    return rss, peak
+
+
+def _measure(mode, path):
+    # loads a catalog one way and prints the time it took and how much the
+    # peak RSS grew. Run in a fresh process, so each way starts from the same memory.
+    import time
+    before = _memory()[0]
+    start = time.time()
+    if mode == 'text':
+        catalog = Catalog(*read_text(path)[:3])
+    else:
+        catalog = load_catalog(path)
+    elapsed = time.time() - start
+    peak = _memory()[1]
+    print('%s %d %.6f %d %d' % (mode, len(catalog), elapsed, peak - before, peak))
+
+
+def benchmark(text_path, binary_path):
+    """ Loads a catalog from text and from its binary copy, each in its own
+    process, and prints the load time, how much memory the load took and the
+    process's peak memory for both. Linux only, the memory is read from /proc.
+    """
+    import subprocess
+    import sys
+    # converted in a process of its own too, so parsing the text here doesn't
+    # count against either load
+    subprocess.check_call([sys.executable, __file__, text_path, binary_path])
+    print('%-7s %8s %10s %12s %10s' % ('format', 'objects', 'load [ms]', 'load [KiB]',
+                                       'peak [KiB]'))
+    for mode, path in (('text', text_path), ('binary', binary_path)):
+        out = subprocess.check_output([sys.executable, __file__, '--measure', mode, path])
+        name, count, elapsed, used, peak = out.decode().split()
+        print('%-7s %8s %10.2f %12s %10s' % (name, count, float(elapsed) * 1000, used, peak))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        _measure(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 4 and sys.argv[1] == '--bench':
+        benchmark(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 3:
+        print('Wrote %d objects' % convert_text(sys.argv[1], sys.argv[2]))
+    else:
+        print('usage: python catalog_file.py [--bench] <text catalog> <binary catalog>')
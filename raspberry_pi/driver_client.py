@@ -0,0 +1,386 @@
+""" @file driver_client.py
+A client for the stepper driver board on the Raspberry Pi. One thread reads
+everything the board sends (command replies, move events and telemetry) and
+another writes queued commands, so several commands can be in flight over the
+one serial port without blocking the caller.
+
+Commands are matched to their replies by the 8-bit command id in the frame.
+Every command gets an OP_ACK or OP_NAK, and every accepted command later gets
+an OP_DONE or OP_ERROR.
+
+Works with Python 2 and 3. submit_async() needs Python 3's asyncio.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import logging
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import serial
+from usb_protocol import (OP_SLEW, OP_TURN, OP_HOME, OP_HOME_SET, OP_STOP, OP_OFF,
+                          OP_TELEM_RATE, OP_TELEMETRY, OP_ACK, OP_NAK, OP_DONE,
+                          ARG_SCALE, CMD_FRAME_LEN, KIND_NONE, KIND_FRAME, KIND_LINE,
+                          StreamParser, encode_command, decode_command,
+                          decode_telemetry, deg_to_arg)
+
+# === CONSTANTS ===
+READ_TIMEOUT = 0.05 # [sec], longest the reader blocks, so close() is quick
+QUEUE_SIZE   = 16   # commands that may wait to be written
+MAX_IN_FLIGHT = 255 # command ids are one byte, and 0 is kept for the board
+
+logger = logging.getLogger(__name__)
+
+
+# === FUNCTIONS AND CLASSES ===
+class CommandError(Exception):
+    """ @class CommandError
+    Raised when the board refuses a command (OP_NAK) or the move it started
+    ends in a driver error (OP_ERROR).
+    """
+    def __init__(self, command, op, arg):
+        Exception.__init__(self, 'command %d on axis %d failed: %s %d' % (
+            command.cmd_id, command.axis, 'NAK' if op == OP_NAK else 'error', arg))
+        self.command = command
+        self.op = op
+        self.arg = arg # the NAK_ reason, or the driver STATUS
+
+
+class CommandTimeout(Exception):
+    """ @class CommandTimeout
+    Raised when a command isn't answered in time.
+    """
+    pass
+
+
+class PendingCommand:
+    """ @class PendingCommand
+    One command sent to the board. Filled in by the reader thread as the
+    replies arrive.
+    """
+
+    def __init__(self, op, axis, arg, cmd_id):
+        """ Creates a new PendingCommand. Made by DriverClient.submit().
+        """
+        self.op = op
+        self.axis = axis
+        self.arg = arg
+        self.cmd_id = cmd_id
+        self.ack = None     # OP_ACK or OP_NAK, once it arrives
+        self.result = None  # OP_DONE, OP_ERROR or OP_NAK, once finished
+        self.result_arg = 0
+        self._acked = threading.Event()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def wait_ack(self, timeout=None):
+        """ Waits until the board has accepted or refused the command.
+
+        @arg @c timeout Seconds to wait, or None to wait forever
+
+        @throws CommandError if the board refused it
+        @throws CommandTimeout if there was no reply in time
+        """
+        if not self._acked.wait(timeout):
+            raise CommandTimeout('no reply to command %d' % self.cmd_id)
+        if self.ack == OP_NAK:
+            raise CommandError(self, OP_NAK, self.result_arg)
+
+    def wait(self, timeout=None):
+        """ Waits until the command has finished.
+
+        @arg @c timeout Seconds to wait, or None to wait forever
+
+        @return @c angle The angle of the axis when it finished, in degrees
+
+        @throws CommandError if the board refused it or it ended in an error
+        @throws CommandTimeout if it didn't finish in time
+        """
+        if not self._done.wait(timeout):
+            raise CommandTimeout('command %d did not finish' % self.cmd_id)
+        if self.result != OP_DONE:
+            raise CommandError(self, self.result, self.result_arg)
+        return float(self.result_arg) / ARG_SCALE
+
+    def done(self):
+        """ @return @c done True once the command has finished, either way
+        """
+        return self._done.is_set()
+
+    def add_done_callback(self, func):
+        """ Calls func(command) from the reader thread once the command has
+        finished, or right away if it already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set_ack(self, op, arg):
+        self.ack = op
+        if op == OP_NAK:
+            self.result_arg = arg
+        self._acked.set()
+        if op == OP_NAK:
+            self._finish(OP_NAK, arg)
+
+    def _finish(self, op, arg):
+        with self._lock:
+            self.result = op
+            self.result_arg = arg
+            self._acked.set() # an event can overtake a lost ACK
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class DriverClient:
+    """ @class DriverClient
+    Talks to the stepper driver board over its USB serial port.
+    """
+
+    def __init__(self, port='/dev/ttyACM0', baudrate=115200, queue_size=QUEUE_SIZE):
+        """ Creates a new DriverClient. Call open() to connect.
+
+        @arg @c port       The serial port of the driver board
+        @arg @c baudrate   The baud rate, ignored by the board's USB link
+        @arg @c queue_size How many commands may wait to be written
+        """
+        self._port = port
+        self._baudrate = baudrate
+        self._dev = None
+        self._out = queue.Queue(queue_size)
+        self._parser = StreamParser(1024)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._running = False
+        self._threads = []
+        self.telemetry = None # (time, seq, samples) of the newest frame
+        # optional callbacks, called from the reader thread
+        self.on_telemetry = None # on_telemetry(seq, samples)
+        self.on_event = None     # on_event(op, axis, arg), for events with no command
+        self.on_line = None      # on_line(text), for text sent by the board
+
+    def open(self):
+        """ Opens the serial port and starts the reader and writer threads.
+
+        @throws serial.serialutil.SerialException if the port can't be opened
+        """
+        self._dev = serial.Serial(port=self._port, baudrate=self._baudrate,
+                                  timeout=READ_TIMEOUT, write_timeout=1)
+        self._running = True
+        self._threads = [threading.Thread(target=self._read_loop, name='driver-read'),
+                         threading.Thread(target=self._write_loop, name='driver-write')]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """ Stops the threads and closes the serial port.
+        """
+        self._running = False
+        try:
+            self._out.put(None, False) # wake the writer
+        except queue.Full:
+            pass # it's busy, and will see _running on its own
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._dev is not None:
+            self._dev.close()
+            self._dev = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, op, axis, arg=0, block=True, timeout=None):
+        """ Queues a command without waiting for it.
+
+        @arg @c op      The command, one of the usb_protocol OP_ constants
+        @arg @c axis    The axis, one of the usb_protocol AXIS_ constants
+        @arg @c arg     The fixed-point argument, eg. from deg_to_arg()
+        @arg @c block   If False, raise queue.Full instead of waiting for room
+        @arg @c timeout Seconds to wait for room in the queue
+
+        @return @c command The PendingCommand, to wait on
+        """
+        with self._lock:
+            if len(self._pending) >= MAX_IN_FLIGHT:
+                raise queue.Full('too many commands in flight')
+            cmd_id = self._next_id
+            while cmd_id in self._pending:
+                cmd_id = cmd_id % MAX_IN_FLIGHT + 1
+            self._next_id = cmd_id % MAX_IN_FLIGHT + 1
+            command = PendingCommand(op, axis, arg, cmd_id)
+            self._pending[cmd_id] = command
+        try:
+            self._out.put(command, block, timeout)
+        except queue.Full:
+            with self._lock:
+                del self._pending[cmd_id]
+            raise
+        return command
+
+    def command(self, op, axis, arg=0, timeout=None):
+        """ Sends a command and waits for it to finish.
+
+        @return @c angle See PendingCommand.wait()
+        """
+        return self.submit(op, axis, arg).wait(timeout)
+
+    def submit_async(self, op, axis, arg=0, loop=None):
+        """ Sends a command for asyncio code. Python 3 only.
+
+        @arg @c loop The event loop to finish the future on, or None for the
+                     running one. Must be given if called from outside a coroutine.
+
+        @return @c future An asyncio.Future that finishes with the angle of
+                the axis, in degrees, or with a CommandError
+        """
+        import asyncio
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def finish(future, command):
+            if future.cancelled():
+                return
+            if command.result == OP_DONE:
+                future.set_result(float(command.result_arg) / ARG_SCALE)
+            else:
+                future.set_exception(CommandError(command, command.result, command.result_arg))
+
+        command = self.submit(op, axis, arg, block=False)
+        command.add_done_callback(
+            lambda command: loop.call_soon_threadsafe(finish, future, command))
+        return future
+
+    # --- shorthands ---
+
+    def slew(self, axis, degrees):
+        """ Starts a slew to an absolute angle. @return @c command The PendingCommand
+        """
+        return self.submit(OP_SLEW, axis, deg_to_arg(degrees))
+
+    def turn(self, axis, degrees):
+        """ Starts a turn by a relative angle. @return @c command The PendingCommand
+        """
+        return self.submit(OP_TURN, axis, deg_to_arg(degrees))
+
+    def home(self, axis):
+        """ Starts a move to HOME. @return @c command The PendingCommand
+        """
+        return self.submit(OP_HOME, axis)
+
+    def set_home(self, axis):
+        """ Sets the current position as HOME. @return @c command The PendingCommand
+        """
+        return self.submit(OP_HOME_SET, axis)
+
+    def stop(self, axis):
+        """ Stops the axis, with holding torque. @return @c command The PendingCommand
+        """
+        return self.submit(OP_STOP, axis)
+
+    def off(self, axis):
+        """ Lets the axis coast. @return @c command The PendingCommand
+        """
+        return self.submit(OP_OFF, axis)
+
+    def set_telemetry_rate(self, period_ms):
+        """ Sets how often the board sends telemetry. 0 stops it.
+        """
+        return self.submit(OP_TELEM_RATE, 0, int(period_ms))
+
+    def send_line(self, text):
+        """ Queues a typed ASCII command, eg. 'alt:turn 1', as for debugging.
+        The board echoes it back through on_line.
+        """
+        self._out.put(text + '\r')
+
+    # --- threads ---
+
+    def _write_loop(self):
+        buf = bytearray(CMD_FRAME_LEN)
+        while self._running:
+            item = self._out.get()
+            if item is None:
+                continue
+            if isinstance(item, PendingCommand):
+                data = encode_command(item.op, item.axis, item.arg, item.cmd_id, buf)
+            else:
+                data = item.encode('ascii')
+            try:
+                self._dev.write(data)
+            except serial.SerialTimeoutException:
+                if isinstance(item, PendingCommand):
+                    logger.warning("Driver board isn't reading, dropped command %d", item.cmd_id)
+                    self._resolve(item.cmd_id, OP_NAK, 0)
+                else:
+                    logger.warning("Driver board isn't reading, dropped the line %r", item)
+
+    def _read_loop(self):
+        ring = self._parser.ring
+        while self._running:
+            data = self._dev.read(max(self._dev.in_waiting, 1))
+            if not data:
+                continue
+            data = bytearray(data)
+            while data:
+                added = ring.extend(data)
+                data = data[added:]
+                self._dispatch()
+
+    def _dispatch(self):
+        parser = self._parser
+        kind = parser.poll()
+        while kind != KIND_NONE:
+            if kind == KIND_FRAME:
+                if parser.frame[2] == OP_TELEMETRY:
+                    telemetry = decode_telemetry(parser.frame)
+                    if telemetry is not None:
+                        self.telemetry = (time.time(),) + telemetry
+                        if self.on_telemetry is not None:
+                            self.on_telemetry(*telemetry)
+                else:
+                    reply = decode_command(parser.frame)
+                    if reply is not None:
+                        op, axis, cmd_id, arg = reply
+                        if not self._resolve(cmd_id, op, arg) and self.on_event is not None:
+                            self.on_event(op, axis, arg)
+            elif kind == KIND_LINE and self.on_line is not None:
+                self.on_line(bytes(parser.line[0:parser.line_len]).decode('ascii', 'replace'))
+            kind = parser.poll()
+
+    # hands a reply to its command. Returns False if no command has that id
+    def _resolve(self, cmd_id, op, arg):
+        with self._lock:
+            command = self._pending.get(cmd_id)
+            if command is None:
+                return False
+            # settings have nothing to carry out, so the ACK is all they get
+            settled = op != OP_ACK or command.op == OP_TELEM_RATE
+            if settled:
+                del self._pending[cmd_id]
+        if op == OP_ACK or op == OP_NAK:
+            command._set_ack(op, arg)
+            if op == OP_ACK and settled:
+                command._finish(OP_DONE, 0)
+        else:
+            command._finish(op, arg)
+        return True
@@ -0,0 +1,211 @@
+""" @file ephem_cache.py
+Caches where targets will be. A TrajectoryCache precomputes the altitude and
+azimuth of each requested body over a window of time, on a background
+thread, and keeps them as compact float arrays. Looking up a position is then
+a linear interpolation between two samples instead of a PyEphem computation.
+Trajectories are extended before they run out, and thrown away when the
+observer moves.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import threading
+import time
+from array import array
+from datetime import datetime
+import ephem
+
+# === CONSTANTS ===
+WINDOW = 3600.0 # [sec], how far ahead a trajectory is computed
+STEP   = 5.0    # [sec], time between samples
+REFILL = 0.5    # share of the window left when the next one is computed
+
+
+# === FUNCTIONS AND CLASSES ===
+def observer_key(observer):
+    """ @arg @c observer An ephem.Observer
+
+    @return @c key What a trajectory depends on about the observer
+    """
+    return (float(observer.lat), float(observer.lon), float(observer.elevation),
+            float(observer.pressure), float(observer.temp))
+
+
+class Trajectory:
+    """ @class Trajectory
+    The altitude and azimuth of one body, sampled every <step> seconds.
+    Azimuth is unwrapped, so it can run past 360 degrees without a jump.
+    """
+
+    def __init__(self, start, step, alt, azi):
+        """ Creates a new Trajectory.
+
+        @arg @c start The time of the first sample, in seconds since the epoch
+        @arg @c step  The time between samples, in seconds
+        @arg @c alt   The altitude samples, an array('f') of degrees
+        @arg @c azi   The unwrapped azimuth samples, an array('f') of degrees
+        """
+        self.start = start
+        self.step = step
+        self.alt = alt
+        self.azi = azi
+        self.end = start + step * (len(alt) - 1)
+
+    def covers(self, when):
+        """ @return @c covers True if <when> is inside the sampled window
+        """
+        return self.start <= when <= self.end
+
+    def at(self, when):
+        """ Interpolates the position at a time inside the window.
+
+        @arg @c when Seconds since the epoch
+
+        @return @c alt_azi The altitude and azimuth, in degrees. Azimuth is 0 to 360.
+        """
+        index, frac = self._index(when)
+        alt = self.alt[index] + (self.alt[index+1] - self.alt[index]) * frac
+        azi = self.azi[index] + (self.azi[index+1] - self.azi[index]) * frac
+        return (alt, azi % 360.0)
+
+    def rate(self, when):
+        """ @arg @c when Seconds since the epoch
+
+        @return @c rates How fast the altitude and azimuth change, in degrees per second
+        """
+        index, frac = self._index(when)
+        return ((self.alt[index+1] - self.alt[index]) / self.step,
+                (self.azi[index+1] - self.azi[index]) / self.step)
+
+    def _index(self, when):
+        offset = (when - self.start) / self.step
+        index = min(max(int(offset), 0), len(self.alt) - 2)
+        return index, offset - index
+
+
+class TrajectoryCache:
+    """ @class TrajectoryCache
+    Keeps a Trajectory for every requested body, computed on a background thread.
+    """
+
+    def __init__(self, observer, window=WINDOW, step=STEP):
+        """ Creates a new TrajectoryCache and starts its thread.
+
+        @arg @c observer The ephem.Observer for the mount's location. A copy is used.
+        @arg @c window   How far ahead to compute, in seconds
+        @arg @c step     The time between samples, in seconds
+        """
+        self._window = window
+        self._step = step
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._obs = observer.copy()
+        self._key = observer_key(observer)
+        self._bodies = {}       # name: body, for everything requested
+        self._trajectories = {} # name: the newest Trajectory
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='ephem-cache')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Stops the background thread.
+        """
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+
+    def set_observer(self, observer):
+        """ Moves the observer. If the location changed, every trajectory is
+        thrown away and computed again.
+        """
+        key = observer_key(observer)
+        with self._lock:
+            if key == self._key:
+                return
+            self._obs = observer.copy()
+            self._key = key
+            self._trajectories = {}
+        self._wake.set()
+
+    def request(self, body):
+        """ Asks for a body to be cached. Cheap to call again for a body
+        that is already cached.
+
+        @arg @c body An ephem body, eg. ephem.Moon(). Its name is the cache key.
+        """
+        with self._lock:
+            if body.name in self._bodies:
+                return
+            self._bodies[body.name] = body.copy()
+        self._wake.set()
+
+    def get(self, name, when=None):
+        """ @arg @c name The name of a requested body
+        @arg @c when Seconds since the epoch, or None for now
+
+        @return @c trajectory Its Trajectory, or None if it doesn't cover <when> yet
+        """
+        if when is None:
+            when = time.time()
+        trajectory = self._trajectories.get(name)
+        if trajectory is None or not trajectory.covers(when):
+            return None
+        return trajectory
+
+    def lookup(self, name, when=None):
+        """ @arg @c name The name of a requested body
+        @arg @c when Seconds since the epoch, or None for now
+
+        @return @c alt_azi The altitude and azimuth in degrees, or None if not cached yet
+        """
+        if when is None:
+            when = time.time()
+        trajectory = self.get(name, when)
+        if trajectory is None:
+            return None
+        return trajectory.at(when)
+
+    def _run(self):
+        while self._running:
+            self._wake.clear()
+            with self._lock:
+                observer = self._obs.copy()
+                key = self._key
+                bodies = list(self._bodies.items())
+            now = time.time()
+            for name, body in bodies:
+                trajectory = self._trajectories.get(name)
+                if trajectory is not None and trajectory.end - now > self._window * REFILL:
+                    continue
+                trajectory = self._compute(observer, body, now)
+                with self._lock:
+                    if key != self._key:
+                        break # the observer moved while computing, start over
+                    self._trajectories[name] = trajectory
+            # sleep until a refill is due, or something changes
+            self._wake.wait(self._window * (1.0 - REFILL) / 2)
+
+    def _compute(self, observer, body, start):
+        count = int(self._window / self._step) + 1
+        alt = array('f', [0.0]) * count
+        azi = array('f', [0.0]) * count
+        last = None
+        turns = 0.0
+        for i in range(count):
+            observer.date = ephem.Date(datetime.utcfromtimestamp(start + i * self._step))
+            body.compute(observer)
+            alt[i] = float(body.alt) * 180/ephem.pi
+            heading = float(body.az) * 180/ephem.pi
+            # unwrap, so interpolating across north doesn't swing through 180
+            if last is not None and heading - last > 180.0:
+                turns -= 360.0
+            elif last is not None and heading - last < -180.0:
+                turns += 360.0
+            last = heading
+            azi[i] = heading + turns
+        return Trajectory(start, self._step, alt, azi)
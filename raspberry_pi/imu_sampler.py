@@ -0,0 +1,207 @@
+""" @file imu_sampler.py
+Reads the BNO055 on its own thread, at the rate its fusion outputs update
+(100 Hz), and publishes timestamped samples into a ring buffer. Everything
+else reads the newest sample, or a window of recent ones, from memory without
+touching the bus.
+
+There is one writer, and it fills a slot before advancing the count, so
+readers never need a lock. A reader can only see a torn window if it falls a
+whole ring behind, which is why window() returns at most size - 1 samples.
+
+Once the sampler is started it owns the sensor: every read has to go through
+it, because the BNO055 can't take two transactions at once.
+
+A SettleDetector uses the sampled quaternions and gyroscope readings to
+decide when the scope has stopped moving.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import math
+import threading
+import time
+from BNO055 import FUSION_NAMES
+
+# === CONSTANTS ===
+SAMPLE_RATE = 100.0 # [Hz], the BNO055's fusion output rate
+RING_SIZE   = 512   # samples kept, a bit over 5 s at 100 Hz
+
+SETTLE_WINDOW  = 0.3  # [sec], how long the scope has to be still
+SETTLE_ANGLE   = 0.05 # [deg], most it may turn over the window
+SETTLE_RATE    = 0.5  # [deg/s], fastest it may turn at any sample in the window
+SETTLE_SAMPLES = 10   # fewest samples to decide on, in case reads are failing
+# The BNO055 is left in its default units, 16 LSB per deg/s, but the driver
+# scales gyroscope readings by 1/900. This turns them back into deg/s.
+GYRO_TO_DPS = 900.0 / 16.0
+
+
+# === FUNCTIONS AND CLASSES ===
+class ImuSampler:
+    """ @class ImuSampler
+    Samples a BNO055 in the background.
+    """
+
+    def __init__(self, imu, rate=SAMPLE_RATE, size=RING_SIZE, names=FUSION_NAMES):
+        """ Creates a new ImuSampler. Call start() to begin sampling.
+
+        @arg @c imu   The BNO055, already set up with begin()
+        @arg @c rate  How often to sample, in Hz
+        @arg @c size  How many samples to keep
+        @arg @c names The fusion outputs to read, see BNO055.FUSION_NAMES
+        """
+        self._imu = imu
+        self._period = 1.0 / rate
+        self._size = size
+        self._names = names
+        self._ring = [None] * size # (time, sample dict) pairs
+        self._count = 0            # samples written so far
+        self._running = False
+        self._thread = None
+        self.errors = 0            # reads that failed, eg. UART bus errors
+
+    def start(self):
+        """ Starts the sampling thread.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='imu-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the sampling thread. The sensor may be read directly again after.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def count(self):
+        """ @return @c count The number of samples taken so far. Changes when a new one lands.
+        """
+        return self._count
+
+    def latest(self):
+        """ @return @c sample The newest (time, sample dict) pair, or None before the first.
+                The dict is keyed like BNO055.read_fusion().
+        """
+        count = self._count
+        if count == 0:
+            return None
+        return self._ring[(count - 1) % self._size]
+
+    def wait_latest(self, timeout=1.0):
+        """ Waits for the first sample if there isn't one yet.
+
+        @return @c sample See latest()
+
+        @throws RuntimeError if no sample arrives in time
+        """
+        deadline = time.time() + timeout
+        while self._count == 0:
+            if time.time() > deadline:
+                raise RuntimeError('No samples from the BNO055, is it connected?')
+            time.sleep(self._period)
+        return self.latest()
+
+    def window(self, seconds=None, count=None):
+        """ Returns recent samples, oldest first.
+
+        @arg @c seconds Only samples taken within this many seconds, or None for any age
+        @arg @c count   At most this many samples, or None for all that are kept
+
+        @return @c samples A list of (time, sample dict) pairs
+        """
+        end = self._count
+        available = min(end, self._size - 1)
+        if count is not None:
+            available = min(available, count)
+        samples = [self._ring[i % self._size] for i in range(end - available, end)]
+        if seconds is not None and samples:
+            oldest = samples[-1][0] - seconds
+            samples = [sample for sample in samples if sample[0] >= oldest]
+        return samples
+
+    def _run(self):
+        next_time = time.time()
+        while self._running:
+            try:
+                sample = self._imu.read_fusion(self._names)
+            except RuntimeError:
+                self.errors += 1 # a bus error or timeout, try again next period
+            else:
+                # fill the slot first, then publish it
+                self._ring[self._count % self._size] = (time.time(), sample)
+                self._count += 1
+            next_time += self._period
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time() # fell behind, don't try to catch up
+
+
+def quaternion_angle(q1, q2):
+    """ @arg @c q1 A quaternion, as a 4 tuple in any component order
+    @arg @c q2 Another, in the same order
+
+    @return @c angle The rotation between the two orientations, in degrees
+    """
+    dot = sum(a * b for a, b in zip(q1, q2))
+    norms = math.sqrt(sum(a * a for a in q1) * sum(b * b for b in q2))
+    if norms == 0.0:
+        return 180.0 # no fusion output yet, so it can't be called still
+    # q and -q are the same orientation, hence abs()
+    return math.degrees(2.0 * math.acos(min(abs(dot) / norms, 1.0)))
+
+
+class SettleDetector:
+    """ @class SettleDetector
+    Decides when the scope has stopped moving. That is when, for a whole
+    window of samples, no orientation is more than <max_angle> from the
+    newest one and the gyroscope never reads more than <max_rate>. Only
+    samples taken since the last reset() count.
+    """
+
+    def __init__(self, sampler, window=SETTLE_WINDOW, max_angle=SETTLE_ANGLE,
+                 max_rate=SETTLE_RATE, min_samples=SETTLE_SAMPLES):
+        """ Creates a new SettleDetector.
+
+        @arg @c sampler     The ImuSampler to read. It has to sample 'quaternion' and 'gyroscope'.
+        @arg @c window      How long the scope has to be still, in seconds
+        @arg @c max_angle   Most the orientation may change over the window, in degrees
+        @arg @c max_rate    Fastest the gyroscope may read, in degrees per second
+        @arg @c min_samples Fewest samples in the window to decide on
+        """
+        self._sampler = sampler
+        self._window = window
+        self._max_angle = max_angle
+        self._max_rate = max_rate
+        self._min_samples = min_samples
+        self._start = time.time()
+
+    def reset(self):
+        """ Forgets the samples taken so far, eg. right after commanding a move.
+        """
+        self._start = time.time()
+
+    def settled(self):
+        """ @return @c settled True if the scope has been still for the whole window
+        """
+        samples = self._sampler.window(seconds=self._window)
+        samples = [sample for sample in samples if sample[0] >= self._start]
+        if len(samples) < self._min_samples:
+            return False
+        if samples[-1][0] - samples[0][0] < self._window * 0.9:
+            return False # hasn't been watching for long enough yet
+        latest = samples[-1][1]['quaternion']
+        for when, sample in samples:
+            x, y, z = sample['gyroscope']
+            if math.sqrt(x*x + y*y + z*z) * GYRO_TO_DPS > self._max_rate:
+                return False
+            if quaternion_angle(sample['quaternion'], latest) > self._max_angle:
+                return False
+        return True
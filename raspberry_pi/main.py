@@ -9,18 +9,35 @@ The main code consists of one task that handles the user interface with stepper
 """
 
 # === IMPORTS ===
+import os
 import time
 import serial
 from datetime import datetime as date
 from BNO055 import BNO055
+from imu_sampler import ImuSampler, SettleDetector
+from driver_client import DriverClient, CommandError, CommandTimeout
+from mount import AXES, STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE, wrap_degrees
+from step_convert import StepConverter
+from usb_protocol import (OP_SLEW, OP_HOME_SET, OP_OFF, OP_DONE, AXIS_ALT, AXIS_AZI,
+                          STATE_BUSY, deg_to_arg)
 try:
     import ephem
     import ephem.stars
+    from tracking import TrackingEngine
+    from pointing import PointingEstimator
+    from ephem_cache import TrajectoryCache
+    from catalog import Catalog
+    from catalog_file import load_catalog
+    from sky_index import SkyIndex
 except ImportError:
     print("PyEphem not installed, must use manual commands")
 
 # === CONSTANTS ===
-LOOP_DELAY = 0.1  # [sec], number of seconds to wait between loops
+LOOP_DELAY   = 0.1   # [sec], number of seconds to wait between loops
+CMD_TIMEOUT  = 2.0   # [sec], longest to wait on a command that doesn't move an axis
+MOVE_TIMEOUT = 120.0 # [sec], longest to wait for a slew to finish
+STALE_AFTER  = 1.0   # [sec], older telemetry isn't taken as where the motors are
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stars.cat')
 
 STATE_INIT      = 1
 STATE_CMD       = 2
@@ -49,17 +66,165 @@ class Main_Task:
         self._state = STATE_INIT
         self._error = NO_ERROR
         self._imu = None
+        self._imu_sampler = None
+        self._settle = None
         self._imu_entry = True
-        self._pre_euler_ang = 0
         self._euler_ang = 0
         self._dev = None
+        self._conv = [StepConverter(STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE)
+                      for axis in AXES]
         self._obs = None
+        self._tracker = None
+        self._pointing = None
+        self._ephem = None
+        self._catalog = None
+        self._sky_index = None
         self._key_checker = None
+        self._moves = [] # the slews the IMU_WAIT state is waiting out
+        self._align_star = None
+        self._offset = [0.0, 0.0] # [deg], sky angle minus pointing, by axis, from alignment
         self._alt = 0
         self._alt_calibrated = 0
         self._azi = 0
         self._azi_calibrated = 0
 
+    def _send_cmd(self, op, axis, degrees=0):
+        """ Queues one command for the stepper driver board, without waiting.
+        If the board refuses it, or it ends in a driver error, that is printed.
+
+        @arg @c op      The command, one of the usb_protocol OP_ constants
+        @arg @c axis    The axis, one of the usb_protocol AXIS_ constants
+        @arg @c degrees The angle argument for slew and turn commands
+
+        @return @c command The driver_client.PendingCommand, to wait on
+        """
+        command = self._dev.submit(op, axis, deg_to_arg(degrees))
+        command.add_done_callback(self._report_failure)
+        return command
+
+    def _report_failure(self, command):
+        """ Prints why a command failed. Called from the client's reader
+        thread when any command sent by _send_cmd finishes.
+        """
+        if command.result != OP_DONE:
+            print('\n' + str(CommandError(command, command.result, command.result_arg)))
+
+    def _wait_cmds(self, commands, timeout=MOVE_TIMEOUT):
+        """ Waits for commands sent by _send_cmd to finish.
+
+        @arg @c commands The driver_client.PendingCommands
+        @arg @c timeout  Seconds to wait for each
+
+        @return @c ok True if they all finished, False if any failed (and was reported)
+        """
+        ok = True
+        for command in commands:
+            try:
+                command.wait(timeout)
+            except CommandError:
+                ok = False # already printed by _report_failure
+            except CommandTimeout as err:
+                print('\n' + str(err))
+                ok = False
+        return ok
+
+    def _set_home(self, *axes):
+        """ Makes the current position HOME on each axis, and waits until it is.
+
+        @return @c ok True if every axis took it
+        """
+        homed = self._wait_cmds([self._send_cmd(OP_HOME_SET, axis) for axis in axes],
+                                CMD_TIMEOUT)
+        if self._pointing is not None:
+            # The motor positions moved, so the old IMU offsets no longer hold
+            self._pointing.reset()
+        return homed
+
+    def _motor_angles(self):
+        """ Reads where the motors are from the board's telemetry, once
+        neither axis is still moving, eg. from a manual slew adjustment.
+
+        @return @c angles The altitude and azimuth motor angles in degrees, or
+                None if the telemetry has stopped or the axes didn't come to rest
+        """
+        deadline = time.time() + MOVE_TIMEOUT
+        while True:
+            telemetry = self._dev.telemetry
+            if telemetry is None or time.time() - telemetry[0] > STALE_AFTER:
+                print('\nNo telemetry from the board, motor positions unknown')
+                return None
+            samples = telemetry[2]
+            if all(samples[axis][3] != STATE_BUSY for axis in AXES):
+                return [self._conv[axis].steps_to_arcsec(samples[axis][0]) / 3600.0
+                        for axis in AXES]
+            if time.time() > deadline:
+                print('\nThe axes are still moving, motor positions unknown')
+                return None
+            time.sleep(LOOP_DELAY)
+
+    def _correction(self):
+        """ @return @c correction What the pointing estimate adds to each motor
+                angle in degrees, all zero without one. The alignment offsets are
+                measured on top of it, the same way tracking.TrackingEngine uses them.
+        """
+        if self._pointing is None:
+            return [0.0, 0.0]
+        return self._pointing.correction()
+
+    def _goto(self, alt, azi):
+        """ Slews to a place in the sky, through the pointing estimate and the
+        offsets found by alignment.
+
+        @arg @c alt The altitude, in degrees
+        @arg @c azi The azimuth, in degrees
+        """
+        self._alt, self._azi = alt, azi
+        correction = self._correction()
+        self._send_cmd(OP_SLEW, AXIS_AZI, azi - correction[AXIS_AZI] - self._offset[AXIS_AZI])
+        self._send_cmd(OP_SLEW, AXIS_ALT, alt - correction[AXIS_ALT] - self._offset[AXIS_ALT])
+
+    def shutdown(self):
+        """ Stops tracking, turns the motors off and lets go of the board and the IMU.
+        """
+        try:
+            if self._tracker is not None:
+                self._tracker.stop()
+                self._tracker = None
+            if self._dev is not None:
+                self._wait_cmds([self._send_cmd(OP_OFF, axis) for axis in (AXIS_AZI, AXIS_ALT)],
+                                CMD_TIMEOUT)
+        finally:
+            if self._dev is not None:
+                self._dev.close()
+            if self._imu_sampler is not None:
+                self._imu_sampler.stop()
+
+    def _read_euler(self):
+        """ @return @c euler The newest heading, roll and pitch from the IMU sampler, in degrees
+        """
+        return self._imu_sampler.wait_latest()[1]['euler']
+
+    def _calibration(self):
+        """ @return @c cal The newest system, gyro, accel and mag calibration status
+        """
+        return self._imu_sampler.wait_latest()[1]['calibration']
+
+    def _locate(self, body):
+        """ Finds where a body is now, from the trajectory cache if it has it
+        yet. The body is added to the cache for next time.
+
+        @arg @c body An ephem body, eg. ephem.Moon()
+
+        @return @c alt_azi The altitude and azimuth of the body, in degrees
+        """
+        alt_azi = self._ephem.lookup(body.name)
+        if alt_azi is None:
+            self._ephem.request(body)
+            self._obs.date = date.utcnow()
+            body.compute(self._obs)
+            alt_azi = (float(body.alt) * 180/ephem.pi, float(body.az) * 180/ephem.pi)
+        return alt_azi
+
     def run_task(self):
         """ Executes task code running the Raspberry Pi controlled portion of the guided telescope mount. The task has a state machine structure.
 
@@ -80,11 +245,18 @@ class Main_Task:
             if self._imu is None:
                 raise ValueError('BNO055 IMU not connected')
             self._imu.begin()
+            if self._imu_sampler is not None:
+                self._imu_sampler.stop()
+            # Reads the IMU in the background from here on
+            self._imu_sampler = ImuSampler(self._imu)
+            self._imu_sampler.start()
+            self._settle = SettleDetector(self._imu_sampler)
 
             # Connects to stepper motor driver board via serial port
             try:
-                self._dev = serial.Serial(port='/dev/ttyACM0', baudrate=115200,
-                                          timeout=5)
+                client = DriverClient(port='/dev/ttyACM0', baudrate=115200)
+                client.open()
+                self._dev = client
             except serial.serialutil.SerialException:
                 print("Unable to connect to driver board")
 
@@ -116,10 +288,29 @@ class Main_Task:
                     self._obs.lon = lon
                     self._obs.lat = lat
                     self._obs.elevation = elev
+
+                    # Starts computing where the targets will be
+                    if self._ephem is None:
+                        self._ephem = TrajectoryCache(self._obs)
+                    else:
+                        self._ephem.set_observer(self._obs)
+                    self._ephem.request(ephem.Moon())
+                    self._ephem.request(ephem.star("Polaris"))
+                    if self._catalog is None:
+                        if os.path.exists(CATALOG_FILE):
+                            self._catalog = load_catalog(CATALOG_FILE)
+                        else:
+                            self._catalog = Catalog.from_ephem_stars()
+                        self._sky_index = SkyIndex(self._catalog)
+                    # Combines the IMU with the motor positions from telemetry,
+                    # which only comes once the board is connected
+                    if self._pointing is None and self._dev is not None:
+                        self._pointing = PointingEstimator(self._imu_sampler)
+                        self._dev.on_telemetry = self._pointing.on_telemetry
                 elif split_cmd[1] == "imu":
                     # Checks the calibration status of the IMU and moves to
                     # IMU calibration state if not calibrated
-                    if self._imu.get_calibration_status()[0] > 0:
+                    if self._calibration()[0] > 0:
                         print("\nIMU is calibrated")
                     else:
                         print('\nStarting IMU calibration...')
@@ -130,7 +321,7 @@ class Main_Task:
                     if self._obs is None:
                         print("\nLocation has not been set, run command: cal obs")
                     else:
-                        if self._imu.get_calibration_status()[0] > 0:
+                        if self._calibration()[0] > 0:
                             self._prev_state = STATE_CMD
                             self._state = STATE_ALIGN
                         else:
@@ -143,22 +334,54 @@ class Main_Task:
                 # currently)
                 if (self._alt_calibrated and self._azi_calibrated) == 1:
                     if split_cmd[1] == "moon":
-                        self._obs.date = date.now()
-                        moon = ephem.Moon(self._obs)
-                        self._alt = float(moon.alt) * 180/ephem.pi
-                        self._azi = float(moon.az) * 180/ephem.pi
+                        self._goto(*self._locate(ephem.Moon()))
+                    elif self._catalog.find(" ".join(split_cmd[1:])) is not None:
+                        index = self._catalog.find(" ".join(split_cmd[1:]))
+                        self._goto(*self._locate(self._catalog.body(index)))
                     else:
                         print("\nNot a valid target")
-                    self._dev.write('azi:slew' + str(self._azi) + '\r')
-                    time.sleep(0.001)
-                    self._dev.write('alt:slew' + str(self._alt) + '\r')
                 else:
                     print("\nDevice not calibrated, run command: cal polar first")
     
+            elif split_cmd[0] == "up":
+                # Lists the brightest catalog objects above an altitude
+                if self._obs is None:
+                    print("\nLocation has not been set, run command: cal obs")
+                else:
+                    min_alt = float(split_cmd[1]) if len(split_cmd) > 1 else 30.0
+                    index, alt, azi = self._catalog.visible(self._obs, min_alt)
+                    for i in range(min(len(index), 20)):
+                        print('%-16s mag %5.2f  alt %5.1f  azi %5.1f' % (
+                            self._catalog.name(index[i]), self._catalog.mag[index[i]],
+                            alt[i], azi[i]))
+
+            elif split_cmd[0] == "track":
+                # Follows a body across the sky until "track stop"
+                stopped = True
+                if self._tracker is not None:
+                    stopped = self._tracker.stop()
+                    self._tracker = None
+                if split_cmd[1] == "stop":
+                    if stopped:
+                        print("\nTracking stopped")
+                    else:
+                        print("\nTracking stopped, but the motors may still be turning")
+                elif (self._alt_calibrated and self._azi_calibrated) == 1:
+                    if split_cmd[1] == "moon":
+                        self._tracker = TrackingEngine(self._dev, self._obs, ephem.Moon(),
+                                                       cache=self._ephem,
+                                                       estimator=self._pointing,
+                                                       offsets=self._offset)
+                        self._tracker.start()
+                    else:
+                        print("\nNot a valid target")
+                else:
+                    print("\nDevice not calibrated, run command: cal polar first")
+
             elif split_cmd[0] == "test":
                 # Allows user to input a string to send directly to board
                 # for debuggin purposes
-                self._dev.write(split_cmd[1] + '\r')
+                self._dev.send_line(split_cmd[1])
 
             else:
                 print("\nNot a valid command entry")
@@ -167,7 +390,7 @@ class Main_Task:
         elif self._state == STATE_CAL_IMU:
             # Prints out calibration status and waits until calibration status
             # is good
-            cal = self._imu.get_calibration_status()
+            cal = self._calibration()
             print('\nIMU system calibration status: ' + str(cal[0]))
             print('\nGyro calibration status: ' + str(cal[1]))
             print('\nAccel calibration status: ' + str(cal[2]))
@@ -184,17 +407,21 @@ class Main_Task:
             #   3. Wait until movement is finished
             #   4. Move on to azimuth calibration routine
 
-            print('\nStarting altitude axis calibration...')
-            self._euler_ang = self._imu.read_euler()
-            self._dev.write('alt:slew ' + str(-self._euler_ang[1]) + '\r')
             if self._prev_state == STATE_IMU_WAIT:
-                self._dev.write('alt:home set\r')
-                time.sleep(0.001)
-                print('\nAltitude axis calibrated.')
-                self._alt_calibrated = 1
-                self._prev_state = STATE_CAL_ALT
-                self._state = STATE_CAL_AZI
+                # Settled at zero pitch, which becomes HOME
+                if self._set_home(AXIS_ALT):
+                    print('\nAltitude axis calibrated.')
+                    self._alt_calibrated = 1
+                    self._prev_state = STATE_CAL_ALT
+                    self._state = STATE_CAL_AZI
+                else:
+                    print('\nAltitude calibration failed, run command: cal polar')
+                    self._prev_state = STATE_CAL_ALT
+                    self._state = STATE_CMD
             else:
+                print('\nStarting altitude axis calibration...')
+                self._euler_ang = self._read_euler()
+                self._moves = [self._send_cmd(OP_SLEW, AXIS_ALT, -self._euler_ang[1])]
                 self._prev_state = STATE_CAL_ALT
                 self._state = STATE_IMU_WAIT
 
@@ -206,16 +433,21 @@ class Main_Task:
             #   3. Wait until movement is finished
             #   4. Move on to overall calibration routine
 
-            print('\nStarting azimuth axis calibration...')
-            self._euler_ang = self._imu.read_euler()
-            self._dev.write('azi:slew' + str(-self._euler_ang[0]) + '\r')
             if self._prev_state == STATE_IMU_WAIT:
-                self._dev.write('azi:home set\r')
-                time.sleep(0.001)
-                print('\nAzimuth axis calibrated.')
-                self._azi_calibrated = 1
-                self._state = STATE_ALIGN
+                # Settled at zero heading, which becomes HOME
+                if self._set_home(AXIS_AZI):
+                    print('\nAzimuth axis calibrated.')
+                    self._azi_calibrated = 1
+                    self._prev_state = STATE_CAL_AZI
+                    self._state = STATE_ALIGN
+                else:
+                    print('\nAzimuth calibration failed, run command: cal polar')
+                    self._prev_state = STATE_CAL_AZI
+                    self._state = STATE_CMD
             else:
+                print('\nStarting azimuth axis calibration...')
+                self._euler_ang = self._read_euler()
+                self._moves = [self._send_cmd(OP_SLEW, AXIS_AZI, -self._euler_ang[0])]
                 self._prev_state = STATE_CAL_AZI
                 self._state = STATE_IMU_WAIT
 
@@ -225,29 +457,30 @@ class Main_Task:
             #   When first getting to this state, go to altitude calibration
             #   When returning from azimuth calibration,
             #   1. Read the current IMU position
-            #   2. Calculate the current position of Polaris
-            #   3. Slew altitude and azimuth axes to Polaris based on IMU reading
+            #   2. Choose an alignment star and calculate its current position
+            #   3. Slew altitude and azimuth axes to the star based on IMU reading
             #   4. Ask user if slewed position is correct
             #   5. If not correct, enter manual adjustment mode
-            #   6. If correct, finish calibration and move on to command state
+            #   6. If correct, save the difference between where the star is
+            #      and where the scope points (see _correction) as the sky offset.
+            #      HOME stays at the calibrated zero.
             if self._prev_state == STATE_CMD:
                 print('\nStarting polar alignment calibration:')
                 self._prev_state = STATE_ALIGN
                 self._state = STATE_CAL_ALT
             elif self._prev_state == STATE_CAL_AZI:
-                self._euler_ang = self._imu.read_euler()
-                self._obs.date = date.now()
-                polaris = ephem.star("Polaris")
-                polaris.compute(self._obs)
-                pol_alt = polaris.alt * 180/ephem.pi
-                pol_azi = polaris.az * 180/ephem.pi
-                print('\nAttempting to slew to Polaris...')
-                self._azi = pol_azi - self._euler_ang[0]
-                self._alt = pol_alt - self._euler_ang[1]
-                self._dev.write('azi:slew' + str(self._azi) + '\r')
-                time.sleep(0.001)
-                self._dev.write('alt:slew' + str(self._alt) + '\r')
-                time.sleep(0.001)
+                self._euler_ang = self._read_euler()
+                # Aligns on the best placed bright star, or Polaris if none is up
+                stars = self._sky_index.pick_alignment_stars(self._obs)
+                star = self._catalog.body(stars[0]) if stars else ephem.star("Polaris")
+                self._align_star = star
+                self._offset = [0.0, 0.0]
+                star_alt, star_azi = self._locate(star)
+                print('\nAttempting to slew to ' + star.name + '...')
+                self._azi = star_azi - self._euler_ang[0]
+                self._alt = star_alt - self._euler_ang[1]
+                self._moves = [self._send_cmd(OP_SLEW, AXIS_AZI, self._azi),
+                               self._send_cmd(OP_SLEW, AXIS_ALT, self._alt)]
                 self._prev_state = STATE_ALIGN
                 self._state = STATE_IMU_WAIT
             elif self._prev_state == STATE_IMU_WAIT:
@@ -256,31 +489,44 @@ class Main_Task:
                     print('\nPlease enter manual slew adjustments.')
                     align_cmd = raw_input('>')
                     while not (align_cmd == 'done'):
-                        self._dev.write(align_cmd + '\r')
-                        self._euler_ang = self._imu.read_euler()
+                        self._dev.send_line(align_cmd)
+                        self._euler_ang = self._read_euler()
                         align_cmd = raw_input('\n>')
                 print('\nSaving alignment...')
-                self._dev.write('azi:home set\r')
-                time.sleep(0.001)
-                self._dev.write('alt:home set\r')
-                time.sleep(0.001)
-                print('\nAlignment finished.')
+                motor = self._motor_angles()
+                if motor is not None:
+                    # against the pointing estimate, the frame tracking adds them in
+                    correction = self._correction()
+                    pointing = [motor[axis] + correction[axis] for axis in (AXIS_ALT, AXIS_AZI)]
+                    star = self._locate(self._align_star)
+                    self._offset = [star[AXIS_ALT] - pointing[AXIS_ALT],
+                                    wrap_degrees(star[AXIS_AZI] - pointing[AXIS_AZI])]
+                    print('\nAlignment finished, offsets: alt %.3f azi %.3f degrees' % (
+                        self._offset[AXIS_ALT], self._offset[AXIS_AZI]))
+                else:
+                    print('\nAlignment not saved, run command: cal polar')
                 self._prev_state = STATE_ALIGN
                 self._state = STATE_CMD
 
-        # Waits for IMU data to stop changing (i.e. motors finished moving)
+        # Waits for the moves to finish and the IMU data to stop changing
         elif self._state == STATE_IMU_WAIT:
-            # If the previous IMU reading has changed more than 0.1 degrees then stay in this state
+            # Stays in this state until the slews are done and the IMU has
+            # been still for a while
             if self._imu_entry is True:
-                self._euler_ang = self._imu.read_euler()
-                self._imu_entry = False
-            else:
-                self._pre_euler_ang = self._euler_ang
-                self._euler_ang = self._imu.read_euler()
-                if abs((self._euler_ang[0] - self._pre_euler_ang[0]) + (self._euler_ang[1] - self._pre_euler_ang[1]) + (self._euler_ang[2] - self._pre_euler_ang[2]))  < 0.1:
-                    self._imu_entry = True
-                    self._state = self._prev_state
+                moved = self._wait_cmds(self._moves)
+                self._moves = []
+                if moved:
+                    self._settle.reset()
+                    self._imu_entry = False
+                else:
+                    print('\nCalibration stopped, run command: cal polar')
                     self._prev_state = STATE_IMU_WAIT
+                    self._state = STATE_CMD
+            elif self._settle.settled():
+                self._euler_ang = self._read_euler()
+                self._imu_entry = True
+                self._state = self._prev_state
+                self._prev_state = STATE_IMU_WAIT
 
         # Error state for errors and stuff
         elif self._state == STATE_ERROR:
@@ -306,6 +552,8 @@ if __name__ == '__main__':
             main.run_task()
             time.sleep(LOOP_DELAY)
     except KeyboardInterrupt:
-        # Shuts off altitude and azimuth motors if a Ctrl-C has been pressed
-        main._dev.write('azi:off\r')
-        main._dev.write('alt:off\r')
+        pass
+    finally:
+        # Shuts off altitude and azimuth motors when Ctrl-C is pressed, or
+        # anything else ends the loop
+        main.shutdown()
@@ -0,0 +1,31 @@
+""" @file mount.py
+The mount's geometry, as the board's MotorTasks see it, for the modules that
+turn motor steps into angles. It only depends on usb_protocol, so it can be
+imported without PyEphem or a serial port.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+from usb_protocol import AXIS_ALT, AXIS_AZI
+
+# === CONSTANTS ===
+# STEP_MODE has to match L6470_configure.MOUNT_PROFILE.
+STEP_DEGREES   = 1.8
+TEETH_DRIVER   = 1
+TEETH_FOLLOWER = 1
+STEP_MODE      = 5
+
+AXES = (AXIS_ALT, AXIS_AZI)
+
+
+# === FUNCTIONS AND CLASSES ===
+def wrap_degrees(angle):
+    """ @arg @c angle An angle difference, in degrees
+
+    @return @c angle The same angle, between -180 and 180 degrees
+    """
+    return (angle + 180.0) % 360.0 - 180.0
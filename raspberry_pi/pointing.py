@@ -0,0 +1,215 @@
+""" @file pointing.py
+Estimates where the scope really points by combining the two things that
+measure it. The motor positions in the board's telemetry are precise and
+smooth, but they only count steps: they can't see a mount that was homed
+slightly wrong, or the gear slack taken up each time an axis turns around.
+The IMU sees the scope itself, but it is noisy.
+
+Each axis has a small Kalman filter with two states: the offset between the
+IMU and motor angles, and the backlash. The model is
+    imu = motor + offset - direction * backlash / 2
+where direction is the way the axis last turned. Every telemetry frame is
+paired with the newest IMU sample, and the filter is updated in constant time
+and memory. The estimate is then the motor angle with the offset and
+backlash put back in.
+
+Angles are in the frame the calibration states set up, with HOME at the IMU's
+zero, the altitude from the IMU's roll and the azimuth from its heading. The
+sky offsets found by alignment are added on top by tracking.TrackingEngine.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import math
+import threading
+import time
+from imu_sampler import GYRO_TO_DPS
+from mount import AXES, STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE, wrap_degrees
+from step_convert import StepConverter
+
+# === CONSTANTS ===
+IMU_NOISE      = 0.5   # [deg], standard deviation of an IMU angle
+OFFSET_DRIFT   = 0.01  # [deg/sqrt(sec)], how fast the offset may wander, eg. magnetic drift
+BACKLASH_DRIFT = 0.001 # [deg/sqrt(sec)], how fast the backlash may change
+BACKLASH_START = 1.0   # [deg], uncertainty of the backlash before any reversals
+DEADBAND       = 0.01  # [deg], motor travel that counts as a change of direction
+MAX_RATE       = 1.0   # [deg/s], faster than this the IMU fusion lags, so it isn't used
+STALE_AFTER    = 0.1   # [sec], older IMU samples aren't paired with telemetry
+
+
+# === FUNCTIONS AND CLASSES ===
+class AxisEstimator:
+    """ @class AxisEstimator
+    The offset and backlash of one axis, as a two-state Kalman filter.
+    """
+
+    def __init__(self, noise=IMU_NOISE, offset_drift=OFFSET_DRIFT,
+                 backlash_drift=BACKLASH_DRIFT, deadband=DEADBAND):
+        """ Creates a new AxisEstimator.
+
+        @arg @c noise          Standard deviation of an IMU angle, in degrees
+        @arg @c offset_drift   How fast the offset may wander, in degrees per root second
+        @arg @c backlash_drift How fast the backlash may change, in degrees per root second
+        @arg @c deadband       Motor travel that counts as a change of direction, in degrees
+        """
+        self._r = noise * noise
+        self._q_offset = offset_drift * offset_drift
+        self._q_backlash = backlash_drift * backlash_drift
+        self._deadband = deadband
+        self.reset()
+
+    def reset(self):
+        """ Forgets everything learned, eg. after the axis is homed again.
+        """
+        self.offset = 0.0   # [deg], IMU angle minus motor angle
+        self.backlash = 0.0 # [deg], total slack between the two directions
+        self.direction = 0  # way the motor last turned: 1, -1, or 0 if it hasn't yet
+        self.updates = 0
+        self._anchor = None # motor angle where the direction was last decided
+        self._time = None
+        # covariance of (offset, backlash)
+        self._p00 = 0.0
+        self._p01 = 0.0
+        self._p11 = BACKLASH_START * BACKLASH_START
+
+    def update(self, motor, measured, when):
+        """ Takes in one pair of readings.
+
+        @arg @c motor    The motor angle, in degrees
+        @arg @c measured The IMU angle at the same time, in degrees
+        @arg @c when     Seconds since the epoch
+        """
+        # which way the axis turned, ignoring jitter smaller than the deadband
+        if self._anchor is None:
+            self._anchor = motor
+        elif motor - self._anchor > self._deadband:
+            self.direction = 1
+            self._anchor = motor
+        elif self._anchor - motor > self._deadband:
+            self.direction = -1
+            self._anchor = motor
+        elif self.direction * (motor - self._anchor) > 0:
+            self._anchor = motor # still turning the same way
+
+        if self.updates == 0:
+            # the first reading sets the offset, backlash can't be seen yet
+            self.offset = wrap_degrees(measured - motor)
+            self._p00 = self._r
+            self._time = when
+            self.updates = 1
+            return
+
+        # predict: both states wander a little over time
+        dt = max(when - self._time, 0.0)
+        self._time = when
+        self._p00 += self._q_offset * dt
+        self._p11 += self._q_backlash * dt
+
+        # correct, with H = (1, h)
+        h = -self.direction / 2.0
+        innovation = wrap_degrees(measured - self.estimate(motor))
+        a0 = self._p00 + h * self._p01
+        a1 = self._p01 + h * self._p11
+        s = a0 + h * a1 + self._r
+        k0 = a0 / s
+        k1 = a1 / s
+        self.offset = wrap_degrees(self.offset + k0 * innovation)
+        self.backlash = max(0.0, self.backlash + k1 * innovation)
+        self._p00 -= k0 * a0
+        self._p01 -= k0 * a1
+        self._p11 -= k1 * a1
+        self.updates += 1
+
+    def estimate(self, motor):
+        """ @arg @c motor The motor angle, in degrees
+
+        @return @c angle Where the axis really points, in degrees
+        """
+        return motor + self.offset - self.direction * self.backlash / 2.0
+
+    def uncertainty(self):
+        """ @return @c sigmas The standard deviations of the offset and backlash, in degrees
+        """
+        return (math.sqrt(max(self._p00, 0.0)), math.sqrt(max(self._p11, 0.0)))
+
+
+class PointingEstimator:
+    """ @class PointingEstimator
+    Fuses the board's telemetry with an imu_sampler.ImuSampler for the
+    altitude and azimuth axes.
+    """
+
+    def __init__(self, sampler, converters=None, max_rate=MAX_RATE, **options):
+        """ Creates a new PointingEstimator. Pass on_telemetry() to the
+        driver_client.DriverClient, or call it with each telemetry frame.
+
+        @arg @c sampler    The ImuSampler to read. It has to sample 'euler' and 'gyroscope'.
+        @arg @c converters One step_convert.StepConverter per axis, or None for the mount's
+        @arg @c max_rate   Fastest the IMU may be turning for a sample to be used, in deg/s
+        @arg @c options    Passed to each AxisEstimator
+        """
+        self._sampler = sampler
+        if converters is None:
+            converters = [StepConverter(STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE)
+                          for axis in AXES]
+        self._conv = converters
+        self._max_rate = max_rate
+        self._lock = threading.Lock()
+        self.axes = [AxisEstimator(**options) for axis in AXES]
+        self.motor = None # [deg], the motor angles from the newest telemetry
+
+    def reset(self):
+        """ Forgets everything learned, eg. after the axes are homed again.
+        """
+        with self._lock:
+            for estimator in self.axes:
+                estimator.reset()
+            self.motor = None
+
+    def on_telemetry(self, seq, samples):
+        """ Updates the estimate with one telemetry frame and the newest IMU
+        sample. Meant for driver_client.DriverClient.on_telemetry.
+
+        @arg @c seq     The frame's sequence number
+        @arg @c samples The frame's (abs_pos, speed, status, state) per axis
+        """
+        motor = [self._conv[axis].steps_to_arcsec(samples[axis][0]) / 3600.0 for axis in AXES]
+        sample = self._sampler.latest()
+        with self._lock:
+            self.motor = motor
+            if sample is None:
+                return
+            when, fusion = sample
+            if time.time() - when > STALE_AFTER:
+                return # the sampler has stalled, eg. bus errors
+            x, y, z = fusion['gyroscope']
+            if math.sqrt(x*x + y*y + z*z) * GYRO_TO_DPS > self._max_rate:
+                return
+            heading, roll, pitch = fusion['euler']
+            measured = (roll, heading) # by axis, as the alignment states use them
+            for axis in AXES:
+                self.axes[axis].update(motor[axis], measured[axis], when)
+
+    def correction(self):
+        """ @return @c correction What position() adds to each motor angle, the
+                offset less half the backlash the way the axis last turned, in degrees
+        """
+        with self._lock:
+            return [self.axes[axis].estimate(0.0) for axis in AXES]
+
+    def position(self, motor=None):
+        """ @arg @c motor The motor angle of each axis in degrees, or None for the newest telemetry
+
+        @return @c alt_azi Where the scope really points, in degrees, or None
+                before any telemetry has arrived
+        """
+        with self._lock:
+            if motor is None:
+                motor = self.motor
+            if motor is None:
+                return None
+            return [self.axes[axis].estimate(motor[axis]) for axis in AXES]
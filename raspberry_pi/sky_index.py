@@ -0,0 +1,213 @@
+""" @file sky_index.py
+Cone searches, nearest-object lookups and alignment star choice over a
+Catalog. Each object is stored as a J2000 unit vector, where the angle between
+two objects is set by the straight-line (chord) distance between their
+vectors.
+
+The index is a grid of declination bands, each cut into equal slices of
+right ascension, sized so a cell holds about CELL_OBJECTS objects. The
+catalog is sorted by cell once, so the objects in a run of neighbouring
+cells in one band are one contiguous slice. A cone search only gathers the
+cells its cone overlaps, a few slices per band, and checks the exact
+distance on those. Only NumPy is needed.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import numpy as np
+
+# === CONSTANTS ===
+CELL_OBJECTS    = 8    # objects per grid cell to aim for
+CELL_MIN        = 0.5  # [deg], smallest cell, so the grid stays small for huge catalogs
+CELL_MAX        = 10.0 # [deg], largest cell, so small catalogs still get an index
+SKY_SQ_DEG      = 41252.96 # [deg^2], the whole sky
+ALIGN_COUNT     = 3    # alignment stars to choose
+ALIGN_MIN_ALT   = 30.0 # [deg], lower stars are hurt by refraction and obstructions
+ALIGN_MAX_ALT   = 80.0 # [deg], higher stars are near the azimuth singularity
+ALIGN_MAX_MAG   = 2.5  # faintest star worth aligning on
+ALIGN_MIN_SEP   = 30.0 # [deg], smallest angle between chosen stars
+
+
+# === FUNCTIONS AND CLASSES ===
+def unit_vectors(ra, dec):
+    """ @arg @c ra  Right ascensions, in radians
+    @arg @c dec Declinations, in radians
+
+    @return @c vectors An (n, 3) array of unit vectors
+    """
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def chord(degrees):
+    """ @return @c chord The distance between unit vectors that are <degrees> apart
+    """
+    return 2.0 * np.sin(np.radians(degrees) / 2.0)
+
+
+def chord_to_degrees(distance):
+    """ @return @c degrees The angle between unit vectors <distance> apart
+    """
+    return np.degrees(2.0 * np.arcsin(np.clip(distance / 2.0, 0.0, 1.0)))
+
+
+class SkyIndex:
+    """ @class SkyIndex
+    Answers "what is near here" for a Catalog. Built once, since J2000
+    positions don't move. See the top of the file for how it is laid out.
+    """
+
+    def __init__(self, catalog, cell=None):
+        """ Creates a new SkyIndex.
+
+        @arg @c catalog The catalog.Catalog to index
+        @arg @c cell    The size of a grid cell in degrees, or None to pick one
+                        from the size of the catalog
+        """
+        self.catalog = catalog
+        self._vectors = unit_vectors(catalog.ra, catalog.dec)
+        if cell is None:
+            cell = np.sqrt(SKY_SQ_DEG * CELL_OBJECTS / max(len(catalog), 1))
+            cell = float(np.clip(cell, CELL_MIN, CELL_MAX))
+        self._bands = int(np.ceil(180.0 / cell))
+        self._band_deg = 180.0 / self._bands
+        self._slices = int(np.ceil(360.0 / cell)) # RA cells per band
+        self._slice_deg = 360.0 / self._slices
+        # sort by cell, and keep where each cell's run starts
+        band = self._band(np.degrees(catalog.dec))
+        ra_cell = self._ra_cell(np.degrees(catalog.ra))
+        key = band * self._slices + ra_cell
+        self._order = np.argsort(key, kind='mergesort')
+        self._starts = np.searchsorted(key[self._order],
+                                       np.arange(self._bands * self._slices + 1))
+
+    def _band(self, dec):
+        # the band of declinations in degrees
+        band = np.floor((np.asarray(dec) + 90.0) / self._band_deg).astype(int)
+        return np.clip(band, 0, self._bands - 1)
+
+    def _ra_cell(self, ra):
+        # the slice of a band that right ascensions in degrees fall in
+        cell = np.floor(np.mod(ra, 360.0) / self._slice_deg).astype(int)
+        return np.clip(cell, 0, self._slices - 1)
+
+    def _candidates(self, ra, dec, radius):
+        # the catalog indices in every cell the cone overlaps, in degrees
+        if radius >= 180.0:
+            return self._order
+        first, last = self._band([dec - radius, dec + radius])
+        if abs(dec) + radius >= 90.0:
+            half_width = 180.0 # the cone takes in a pole, so every right ascension
+        else:
+            # the widest the cone gets in right ascension
+            half_width = np.degrees(np.arcsin(np.sin(np.radians(radius)) /
+                                              np.cos(np.radians(dec))))
+        low = int(np.floor((ra - half_width) / self._slice_deg))
+        high = int(np.floor((ra + half_width) / self._slice_deg))
+        if high - low + 1 >= self._slices:
+            runs = [(0, self._slices - 1)]
+        else:
+            low %= self._slices
+            high %= self._slices
+            runs = [(low, high)] if low <= high else [(low, self._slices - 1), (0, high)]
+        starts = self._starts
+        parts = []
+        for band in range(first, last + 1):
+            row = band * self._slices
+            for low, high in runs:
+                parts.append(self._order[starts[row + low]:starts[row + high + 1]])
+        return np.concatenate(parts)
+
+    def cone(self, ra, dec, radius):
+        """ Finds every object within <radius> of a point.
+
+        @arg @c ra     J2000 right ascension of the point, in radians
+        @arg @c dec    J2000 declination of the point, in radians
+        @arg @c radius The search radius, in degrees
+
+        @return @c indices The catalog indices, in no particular order
+        """
+        index = self._candidates(np.degrees(ra), np.degrees(dec), radius)
+        if radius >= 180.0:
+            return index # the whole sky, don't let rounding drop the far side
+        point = unit_vectors(ra, dec)[0]
+        return index[self._vectors[index].dot(point) >= np.cos(np.radians(radius))]
+
+    def nearest(self, ra, dec, count=1):
+        """ Finds the objects closest to a point.
+
+        @arg @c ra    J2000 right ascension of the point, in radians
+        @arg @c dec   J2000 declination of the point, in radians
+        @arg @c count How many objects to return
+
+        @return @c nearest The catalog indices, closest first, and their distances in degrees
+        """
+        point = unit_vectors(ra, dec)[0]
+        count = min(count, len(self._vectors))
+        if count == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        # widen the cone until it holds enough objects. The nearest <count>
+        # are then all inside it, since at least that many are.
+        radius = self._band_deg
+        while True:
+            index = self.cone(ra, dec, radius)
+            if len(index) >= count or radius >= 180.0:
+                break
+            radius = min(radius * 2.0, 180.0)
+        distance = np.sqrt(np.maximum(2.0 - 2.0 * self._vectors[index].dot(point), 0.0))
+        nearest = np.argpartition(distance, count - 1)[:count]
+        nearest = nearest[np.argsort(distance[nearest])]
+        return index[nearest], chord_to_degrees(distance[nearest])
+
+    def nearest_altaz(self, observer, alt, az, count=1, when=None):
+        """ Finds the objects closest to a point in the local sky, eg. where
+        the IMU says the scope is pointing.
+
+        @arg @c observer An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c alt      The altitude of the point, in degrees
+        @arg @c az       The azimuth of the point, in degrees
+        @arg @c count    How many objects to return
+        @arg @c when     Seconds since the epoch, or None for now
+
+        @return @c nearest See nearest()
+        """
+        ra, dec = self.catalog.j2000(observer, alt, az, when)
+        return self.nearest(ra, dec, count)
+
+    def pick_alignment_stars(self, observer, count=ALIGN_COUNT, min_alt=ALIGN_MIN_ALT,
+                             max_alt=ALIGN_MAX_ALT, max_mag=ALIGN_MAX_MAG,
+                             min_separation=ALIGN_MIN_SEP, when=None):
+        """ Chooses stars to align on: bright, well above the horizon and far
+        apart from each other. The brightest usable star is taken first, then
+        each next one is the brightest that is at least <min_separation> away
+        from all those already taken.
+
+        @arg @c observer       An ephem.Observer, or a (lat, lon) pair in radians
+        @arg @c count          How many stars to choose
+        @arg @c min_alt        Lowest altitude to use, in degrees
+        @arg @c max_alt        Highest altitude to use, in degrees
+        @arg @c max_mag        Faintest magnitude to use
+        @arg @c min_separation Smallest angle between chosen stars, in degrees
+        @arg @c when           Seconds since the epoch, or None for now
+
+        @return @c stars The catalog indices of the chosen stars, best first.
+                May be fewer than <count> if the sky doesn't have enough.
+        """
+        index, alt, az = self.catalog.visible(observer, min_alt, max_mag, when)
+        usable = np.zeros(len(self.catalog), dtype=bool)
+        usable[index[alt <= max_alt]] = True
+        chosen = []
+        for i in index: # brightest first
+            if not usable[i]:
+                continue
+            chosen.append(int(i))
+            if len(chosen) == count:
+                break
+            usable[self.cone(self.catalog.ra[i], self.catalog.dec[i], min_separation)] = False
+        return chosen
@@ -0,0 +1,193 @@
+""" @file step_convert.py
+This module converts between output shaft angles and L6470 microsteps using
+integer math only, so it behaves the same on the board and on a PC. The same
+file is kept in telescope_driver/ and raspberry_pi/.
+
+    @authors Anthony Lombardi
+    @authors John Barry
+    @date 8 December 2016
+"""
+
+ARCSEC_PER_REV = 1296000 # 360 degrees, in arcseconds
+ABS_POS_BITS   = 22      # width of the ABS_POS and MARK registers
+SPEED_MAX      = 0xFFFFF # largest SPEED register (and Run argument) value
+# SPEED is in full steps per 250 ns tick, as a 0.28 fixed point number, so one
+# full step per second is 2^28 * 250e-9 = 2^28 / 4000000 register units
+_SPEED_SHIFT   = 28
+_TICKS_PER_SEC = 4000000
+# The scale factors are split into a whole part and a fraction of 30
+# significant bits, kept as two 15 bit limbs. Inputs are split the same way,
+# so every product of two limbs is below 2^30, a MicroPython small int.
+_LIMB_BITS     = 15
+_LIMB_MASK     = (1 << _LIMB_BITS) - 1
+_FRAC_BITS     = 30
+
+def _div_round (num, den):
+    # integer division rounding half away from zero, for either sign
+    if num < 0:
+        return -((-num + den//2) // den)
+    return (num + den//2) // den
+
+def _scale_factor (num, den):
+    # num/den as (whole part, fraction high limb, fraction low limb, shift),
+    # where the fraction is (high << 15 | low) / 2^shift. The shift grows
+    # until the fraction has 30 significant bits, so it is rounded by at
+    # most 2^-30 of itself.
+    whole = num // den
+    rem = num - whole*den
+    shift = _FRAC_BITS
+    frac = _div_round(rem << shift, den)
+    while rem and frac < 1 << (_FRAC_BITS-1):
+        shift += 1
+        frac = _div_round(rem << shift, den)
+    if frac == 1 << _FRAC_BITS: # rounded up to a whole
+        whole += 1
+        frac = 0
+    return (whole, frac >> _LIMB_BITS, frac & _LIMB_MASK, shift)
+
+def _scale (x, factor):
+    # x times a factor from _scale_factor, rounded half away from zero.
+    # While x and the result are within +-(2^30-1), so is every intermediate.
+    if x < 0:
+        return -_scale(-x, factor)
+    whole, high, low, shift = factor
+    x_high = x >> _LIMB_BITS
+    x_low = x & _LIMB_MASK
+    # x * fraction * 2^shift is top*2^30 + carry*2^15 + the low 15 bits of x_low*low
+    cross_a = x_high * low
+    cross_b = x_low * high
+    carry = ((x_low * low) >> _LIMB_BITS) + (cross_a & _LIMB_MASK) + (cross_b & _LIMB_MASK)
+    top = x_high * high + (cross_a >> _LIMB_BITS) + (cross_b >> _LIMB_BITS) + (carry >> _LIMB_BITS)
+    if shift == _FRAC_BITS:
+        part = top + ((carry >> (_LIMB_BITS-1)) & 1)
+    else:
+        part = ((top >> (shift - _FRAC_BITS - 1)) + 1) >> 1
+    scaled = x * whole
+    return scaled + part
+
+def to_signed (abs_pos):
+    """ Turns a raw ABS_POS or MARK register value into a signed step count.
+
+        @arg @c abs_pos (int): The 22-bit two's complement register value.
+
+        @return @c steps (int): The position, from -2^21 to 2^21-1.
+    """
+    abs_pos &= (1<<ABS_POS_BITS)-1
+    if abs_pos & (1<<(ABS_POS_BITS-1)):
+        return abs_pos - (1<<ABS_POS_BITS)
+    return abs_pos
+
+def to_abs_pos (steps):
+    """ Turns a signed step count into the 22-bit form GoTo and SetParam
+            expect, wrapping the same way the ABS_POS register does.
+
+        @arg @c steps (int): The position, in microsteps.
+
+        @return @c abs_pos (int): The 22-bit two's complement value.
+    """
+    return steps & ((1<<ABS_POS_BITS)-1)
+
+class StepConverter:
+    """ @details Holds the gear ratio and step mode of one axis as integer
+            scale factors. Angles are kept in whole arcseconds, and a
+            conversion is a multiply by the whole part of a factor plus
+            four limb multiplies and a rounding shift for its fraction, so
+            no floats, divides or bignums are involved. Every intermediate
+            stays a small int on the board while the input and result are
+            below 2^30, which covers the whole ABS_POS range of the mount
+            (2^21 microsteps of 202.5" is under 2^29 arcsec) and rates up to
+            2^30 mas/s, about 298 degrees per second.
+
+            Where exactness stops: a result is the nearest whole microstep
+            or arcsecond, give or take 2^-30 of the share of it that comes
+            from the factor's fraction. Steps to arcseconds on the mount
+            (202.5"/microstep) have an exact fraction. A step count survives the round
+            trip to arcseconds and back only while one microstep is at
+            least one arcsecond of output rotation, ie. while
+            full steps per rev * teeth_follower / teeth_driver * 2^step_mode
+            is at most 1296000. A 1.8 degree motor at 1:1 is 50.6"/microstep
+            even at 1/128, but with a 1:100 reduction at 1/128 microsteps
+            are 0.5" and angles are only good to the nearest arcsecond.
+    """
+    def __init__(self, step_degrees=1.8, teeth_driver=1, teeth_follower=1, step_mode=0):
+        """ Create a converter for one axis.
+
+        @arg @c step_degrees   The size of one full step of the motor, in degrees.
+        @arg @c teeth_driver   The number of teeth on the attached gear.
+        @arg @c teeth_follower The number of teeth on the driven gear.
+        @arg @c step_mode      The STEP_MODE register value, 0 (full step) to 7 (1/128).
+        """
+        # full steps per motor revolution, eg. 200 for a 1.8 degree motor
+        self._full_steps = int(round(360.0/step_degrees))
+        self._n_d = teeth_driver
+        self._n_f = teeth_follower
+        # SPEED units per mas/s and back. Speeds are in full steps, so these
+        # don't depend on the step mode.
+        full = self._full_steps * self._n_f
+        unit = 1000 * ARCSEC_PER_REV * self._n_d * _TICKS_PER_SEC
+        self._to_speed = _scale_factor(full << _SPEED_SHIFT, unit)
+        self._to_rate = _scale_factor(unit, full << _SPEED_SHIFT)
+        self.step_mode = None
+        self.set_step_mode(step_mode)
+
+    def set_step_mode (self, step_mode):
+        """ Rescales for a new step mode. Cheap to call every time the mode is
+        read, it does nothing unless the mode changed.
+
+        @arg @c step_mode The STEP_MODE register value. Only the low 3 bits are used.
+        """
+        step_mode &= 7
+        if step_mode == self.step_mode:
+            return
+        self.step_mode = step_mode
+        # microsteps per arcsecond of output is num/den, one factor for each direction
+        num = (self._full_steps * self._n_f) << step_mode
+        den = ARCSEC_PER_REV * self._n_d
+        self._to_steps = _scale_factor(num, den)
+        self._to_arcsec = _scale_factor(den, num)
+
+    def arcsec_to_steps (self, arcsec):
+        """ @arg @c arcsec (int): An output angle, in arcseconds.
+
+        @return @c steps (int): The nearest microstep count.
+        """
+        return _scale(arcsec, self._to_steps)
+
+    def steps_to_arcsec (self, steps):
+        """ @arg @c steps (int): A microstep count.
+
+        @return @c arcsec (int): The nearest output angle, in arcseconds.
+        """
+        return _scale(steps, self._to_arcsec)
+
+    def rate_to_speed (self, mas_per_sec):
+        """ Converts an output rate to the units of the SPEED register and
+        the Run command. The step mode doesn't matter, speeds are always in
+        full steps.
+
+        @arg @c mas_per_sec (int): The output rate, in milliarcseconds per second.
+
+        @return @c speed (int): The signed speed, in SPEED register units.
+        """
+        return _scale(mas_per_sec, self._to_speed)
+
+    def speed_to_rate (self, speed):
+        """ @arg @c speed (int): A signed speed, in SPEED register units.
+
+        @return @c mas_per_sec (int): The output rate, in milliarcseconds per second.
+        """
+        return _scale(speed, self._to_rate)
+
+    def deg_to_steps (self, degrees):
+        """ @arg @c degrees (float): An output angle, in degrees.
+
+        @return @c steps (int): The nearest microstep count.
+        """
+        return self.arcsec_to_steps(int(round(degrees * 3600)))
+
+    def steps_to_deg (self, steps):
+        """ @arg @c steps (int): A microstep count.
+
+        @return @c degrees (float): The output angle, to the nearest arcsecond.
+        """
+        return self.steps_to_arcsec(steps) / 3600.0
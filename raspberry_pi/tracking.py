@@ -0,0 +1,258 @@
+""" @file tracking.py
+Keeps the telescope on a moving target. A TrackingEngine recomputes the
+target's altitude and azimuth with PyEphem a few times a second, turns their
+rate of change into L6470 SPEED units for each axis and sends them to the
+board as OP_TRACK commands. The motor positions from the board's telemetry
+close the loop: a small extra speed, proportional to the pointing error, is
+added so the error can't build up over a night. Given a
+pointing.PointingEstimator, the loop uses its corrected positions instead.
+
+Speeds are only sent when they change, so a steady target costs a frame or
+two per axis every few seconds.
+
+The SPEED register is quantized to 2^-28 full steps per 250 ns tick, about
+0.0149 full steps/s. With this mount (1.8 degree steps, 1:1) that is one unit
+per 96.6"/s, so the sidereal rate (15"/s) rounds to 0 and even the largest
+correction is a single unit. Below MIN_RUN_SPEED units an axis therefore
+isn't run at a speed at all. It is stopped and kept on target with small
+corrective OP_SLEWs instead, one whenever the target drifts half a microstep
+(101" at 1/32 stepping) from the motor. The error then stays within half a
+microstep, plus the drift over one update, and costs a frame per microstep:
+about one every 13 s at the sidereal rate.
+
+@author John Barry
+@author Anthony Lombardi
+
+@date 6 December 2016
+"""
+
+# === IMPORTS ===
+import threading
+import time
+from datetime import datetime
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import ephem
+from driver_client import CommandError, CommandTimeout
+from mount import AXES, STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE, wrap_degrees
+from step_convert import StepConverter
+from usb_protocol import OP_SLEW, OP_TRACK, OP_STOP, deg_to_arg
+
+# === CONSTANTS ===
+UPDATE_RATE    = 2.0   # [Hz], how often the target is recomputed
+RATE_STEP      = 1.0   # [sec], time step for the rate of change of alt/az
+GAIN           = 0.1   # [1/sec], share of the pointing error taken out per second
+MAX_CORRECTION = 60.0  # [arcsec/sec], largest speed added to take out an error
+KEEPALIVE      = 30.0  # [sec], longest time between speeds sent to an axis
+TELEMETRY_MS   = 100   # [ms], telemetry period asked of the board while tracking
+STALE_AFTER    = 1.0   # [sec], older telemetry isn't used to correct the speed
+SLEW_TIMEOUT   = 120.0 # [sec], longest the first slew to the target may take
+STOP_TIMEOUT   = 2.0   # [sec], longest to wait for the board to take a stop
+MIN_RUN_SPEED  = 4     # [SPEED units], slower than this the quantization is over 1/8,
+                       # so the axis is moved with corrective slews instead
+
+
+# === FUNCTIONS AND CLASSES ===
+class TrackingEngine:
+    """ @class TrackingEngine
+    Tracks one PyEphem body on a background thread, through a
+    driver_client.DriverClient.
+    """
+
+    def __init__(self, client, observer, body, rate=UPDATE_RATE, gain=GAIN, converters=None,
+                 cache=None, estimator=None, offsets=None):
+        """ Creates a new TrackingEngine. Call start() to begin tracking.
+
+        @arg @c client     The driver_client.DriverClient connected to the board
+        @arg @c observer   The ephem.Observer for the mount's location. A copy is used.
+        @arg @c body       The ephem body to follow, eg. ephem.Moon()
+        @arg @c rate       How often to update the speeds, in Hz
+        @arg @c gain       Share of the pointing error to take out per second
+        @arg @c converters One step_convert.StepConverter per axis, or None for the mount's
+        @arg @c cache      An ephem_cache.TrajectoryCache to look the target up in, or None
+        @arg @c estimator  A pointing.PointingEstimator to correct the motor positions with, or None
+        @arg @c offsets    The sky angle minus the pointing of each axis, in degrees, as
+                           found by alignment. The pointing is the estimator's position,
+                           or the motor angle without one. None if zeroed on the sky.
+        """
+        self._client = client
+        self._obs = observer.copy()
+        self._body = body
+        self._cache = cache
+        self._estimator = estimator
+        self._offsets = list(offsets) if offsets is not None else [0.0, 0.0]
+        if cache is not None:
+            cache.request(body)
+        self._period = 1.0 / rate
+        self._gain = gain
+        if converters is None:
+            converters = [StepConverter(STEP_DEGREES, TEETH_DRIVER, TEETH_FOLLOWER, STEP_MODE)
+                          for axis in AXES]
+        self._conv = converters
+        self._sent = [None, None]      # last speed sent to each axis
+        self._sent_time = [0.0, 0.0]
+        self._moves = [None, None]     # the last stop or corrective slew of each axis
+        self._slewed = [None, None]    # [deg], where the last corrective slew went
+        # [arcsec], the size of a microstep, the finest a slew can place an axis
+        self._step = [converter.steps_to_arcsec(1) for converter in converters]
+        self._stop = threading.Event()
+        self._thread = None
+        self.error = [0.0, 0.0] # [arcsec], the latest pointing error of each axis
+
+    def target(self, when):
+        """ Computes where the body is.
+
+        @arg @c when Seconds since the epoch
+
+        @return @c alt_azi The altitude and azimuth of the body, in degrees
+        """
+        if self._cache is not None:
+            alt_azi = self._cache.lookup(self._body.name, when)
+            if alt_azi is not None:
+                return alt_azi
+        self._obs.date = ephem.Date(datetime.utcfromtimestamp(when))
+        self._body.compute(self._obs)
+        return (float(self._body.alt) * 180/ephem.pi, float(self._body.az) * 180/ephem.pi)
+
+    def start(self, acquire=True):
+        """ Starts tracking on a background thread.
+
+        @arg @c acquire If True, slew to the target first
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(acquire,), name='tracking')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops tracking and brings both axes to a stop. The board is
+        waited on until it takes the stops, and a refusal is printed.
+
+        @return @c stopped True if the board took the stop for every axis
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        stops = [self._client.submit(OP_STOP, axis) for axis in AXES]
+        stopped = True
+        for command in stops:
+            try:
+                command.wait_ack(STOP_TIMEOUT)
+            except (CommandError, CommandTimeout) as err:
+                print('\nCould not stop the motors: ' + str(err))
+                stopped = False
+        return stopped
+
+    def update(self):
+        """ Recomputes the target and sends new speeds to any axis whose
+        speed changed. Called by the tracking thread.
+        """
+        now = time.time()
+        before = self.target(now - RATE_STEP/2)
+        after = self.target(now + RATE_STEP/2)
+        target = self.target(now)
+        motor, position = self._position()
+        for axis in AXES:
+            # [arcsec/sec], the rate the sky moves at
+            rate = wrap_degrees(after[axis] - before[axis]) / RATE_STEP * 3600
+            if position is not None:
+                self.error[axis] = wrap_degrees(target[axis] - position[axis]) * 3600
+                correction = self._gain * self.error[axis]
+                rate += max(-MAX_CORRECTION, min(MAX_CORRECTION, correction))
+            speed = self._conv[axis].rate_to_speed(int(round(rate * 1000)))
+            if abs(speed) < MIN_RUN_SPEED:
+                self._correct(axis, target[axis], motor, position)
+            else:
+                self._send(axis, speed)
+
+    def _position(self):
+        # the motor angles from the board's telemetry and where the axes
+        # point in the sky, in degrees, or (None, None) if stale. With an
+        # estimator, the pointing is also corrected for the IMU offset and
+        # backlash it has found.
+        telemetry = self._client.telemetry
+        if telemetry is None or time.time() - telemetry[0] > STALE_AFTER:
+            return None, None
+        samples = telemetry[2]
+        motor = [self._conv[axis].steps_to_arcsec(samples[axis][0]) / 3600.0 for axis in AXES]
+        position = motor
+        if self._estimator is not None:
+            position = self._estimator.position(motor)
+        return motor, [position[axis] + self._offsets[axis] for axis in AXES]
+
+    def _motor_goal(self, axis, sky):
+        # [deg], the motor angle that points the axis at a sky angle, going
+        # by the estimator's latest correction when there is no telemetry
+        if self._estimator is not None:
+            sky -= self._estimator.correction()[axis]
+        return sky - self._offsets[axis]
+
+    def _moving(self, axis):
+        # True while the last stop or corrective slew of the axis is under way
+        move = self._moves[axis]
+        return move is not None and not move.done()
+
+    def _submit(self, op, axis, arg):
+        # queues a command without waiting for room, or returns None
+        try:
+            return self._client.submit(op, axis, arg, block=False)
+        except queue.Full:
+            return None # the link is backed up, try again next update
+
+    def _send(self, axis, speed):
+        now = time.time()
+        if speed == self._sent[axis] and now - self._sent_time[axis] < KEEPALIVE:
+            return
+        if self._moving(axis):
+            return # the board refuses a speed while a slew runs
+        if self._submit(OP_TRACK, axis, speed) is None:
+            return
+        self._sent[axis] = speed
+        self._sent_time[axis] = now
+        self._slewed[axis] = None
+
+    def _correct(self, axis, target, motor, position):
+        # keeps a slow axis on target with slews, see the top of the file
+        if self._moving(axis):
+            return
+        if self._sent[axis]:
+            # it was running at a speed, which has to stop before it can slew
+            self._moves[axis] = self._submit(OP_STOP, axis, 0)
+            if self._moves[axis] is not None:
+                self._sent[axis] = 0
+            return
+        if position is None:
+            # no telemetry, so go by the last slew instead
+            goal = self._motor_goal(axis, target)
+            reference = self._slewed[axis]
+        else:
+            goal = motor[axis] + wrap_degrees(target - position[axis])
+            reference = motor[axis]
+        if reference is not None and abs(wrap_degrees(goal - reference)) * 3600 < self._step[axis] / 2.0:
+            return # already within half a microstep
+        self._moves[axis] = self._submit(OP_SLEW, axis, deg_to_arg(goal))
+        if self._moves[axis] is not None:
+            self._slewed[axis] = goal
+
+    def _run(self, acquire):
+        self._client.set_telemetry_rate(TELEMETRY_MS)
+        if acquire:
+            # aim a little ahead, where the target will be once the slew is done
+            target = self.target(time.time() + 5)
+            slews = [self._client.submit(OP_SLEW, axis,
+                                         deg_to_arg(self._motor_goal(axis, target[axis])))
+                     for axis in AXES]
+            try:
+                for command in slews:
+                    command.wait(SLEW_TIMEOUT)
+            except (CommandError, CommandTimeout) as err:
+                print('\nCould not reach the target, not tracking: ' + str(err))
+                return
+        next_time = time.time()
+        while not self._stop.is_set():
+            self.update()
+            next_time += self._period
+            self._stop.wait(max(0.0, next_time - time.time()))
@@ -6,10 +6,19 @@
 import ujson
 import sys
 
+# the profile both mount axes run with
+MOUNT_PROFILE = {
+    'STEP_MODE': 5,    # 1/32 microstep
+    'MAX_SPEED': 0x20, # 1/2 of the default
+}
+
 
 def set_config(driver_obj, config_dict):
+    """ Writes every register in config_dict. A MotorTask programs the whole
+    dict at once and checks it once, see MotorTask.apply_params.
     """
-    """
+    if hasattr(driver_obj, 'apply_params'):
+        return driver_obj.apply_params(config_dict)
 
     for key in config_dict:
         try:
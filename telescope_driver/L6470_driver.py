@@ -5,7 +5,41 @@ This module implements the command set of the L6470 stepper driver.
     @authors John Barry
     @date 8 December 2016
 """
-from math import ceil as math_ceil
+def get_status_all(chain):
+    """ Reads the STATUS register of every L6470 on a stmspi.DaisyChain in a
+            single frame. Like L6470.GetStatus, this clears the error flags.
+
+        @arg @c chain (obj): The stmspi.DaisyChain the drivers sit on.
+
+        @return @c statuses (list): The two-byte status of each driver, in chain order.
+    """
+    return chain.broadcast(0b11010000,1,2)
+
+def measure_alloc(command, *args):
+    """ Counts the heap bytes allocated by one call to a driver command.
+            MicroPython only, as it relies on gc.mem_alloc().
+
+        @arg @c command (func): The bound command to call, eg. driver.GetStatus.
+        @arg @c args:           The arguments to call it with.
+
+        @return @c bytes (int): The number of bytes the command allocated.
+    """
+    import gc
+    gc.collect()
+    gc.disable() # don't let a collection hide anything
+    # the cost of the call itself, so only the command is counted
+    start = gc.mem_alloc()
+    __call(*args)
+    overhead = gc.mem_alloc() - start
+    start = gc.mem_alloc()
+    command(*args)
+    used = gc.mem_alloc() - start
+    gc.enable()
+    return used - overhead
+
+# does nothing, for measure_alloc's baseline
+def __call(*args):
+    pass
 
 class L6470:
     """ @details This class represents an L6470 stepper driver.
@@ -17,36 +51,51 @@ class L6470:
     # === DICTIONARIES ===
     """ Dictionary of available registers and their addresses.
     """
-    REGISTER_DICT = {} #        ADDR | LEN |  DESCRIPTION     | xRESET | Write
-    REGISTER_DICT['ABS_POS'   ]=[0x01, 22] # current pos      | 000000 |   S
-    REGISTER_DICT['EL_POS'    ]=[0x02,  9] # Electrical pos   |    000 |   S
-    REGISTER_DICT['MARK'      ]=[0x03, 22] # mark position    | 000000 |   W
-    REGISTER_DICT['SPEED'     ]=[0x04, 20] # current speed    |  00000 |   R
-    REGISTER_DICT['ACC'       ]=[0x05, 12] # accel limit      |    08A |   W
-    REGISTER_DICT['DEC'       ]=[0x06, 12] # decel limit      |    08A |   W
-    REGISTER_DICT['MAX_SPEED' ]=[0x07, 10] # maximum speed    |    041 |   W
-    REGISTER_DICT['MIN_SPEED' ]=[0x08, 13] # minimum speed    |      0 |   S
-    REGISTER_DICT['FS_SPD'    ]=[0x15, 10] # full-step speed  |    027 |   W
-    REGISTER_DICT['KVAL_HOLD' ]=[0x09,  8] # holding Kval     |     29 |   W
-    REGISTER_DICT['KVAL_RUN'  ]=[0x0A,  8] # const speed Kval |     29 |   W
-    REGISTER_DICT['KVAL_ACC'  ]=[0x0B,  8] # accel start Kval |     29 |   W
-    REGISTER_DICT['KVAL_DEC'  ]=[0x0C,  8] # decel start Kval |     29 |   W
-    REGISTER_DICT['INT_SPEED' ]=[0x0D, 14] # intersect speed  |   0408 |   H
-    REGISTER_DICT['ST_SLP'    ]=[0x0E,  8] # start slope      |     19 |   H
-    REGISTER_DICT['FN_SLP_ACC']=[0x0F,  8] # accel end slope  |     29 |   H
-    REGISTER_DICT['FN_SLP_DEC']=[0x10,  8] # decel end slope  |     29 |   H
-    REGISTER_DICT['K_THERM'   ]=[0x11,  4] # therm comp factr |      0 |   H
-    REGISTER_DICT['ADC_OUT'   ]=[0x12,  5] # ADC output       |     XX |
-    REGISTER_DICT['OCD_TH'    ]=[0x13,  4] # OCD threshold    |      8 |   W
-    REGISTER_DICT['STALL_TH'  ]=[0x14,  7] # STALL threshold  |     40 |   W
-    REGISTER_DICT['STEP_MODE' ]=[0x16,  8] # Step mode        |      7 |   H
-    REGISTER_DICT['ALARM_EN'  ]=[0x17,  8] # Alarm enable     |     FF |   S
-    REGISTER_DICT['CONFIG'    ]=[0x18, 16] # IC configuration |   2E88 |   H
-    REGISTER_DICT['STATUS'    ]=[0x19, 16] # Status           |   XXXX |
-    REGISTER_DICT['RESERVED A']=[0x1A,  0] # RESERVED         |        |   X
-    REGISTER_DICT['RESERVED B']=[0x1B,  0] # RESERVED         |        |   X
-    # Write: X = unreadable, W = Writable (always), 
+    REGISTER_DICT = {} #        ADDR LEN Write   DESCRIPTION     | xRESET
+    REGISTER_DICT['ABS_POS'   ]=[0x01, 22, 'S'] # current pos      | 000000
+    REGISTER_DICT['EL_POS'    ]=[0x02,  9, 'S'] # Electrical pos   |    000
+    REGISTER_DICT['MARK'      ]=[0x03, 22, 'W'] # mark position    | 000000
+    REGISTER_DICT['SPEED'     ]=[0x04, 20, 'R'] # current speed    |  00000
+    REGISTER_DICT['ACC'       ]=[0x05, 12, 'W'] # accel limit      |    08A
+    REGISTER_DICT['DEC'       ]=[0x06, 12, 'W'] # decel limit      |    08A
+    REGISTER_DICT['MAX_SPEED' ]=[0x07, 10, 'W'] # maximum speed    |    041
+    REGISTER_DICT['MIN_SPEED' ]=[0x08, 13, 'S'] # minimum speed    |      0
+    REGISTER_DICT['FS_SPD'    ]=[0x15, 10, 'W'] # full-step speed  |    027
+    REGISTER_DICT['KVAL_HOLD' ]=[0x09,  8, 'W'] # holding Kval     |     29
+    REGISTER_DICT['KVAL_RUN'  ]=[0x0A,  8, 'W'] # const speed Kval |     29
+    REGISTER_DICT['KVAL_ACC'  ]=[0x0B,  8, 'W'] # accel start Kval |     29
+    REGISTER_DICT['KVAL_DEC'  ]=[0x0C,  8, 'W'] # decel start Kval |     29
+    REGISTER_DICT['INT_SPEED' ]=[0x0D, 14, 'H'] # intersect speed  |   0408
+    REGISTER_DICT['ST_SLP'    ]=[0x0E,  8, 'H'] # start slope      |     19
+    REGISTER_DICT['FN_SLP_ACC']=[0x0F,  8, 'H'] # accel end slope  |     29
+    REGISTER_DICT['FN_SLP_DEC']=[0x10,  8, 'H'] # decel end slope  |     29
+    REGISTER_DICT['K_THERM'   ]=[0x11,  4, 'H'] # therm comp factr |      0
+    REGISTER_DICT['ADC_OUT'   ]=[0x12,  5, 'R'] # ADC output       |     XX
+    REGISTER_DICT['OCD_TH'    ]=[0x13,  4, 'W'] # OCD threshold    |      8
+    REGISTER_DICT['STALL_TH'  ]=[0x14,  7, 'W'] # STALL threshold  |     40
+    REGISTER_DICT['STEP_MODE' ]=[0x16,  8, 'H'] # Step mode        |      7
+    REGISTER_DICT['ALARM_EN'  ]=[0x17,  8, 'S'] # Alarm enable     |     FF
+    REGISTER_DICT['CONFIG'    ]=[0x18, 16, 'H'] # IC configuration |   2E88
+    REGISTER_DICT['STATUS'    ]=[0x19, 16, 'R'] # Status           |   XXXX
+    REGISTER_DICT['RESERVED A']=[0x1A,  0, 'X'] # RESERVED
+    REGISTER_DICT['RESERVED B']=[0x1B,  0, 'X'] # RESERVED
+    # Write: X = unreadable, R = Read only, W = Writable (always),
     #        S = Writable (when stopped), H = Writable (when Hi-Z)
+
+    """ Register handles, compiled from REGISTER_DICT when the module loads
+            (see the bottom of this file) and also reachable as class
+            attributes, eg. L6470.ABS_POS. Each is a tuple of
+            (address, byte length, read mask, write class, cacheable). Passing a handle
+            to GetParam/SetParam skips the name lookup and length math.
+    """
+    REGISTERS = {}
+
+    """ Configuration registers only our own SetParam changes, so an L6470
+            made with cache=True keeps a copy instead of reading them back.
+            Everything else (ABS_POS, SPEED, STATUS, ...) always goes to the chip.
+    """
+    CACHED_REGISTERS = ('ACC', 'DEC', 'MAX_SPEED', 'KVAL_HOLD', 'KVAL_RUN',
+                        'KVAL_ACC', 'KVAL_DEC', 'STEP_MODE', 'CONFIG')
     
     """ Dictionary for the STATUS register. Contains all error flags,
             as well as basic motor state information.
@@ -78,15 +127,29 @@ class L6470:
 
            @returns a new instance of an L6470 object.
     """
-    def __init__(self, spi_handler):
+    def __init__(self, spi_handler, cache=False):
         """ Create a new L6470 object.
 
         @arg @c spi_handler The SPI device to use. Guaranteed to work with stmspi::SPIDevice or stmspi::DummyBus.
+        @arg @c cache       If true, keep a write-through copy of CACHED_REGISTERS and skip reading them back.
         """
         self.spi = spi_handler
-        if not hasattr(self.spi,'send_recieve'):
+        if not hasattr(self.spi,'burst'):
             print ('Invalid SPI object.')
             raise AttributeError
+        # commands are encoded straight into the SPI device's frame buffers,
+        # so issuing one doesn't allocate anything on the heap.
+        self._tx = self.spi.tx_buf
+        self._rx = self.spi.rx_buf
+        # the last STATUS value read, or None if the motor may have changed
+        # state since. Lets SetParam turn down S/H writes without asking the chip.
+        self.last_status = None
+        # shadow copies of the cached registers, indexed by address. A write
+        # stays dirty (and is read back from the chip) until a status read
+        # shows no command error since it went out.
+        self._cache = cache
+        self._shadow = [None]*0x1C
+        self._dirty = 0 # bit per register address
     
     def __del__(self):
         """ Automatically called when the instance is deleted.
@@ -94,37 +157,76 @@ class L6470:
         """
         self.HardHiZ() # stop motors ASAP, for safety
     
+    def alloc_report (self):
+        """ Prints the number of heap bytes each non-moving command allocates.
+                Anything but 0 means that command can set off the garbage
+                collector mid-slew. Use measure_alloc() for the others.
+        """
+        print ('Heap bytes allocated per command:')
+        print ('  Nop:       ', measure_alloc(self.Nop))
+        print ('  GetStatus: ', measure_alloc(self.GetStatus))
+        print ('  GetParam:  ', measure_alloc(self.GetParam, 'ABS_POS'))
+        mark = self.GetParam('MARK')
+        print ('  SetParam:  ', measure_alloc(self.SetParam, 'MARK', mark))
+
     # === L6470 FUNCTION WRAPPERS ===
     def Nop (self):
         """ No-Operation command. The driver will not react.
         """
         # ze goggles
-        self.spi.send_recieve(0,1,0)
+        self.__frame(0, 0, 0)
     
     def SetParam (self, register, value):
-        """ Writes the value <param> to the register named <register>.
+        """ Writes the value <param> to the register named <register>. Registers
+                that are only writable while stopped (S) or in Hi-Z (H) are
+                checked against the last known status first, so a write the
+                chip would refuse with NOTPERF_CMD never goes out on the bus.
 
-           @arg @c register (string): A name corresponding to an entry in REGISTER_DICT.
+           @arg @c register (handle): A handle from REGISTERS, eg. L6470.MARK, or its name as a string.
            @arg @c value (int): The new value to write to that register.
+
+           @returns @c -1 if the register can't be written in the current state.
+           @returns @c  0 if the command ran successfully.
         """
-        regdata = L6470.REGISTER_DICT[register]
-        send_len = math_ceil(regdata[1]/8)
-        self.spi.send_recieve(0b00000000 + regdata[0], 1, 0)
-        self.spi.send_recieve(value, send_len, 0)
+        if isinstance(register, str):
+            register = L6470.REGISTERS[register]
+        addr, length, mask, access, cached = register
+        if access != 'W':
+            if access == 'S':
+                # MOT_STATUS (bits 5-6) must read stopped
+                if (self.last_status is not None) and (self.last_status & 0b1100000):
+                    return -1
+            elif access == 'H':
+                # Hi-Z (bit 0) must be set
+                if (self.last_status is not None) and not (self.last_status & 1):
+                    return -1
+            else:
+                return -1 # read only
+        self.__frame(0b00000000 + addr, value & mask, length)
+        if cached and self._cache:
+            self._shadow[addr] = value & mask
+            self._dirty |= 1<<addr
+        return 0
     
     def GetParam (self, register):
         """ Reads the value of the register named <register>.
 
-            @arg @c register (string): A name corresponding to an entry in REGISTER_DICT.
+            @arg @c register (handle): A handle from REGISTERS, eg. L6470.ABS_POS, or its name as a string.
 
-            @return @c value (byte array): The contents of the selected register.
+            @return @c value (int): The contents of the selected register.
         """
-        regdata = L6470.REGISTER_DICT[register]
-        cmd = 0b00100000 + regdata[0]
-        send_len = math_ceil(regdata[1]/8)
-        recv_len = send_len
-        value = self.spi.send_recieve(cmd, send_len, recv_len)
-        return value
+        if isinstance(register, str):
+            register = L6470.REGISTERS[register]
+        addr, length, mask, access, cached = register
+        if cached and self._cache:
+            value = self._shadow[addr]
+            if (value is not None) and not (self._dirty & 1<<addr):
+                return value
+            value = self.__frame(0b00100000 + addr, 0, length) & mask
+            self._shadow[addr] = value
+            self._dirty &= ~(1<<addr)
+            return value
+        return self.__frame(0b00100000 + addr, 0, length) & mask
     
     def Run (self, speed, direction):
         """ Sets the target <speed> and <direction>. BUSY flag is low until the
@@ -141,8 +243,7 @@ class L6470:
             return -1 # invalid argument
         if speed < 0:# or speed > :
             return -1 # invalid argument
-        self.spi.send_recieve(0b01010000 + direction,1,0)
-        self.spi.send_recieve(speed,3,0)
+        self.__frame(0b01010000 + direction, speed, 3)
         return 0
     
     def StepClock (self, direction):
@@ -162,7 +263,7 @@ class L6470:
         """
         if (direction != 1) and (direction != 0):
             return -1 # unpermitted behavior
-        self.spi.send_recieve(0b01011000 + direction,1,0)
+        self.__frame(0b01011000 + direction, 0, 0)
     
     def Move (self, steps, direction):
         """ Moves a number of microsteps in a given direction. The units of
@@ -179,8 +280,7 @@ class L6470:
         """
         if (direction != 1) and (direction != 0):
             return -1 # unpermitted behavior
-        self.spi.send_recieve(0b01000000 + direction,1,0)
-        self.spi.send_recieve(steps,3,0)
+        self.__frame(0b01000000 + direction, steps, 3)
     
     def GoTo (self, position):
         """ Brings motor to the step count of <position> via the minimum path.
@@ -191,8 +291,7 @@ class L6470:
 
             @arg @c position (int): the absolute position to rotate to.
         """
-        self.spi.send_recieve(0b01100000,1,0)
-        self.spi.send_recieve(position,3,0)
+        self.__frame(0b01100000, position, 3)
     
     def GoTo_DIR (self, position, direction):
         """ Brings motor to the step count of <position>, forcing <direction>.
@@ -208,9 +307,7 @@ class L6470:
         """
         if (direction != 1) and (direction != 0):
             return -1 # unpermitted behavior
-        cmd = 0b01101000 + direction
-        self.spi.send_recieve(cmd,1,0)
-        self.spi.send_recieve(position,3,0)
+        self.__frame(0b01101000 + direction, position, 3)
     
     def GoUntil (self, speed, action, direction):
         """ Performs a motion in <direction> at <speed> until Switch is closed,
@@ -231,7 +328,7 @@ class L6470:
             return -1 # unpermitted behavior
         if (direction != 1) and (direction != 0):
             return -1 # unpermitted behavior
-        self.spi.send_recieve(0b01000010 + (action<<3) + direction,1,0)
+        self.__frame(0b01000010 + (action<<3) + direction, 0, 0)
     
     def ReleaseSW (self, action, direction):
         """ Performs a motion in <direction> at minimum speed until Switch is
@@ -251,7 +348,7 @@ class L6470:
             return -1 # unpermitted behavior
         if (direction != 1) and (direction != 0):
             return -1 # unpermitted behavior
-        self.spi.send_recieve(0b01110000 + (action<<3) + direction,1,0)
+        self.__frame(0b01110000 + (action<<3) + direction, 0, 0)
     
     def GoHome (self):
         """ Brings the motor to the HOME position (ABS_POS == 0) via the shortest
@@ -261,24 +358,28 @@ class L6470:
                 given only when the previous command is completed- if BUSY is low
                 when this command is called, the NOTPERF_CMD flag will raise.
         """
-        self.spi.send_recieve(0b01110000,1,0)
+        self.__frame(0b01110000, 0, 0)
     
     def GoMark (self):
         """ Brings the motor to the MARK position via the minimum path. Note 
                 that this command is equivalent to using GoTo with the value of
                 the MARK register. Use GoTo_DIR() if a direction is mandatory.
         """
-        self.spi.send_recieve(0b01111000,1,0)
+        self.__frame(0b01111000, 0, 0)
     
     def ResetPos (self):
         """ Resets the ABS_POS register to zero (ie, sets HOME position).
         """
-        self.spi.send_recieve(0b11011000,1,0)
+        self.__frame(0b11011000, 0, 0)
     
     def ResetDevice (self):
-        """ Resets the L6470 chip to power-up conditions.
+        """ Resets the L6470 chip to power-up conditions. Also empties the
+                register cache, since every register is back to its default.
         """
-        self.spi.send_recieve(0b11000000,1,0)
+        self.__frame(0b11000000, 0, 0)
+        for addr in range(0,len(self._shadow)):
+            self._shadow[addr] = None
+        self._dirty = 0
     
     def SoftStop (self):
         """ Stops the motor, using the value of the DEC register as the
@@ -287,28 +388,28 @@ class L6470:
                 be run any time and runs immediately- the BUSY flag will be held
                 low until the motor stops.
         """
-        self.spi.send_recieve(0b10110000,1,0)
+        self.__frame(0b10110000, 0, 0)
     
     def HardStop (self):
         """ Stops the motor immediately, with infinite deceleration. This 
                 command interacts with the Hi-Z state and the BUSY flag just
                 like SoftStop().
         """
-        self.spi.send_recieve(0b10111000,1,0)
+        self.__frame(0b10111000, 0, 0)
     
     def SoftHiZ (self):
         """ Puts bridges into Hi-Z after a deceleration phase using the value of
                 the DEC register. This command can be run at any time and is
                 immediately executed, and holds BUSY low until the motor stops.
         """
-        self.spi.send_recieve(0b10100000,1,0)
+        self.__frame(0b10100000, 0, 0)
     
     def HardHiZ (self):
         """ Puts bridges into hi-z immediately, ignoring the DEC parameter. This
                 command can be run any time and immediately executes, holding 
                 BUSY low until the motor stops.
         """
-        self.spi.send_recieve(0b10101000,1,0)
+        self.__frame(0b10101000, 0, 0)
     
     def GetStatus (self, verbose=0):
         """ Returns the value of the STATUS register, and forces the system to
@@ -319,11 +420,60 @@ class L6470:
 
             @return @c status (int): the two-byte value of the register.
         """
-        status = self.spi.send_recieve(0b11010000,1,2)
+        status = self.__frame(0b11010000, 0, 2)
+        self.note_status(status)
         if verbose:
             self.print_status(status)
         return status
     
+    # === FRAME ENCODING ===
+## @privatesection
+
+    # Writes a command byte and its <length> byte argument into the frame
+    # buffer, clocks it out, and decodes the <length> byte reply. Reads pass
+    # a value of 0, which fills the argument bytes with NOPs.
+    def __frame (self, cmd, value, length):
+        if cmd & 0b11000000:
+            # motion, stop, Hi-Z and reset commands leave the motor state unknown
+            self.last_status = None
+        tx = self._tx
+        tx[0] = cmd
+        if length == 3:
+            tx[1] = (value>>16)&0xff
+            tx[2] = (value>>8)&0xff
+            tx[3] = value&0xff
+        elif length == 2:
+            tx[1] = (value>>8)&0xff
+            tx[2] = value&0xff
+        elif length == 1:
+            tx[1] = value&0xff
+        self.spi.burst(length+1)
+        rx = self._rx
+        if length == 3:
+            return (rx[1]<<16) | (rx[2]<<8) | rx[3]
+        elif length == 2:
+            return (rx[1]<<8) | rx[2]
+        elif length == 1:
+            return rx[1]
+        return 0
+
+## @publicsection
+    def note_status (self, status):
+        """ Records a status value, whether it came from GetStatus or from a
+                read of a whole daisy chain. Cached writes made since the
+                last status are kept if no command error was flagged, and
+                dropped otherwise.
+
+            @arg @c status (int): the code returned by a GetStatus call.
+        """
+        self.last_status = status
+        if self._dirty:
+            if status & 0b110000000: # WRONG_CMD or NOTPERF_CMD
+                for addr in range(0,len(self._shadow)):
+                    if self._dirty & 1<<addr:
+                        self._shadow[addr] = None
+            self._dirty = 0
+
     def print_status (self, status):
         """ Formatted printing of status codes for the driver.
 
@@ -385,3 +535,12 @@ class L6470:
         else:
             print("  External switch is open.")
 
+# === REGISTER HANDLES ===
+# compile REGISTER_DICT into handles once, at import
+for name in L6470.REGISTER_DICT:
+    addr, bits, access = L6470.REGISTER_DICT[name]
+    if access == 'X':
+        continue # reserved, nothing to read or write
+    L6470.REGISTERS[name] = (addr, (bits+7)//8, (1<<bits)-1, access,
+                             name in L6470.CACHED_REGISTERS)
+    setattr(L6470, name, L6470.REGISTERS[name])
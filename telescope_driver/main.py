@@ -6,10 +6,29 @@ The main code to run on the STM32F411 at the heart of the IMU guide.
 @date 8 December 2016
 """
 
+# === IMPORTS ===
+import pyb
+from step_convert import StepConverter, to_signed, to_abs_pos, SPEED_MAX
+from usb_protocol import (OP_NONE, OP_INIT, OP_SLEW, OP_TURN, OP_TRACK, OP_MARK,
+                          OP_MARK_SET, OP_HOME, OP_HOME_SET, OP_STOP, OP_OFF,
+                          OP_TELEM_RATE, OP_ACK, OP_NAK, OP_DONE, OP_ERROR,
+                          NAK_AXIS, NAK_OPCODE, NAK_BUSY, NAK_STATE, CMD_FRAME_LEN,
+                          AXIS_NAMES, KIND_NONE, KIND_FRAME, StreamParser,
+                          decode_command, encode_command, parse_ascii,
+                          encode_telemetry, telemetry_len)
+
 # === CONSTANTS ===
-_LOOP_DELAY    = const(100) # [us], number of microseconds to wait between main loops
+_MOTOR_PERIOD  = const(2)  # [ms], motor task period while an axis is moving
+_MOTOR_IDLE    = const(64) # [ms], longest period an idle axis backs off to
+_USB_PERIOD    = const(1)  # [ms], USB parser period while commands come in
+_USB_IDLE      = const(8)  # [ms], longest period a quiet USB link backs off to
+_TELEM_PERIOD  = const(50) # [ms], default time between telemetry frames
+_TELEM_OFF     = const(500) # [ms], how often to check back while telemetry is off
 _ERR_FLAG_MASK = const(0b0111111000000000) # bit placement of error flags
 _ERR_CMD_MASK  = const(0b0000000110000000) # bit placement of cmd error flags
+_MOT_MASK      = const(0b0000000001100000) # bit placement of MOT_STATUS, 0 = stopped
+_DAISY_CHAIN   = const(0) # 1 = motor drivers share CS pin B0 as one daisy chain
+_ASYNCIO       = const(0) # 1 = run the motors from uasyncio (motor_async) instead of the scheduler
 
 # state aliases
 _STATE_INIT = const(0)
@@ -17,6 +36,10 @@ _STATE_IDLE = const(1)
 _STATE_BUSY = const(2)
 _STATE_ERR  = const(3)
 
+# what a typed command is told when it's refused, by NAK_ reason
+_NAK_TEXT = {NAK_AXIS: 'has no motor', NAK_OPCODE: 'does not take that command',
+             NAK_BUSY: 'is busy', NAK_STATE: 'is initializing or in error'}
+
 # === FUNCTIONS AND CLASSES ===
 # def load_config_data ():
 #    """ Loads config data from the uSD card for the motors.
@@ -27,27 +50,156 @@ _STATE_ERR  = const(3)
 class MotorTask:
     """ The task class for motor drivers.
     """
-    def __init__(self, name, driver_obj, step_degrees=1.8, teeth_driver=1, teeth_follower=1):
+    def __init__(self, name, driver_obj, step_degrees=1.8, teeth_driver=1, teeth_follower=1,
+                 busy_pin=None, flag_pin=None):
         """ Creates a new MotorTask. Sets initial states and creates task variables.
 
         @arg @c driver_obj     The L6470 instance to control.
-        @arg @c step_degrees   The number of steps per degree for the motor.
+        @arg @c step_degrees   The size of one full step of the motor, in degrees.
         @arg @c teeth_driver   The number of teeth on the attached gear.
         @arg @c teeth_follower The number of teeth on the driven gear.
+        @arg @c busy_pin       The pin wired to the driver's BUSY output, or None.
+        @arg @c flag_pin       The pin wired to the driver's FLAG output, or None.
+                               With both pins given, the status is only read over
+                               SPI after one of them changes.
         """
         self._name = name
         self._driver = driver_obj
-        self._STPD = step_degrees
-        self._N_W = teeth_driver
-        self._N_F = teeth_follower
+        self._conv = StepConverter(step_degrees, teeth_driver, teeth_follower)
         self._driver.ResetDevice()
         self._driver.GetStatus() # throw the first check away
         self._state = _STATE_INIT
         self._err = 0
+        self._pin_event = True # read the status at least once
+        self._cmd_id = 0 # id of the command being carried out
+        self._tracking = False # True while turning at a set speed (OP_TRACK)
+        self._stopping = OP_NONE # the stop being waited out (OP_STOP, OP_OFF or OP_HOME_SET)
+        self._cut_id = 0 # id of the command a stop cut short, finished with the stop
+        # called as on_event(op, cmd_id, arg) when a command finishes
+        # (OP_DONE) or the driver reports an error (OP_ERROR)
+        self.on_event = None
+        self._irqs = None
+        if busy_pin is not None and flag_pin is not None:
+            # both outputs are open drain, active low
+            self._irqs = (pyb.ExtInt(busy_pin, pyb.ExtInt.IRQ_RISING_FALLING,
+                                     pyb.Pin.PULL_UP, self.__on_pin),
+                          pyb.ExtInt(flag_pin, pyb.ExtInt.IRQ_RISING_FALLING,
+                                     pyb.Pin.PULL_UP, self.__on_pin))
+
+    # interrupt handler for the BUSY and FLAG pins. Must not allocate.
+    def __on_pin (self, line):
+        self._pin_event = True
     
+    # reports the end of the current command, and forgets its id
+    def __event (self, op, arg=0):
+        if self.on_event is not None:
+            if op == OP_DONE:
+                self._conv.set_step_mode(self._driver.GetParam(self._driver.STEP_MODE))
+                arg = self._conv.steps_to_arcsec(to_signed(self._driver.GetParam(self._driver.ABS_POS)))
+            self.on_event(op, self._cmd_id, arg)
+        self._cmd_id = 0
+
+    # turns at a signed speed, in SPEED register units. Run takes effect at
+    # any time, so a motor that is already tracking isn't stopped first.
+    def __track (self, speed):
+        if not self._tracking:
+            self._driver.SoftStop()
+            pyb.udelay(10)
+            self._tracking = True
+        if speed < 0:
+            self._driver.Run(min(-speed, SPEED_MAX), 0)
+        else:
+            self._driver.Run(min(speed, SPEED_MAX), 1)
+        self._state = _STATE_BUSY
+
+    # OP_STOP (with holding torque) or OP_OFF (Hi-Z), whatever the motor is
+    # doing. A command that gets cut short finishes where it stopped.
+    def __halt (self, cmd_code, cmd_id):
+        if self._state == _STATE_BUSY and self._cmd_id:
+            if self._stopping == OP_HOME_SET:
+                # HOME wasn't written yet, so it didn't happen
+                self.__event(OP_ERROR, self._driver.GetParam(self._driver.STATUS))
+            else:
+                if self._cut_id:
+                    self.cancel(self._cut_id) # a stop cut short by another stop
+                self._cut_id = self._cmd_id
+        self._cmd_id = cmd_id
+        self.__stop(cmd_code)
+
+    # starts bringing the motor to rest. The motor decelerates for a while
+    # after the command, so the axis stays busy and run_task finishes
+    # cmd_code once BUSY and MOT_STATUS show it has stopped.
+    def __stop (self, cmd_code):
+        self._tracking = False
+        if cmd_code == OP_OFF:
+            self._driver.SoftHiZ()
+        else:
+            self._driver.SoftStop()
+        self._stopping = cmd_code
+        self._state = _STATE_BUSY
+        self._err = 2
+        self._pin_event = True # BUSY may not change if the motor was already at rest
+
+    # writes one register and finishes the command, with OP_ERROR and the
+    # status if the driver didn't take it
+    def __set_and_finish (self, reg, value):
+        if self.set_param(reg, value):
+            self.__event(OP_ERROR, self._driver.GetParam(self._driver.STATUS))
+        else:
+            self.__event(OP_DONE)
+
+    def cancel (self, cmd_id):
+        """ Reports a command that was accepted but replaced before it
+        started, eg. by an OP_STOP. It finishes with OP_DONE where the axis is now.
+
+        @arg @c cmd_id The host's id for the replaced command.
+        """
+        current = self._cmd_id
+        self._cmd_id = cmd_id
+        self.__event(OP_DONE)
+        self._cmd_id = current
+
+    def check_command (self, cmd_code):
+        """ Says whether a command would be carried out if it were given to
+        run_task now.
+
+        @arg @c cmd_code One of the usb_protocol opcodes.
+
+        @return @c reason @c 0 if it would, else one of the usb_protocol NAK_ reasons.
+        """
+        if cmd_code == OP_NONE or self._state == _STATE_IDLE:
+            return 0
+        if (cmd_code == OP_STOP or cmd_code == OP_OFF) and self._state != _STATE_INIT:
+            return 0 # always, so a move or a faulted axis can be brought to rest
+        if cmd_code == OP_TRACK and self._tracking and self._state == _STATE_BUSY:
+            return 0 # speed changes are taken while still accelerating
+        if self._state == _STATE_BUSY:
+            return NAK_BUSY
+        return NAK_STATE
+
+    def is_idle (self):
+        """ @return @c idle True if the motor is waiting for a command.
+        """
+        return self._state == _STATE_IDLE
+
+    def read_telemetry (self, sample):
+        """ Reads the position, speed and status of the motor for a telemetry
+        frame. The STATUS register is read with GetParam, so unlike
+        GetStatus it leaves the error flags for run_task to see.
+
+        @arg @c sample A list of 4 to fill in place with the signed ABS_POS,
+                       the raw SPEED, the STATUS and the MotorTask state.
+        """
+        driver = self._driver
+        sample[0] = to_signed(driver.GetParam(driver.ABS_POS))
+        sample[1] = driver.GetParam(driver.SPEED)
+        sample[2] = driver.GetParam(driver.STATUS)
+        sample[3] = self._state
+
     def shut_off (self):
         """ Shut down the motor and wait for commands.
         """
+        self._tracking = False
         self._driver.SoftHiZ()
         self._state = _STATE_IDLE
         self._err = 0
@@ -56,19 +208,54 @@ class MotorTask:
         """ Wrapper for the L6470.SetParam function for the L6470 instance
         being controlled by this MotorTask.
 
-        @arg @c param_str The name of the register to set.
+        @arg @c param_str The register to set, as a handle (eg. L6470.ACC) or its name.
         @arg @c value     The new value for the register.
+
+        @return @c failed A list with the register if it could not be set, else empty.
         """
-        self._driver.GetStatus() # clear previous errors
-        self._driver.SetParam(param_str, value)
-        stat = self._driver.GetStatus()
+        return self.apply_params({param_str: value})
+
+    def apply_params (self, params):
+        """ Writes a whole configuration profile, eg. a dict meant for
+        L6470_configure.set_config. The status flags are only checked once,
+        after every register is written. If they show an error, the registers
+        are read back and only the ones that differ are written again.
+
+        @arg @c params A dict of register handles (or names) to values.
+
+        @return @c failed A list of the registers that could not be set.
+        """
+        driver = self._driver
+        driver.GetStatus() # clear previous errors
+        retry = []
+        for reg in params:
+            if driver.SetParam(reg, params[reg]):
+                retry.append(reg) # refused, the chip wasn't in the right state
+        stat = driver.GetStatus()
         if (stat & _ERR_CMD_MASK) or ((stat & _ERR_FLAG_MASK) != _ERR_FLAG_MASK):
-            self._driver.GetStatus() # try once more
-            self._driver.SetParam(param_str, value)
-            stat = self._driver.GetStatus()
-            if (stat & _ERR_CMD_MASK) or ((stat & _ERR_FLAG_MASK) != _ERR_FLAG_MASK):
-                print('Error setting parameter for',self._name,'driver!')
-                print(self._driver.print_status(stat))
+            retry = self.__differing(params)
+        if not retry:
+            return retry
+
+        # try once more, with only the registers that didn't take
+        for reg in retry:
+            driver.SetParam(reg, params[reg])
+        stat = driver.GetStatus()
+        failed = self.__differing(params, retry)
+        if failed or (stat & _ERR_CMD_MASK) or ((stat & _ERR_FLAG_MASK) != _ERR_FLAG_MASK):
+            print('Error setting parameters for',self._name,'driver!')
+            driver.print_status(stat)
+        return failed
+
+    # reads back registers and returns the ones that don't hold the value in params
+    def __differing (self, params, regs=None):
+        driver = self._driver
+        differing = []
+        for reg in (regs or params):
+            mask = (driver.REGISTERS[reg] if isinstance(reg, str) else reg)[2]
+            if driver.GetParam(reg) != params[reg] & mask:
+                differing.append(reg)
+        return differing
 
     def get_angle (self):
         """ Uses the motor's gear ratio and the step mode to calculate
@@ -76,30 +263,52 @@ class MotorTask:
 
         @return @c angle The angle of the output shaft, in degrees.
         """
-        step_count = self._driver.GetParam('ABS_POS')
-        step_mode  = 2.0**(self._driver.GetParam('STEP_MODE') & 7)
-        return (1.0*self._N_D/self._N_F) * step_count * self._STPD / step_mode
+        self._conv.set_step_mode(self._driver.GetParam(self._driver.STEP_MODE))
+        return self._conv.steps_to_deg(to_signed(self._driver.GetParam(self._driver.ABS_POS)))
 
-    def run_task (self, cmd_code='init'):
+    def run_task (self, cmd_code=OP_INIT, stat=None, arg=0, cmd_id=0):
         """ The state machine for the MotorTask.
         Run this once per loop and update the argument from there.
 
-        The command code can be one of the following:
-        @li @c init          (re-)initialize this MotorTask.
-        @li @c slew @c #     Go to a position, in absolute degrees.
-        @li @c turn @c #     Go to a position, in relative degrees.
-        @li @c track         Turn at a constant rate.
-        @li @c mark @c [set] Go to the MARK position [set the current position as MARK].
-        @li @c home @c [set] Go to the HOME position [set the current position as HOME].
-        @li @c stop          Stop the motor, with a holding torque.
-        @li @c off           Set the motor driver to Hi-Z (coast) mode.
+        The command code is one of the usb_protocol opcodes, or the
+        equivalent typed command:
+        @li @c OP_INIT     @c init          (re-)initialize this MotorTask.
+        @li @c OP_SLEW     @c slew @c #     Go to a position, in absolute degrees.
+        @li @c OP_TURN     @c turn @c #     Go to a position, in relative degrees.
+        @li @c OP_TRACK    @c track @c [#]  Turn at a signed speed, in SPEED register units.
+        @li @c OP_MARK     @c mark @c [set] Go to the MARK position [set the current position as MARK].
+        @li @c OP_HOME     @c home @c [set] Go to the HOME position [set the current position as HOME].
+        @li @c OP_STOP     @c stop          Stop the motor, with a holding torque.
+        @li @c OP_OFF      @c off           Set the motor driver to Hi-Z (coast) mode.
 
-        @arg @c cmd_code A string that represents the requested instruction.
+        @arg @c cmd_code An opcode, or a string that represents the requested instruction.
+        @arg @c stat     The driver status, if it was already read (eg. for a
+                         whole daisy chain at once). Read here if @c None.
+        @arg @c arg      The fixed-point argument that goes with an opcode.
+                         Angles are in arcseconds.
+        @arg @c cmd_id   The id the host gave the command, passed back to
+                         on_event when it finishes.
 
         @return @c error The error code. @c 0 if no error.
         """
-        if self._state == _STATE_INIT:
+        if isinstance(cmd_code, str):
+            try:
+                cmd_code, arg = parse_ascii(cmd_code)
+            except ValueError:
+                print('invalid angle given to',self._name,':',cmd_code)
+                cmd_code = OP_NONE
+
+        if stat is None:
+            if (self._irqs is not None) and (cmd_code == OP_NONE) and not self._pin_event \
+                    and (self._state == _STATE_IDLE or self._state == _STATE_BUSY):
+                # BUSY and FLAG haven't moved, so neither has the status
+                return self._err
+            self._pin_event = False # cleared first, so an edge during the read isn't lost
             stat = self._driver.GetStatus()
+        else:
+            self._driver.note_status(stat)
+
+        if self._state == _STATE_INIT:
             if stat == 0 or stat == 65535:
                 print('Cannot connect to',self._name,'- Is motor power on?')
                 return
@@ -111,92 +320,111 @@ class MotorTask:
                 print(self._name,'init finished successfully:',stat)
                 self._driver.SoftHiZ()
                 self._state = _STATE_IDLE
+                self.__event(OP_DONE)
         
         # --state: waiting for command--
         elif self._state == _STATE_IDLE:
+            if cmd_code != OP_NONE:
+                self._cmd_id = cmd_id
             # check the cmd_code to see what to do
-            
-            stat = self._driver.GetStatus()
             if (stat & _ERR_CMD_MASK) or ((stat & _ERR_FLAG_MASK) != _ERR_FLAG_MASK):
                 self._state = _STATE_ERR
                 print('Error in',self._name,'driver:','{0:016b}'.format(stat))
                 self._driver.print_status(stat)
                 self._err = stat
+                self.__event(OP_ERROR, stat)
+            elif cmd_code == OP_NONE:
+                pass
+            elif cmd_code == OP_TRACK:
+                self.__track(arg)
             # go-to-angle commands
-            elif cmd_code.startswith('slew'): # absolute angle
-                try:
-                    angle = float(cmd_code.replace('slew',''))
-                    step_reg = self._driver.GetParam('STEP_MODE')
-                    step_mode = 2**(step_reg & 7) # mask the upper bits
-                    step_value = int( angle * step_mode * (1.0*_N_F / _N_D) / (_STPD/10.0) )
-                except ValueError:
-                    print('invalid angle given to',self._name,':',cmd_code.replace('slew',''))
-                else:
-                    self._driver.SoftStop()
-                    pyb.udelay(10)
-                    self._driver.GoTo(step_value)
-                    #print('going to',angle,'(',step_value,'sc)')
-                    self._state = _STATE_BUSY
+            elif cmd_code == OP_SLEW: # absolute angle
+                self._tracking = False
+                self._conv.set_step_mode(self._driver.GetParam(self._driver.STEP_MODE))
+                step_value = to_abs_pos(self._conv.arcsec_to_steps(arg))
+                self._driver.SoftStop()
+                pyb.udelay(10)
+                self._driver.GoTo(step_value)
+                #print('going to',arg,'(',step_value,'sc)')
+                self._state = _STATE_BUSY
             
-            elif cmd_code.startswith('turn'): # relative angle
-                try:
-                    angle     = float(cmd_code.replace('turn',''))
-                    step_reg  = self._driver.GetParam('STEP_MODE')
-                    step_mode = 2**(step_reg & 7)
-                    del_steps = angle * step_mode * (1.0*_N_F / _N_D) / ( _STPD/10.0)
-                    cur_steps = self._driver.GetParam('ABS_POS')
-                except ValueError:
-                    print('invalid angle given to',self._name,':',cmd_code.replace('turn',''))
-                else:
-                    self._driver.SoftStop()
-                    pyb.udelay(10)
-                    self._driver.GoTo( int(cur_steps + del_steps) )
-                    self._state = _STATE_BUSY
-                    
-            # constant speed command
-            elif cmd_code == 'track':
-                #print('tracking')
+            elif cmd_code == OP_TURN: # relative angle
+                self._tracking = False
+                self._conv.set_step_mode(self._driver.GetParam(self._driver.STEP_MODE))
+                del_steps = self._conv.arcsec_to_steps(arg)
+                cur_steps = to_signed(self._driver.GetParam(self._driver.ABS_POS))
                 self._driver.SoftStop()
                 pyb.udelay(10)
-                self._driver.Run(1000,1)
+                self._driver.GoTo( to_abs_pos(cur_steps + del_steps) )
                 self._state = _STATE_BUSY
+                    
             # MARK position commands
-            elif cmd_code.startswith('mark'):
-                if 'set' in cmd_code:
-                    self.set_param('MARK',self._driver.GetParam('ABS_POS'))
-                else:
-                    self._driver.GoMark()
-                    self.state = _STATE_BUSY
+            elif cmd_code == OP_MARK_SET:
+                self.__set_and_finish(self._driver.MARK,self._driver.GetParam(self._driver.ABS_POS))
+            elif cmd_code == OP_MARK:
+                self._tracking = False
+                self._driver.GoMark()
+                self._state = _STATE_BUSY
             # HOME position commands
-            elif cmd_code.startswith('home'):
-                if 'set' in cmd_code:
-                    self._driver.SoftStop()
-                    pyb.udelay(10)
-                    self.set_param('ABS_POS',0)
-                else:
-                    self._driver.GoHome()
-                    self.state = _STATE_BUSY
-            # motor halt command
-            elif cmd_code == 'stop':
-                self._driver.SoftStop()
-            # low-power-draw mode command
-            elif cmd_code == 'off':
-                self._driver.SoftHiZ()
+            elif cmd_code == OP_HOME_SET:
+                # ABS_POS can only be written with the motor at rest, so the
+                # write waits for the stop, see the busy state
+                self.__stop(OP_HOME_SET)
+            elif cmd_code == OP_HOME:
+                self._tracking = False
+                self._driver.GoHome()
+                self._state = _STATE_BUSY
+            # motor halt and low-power-draw mode commands
+            elif cmd_code == OP_STOP or cmd_code == OP_OFF:
+                self.__halt(cmd_code, cmd_id)
+            # start over
+            elif cmd_code == OP_INIT:
+                self._tracking = False
+                self._state = _STATE_INIT
 
         # --state: error has ocurred--
         elif self._state == _STATE_ERR:
-            stat = self._driver.GetStatus()
-            if (not (stat & _ERR_CMD_MASK)) and ((stat & _ERR_FLAG_MASK) == _ERR_FLAG_MASK):
+            if cmd_code == OP_STOP or cmd_code == OP_OFF:
+                self.__halt(cmd_code, cmd_id)
+            elif (not (stat & _ERR_CMD_MASK)) and ((stat & _ERR_FLAG_MASK) == _ERR_FLAG_MASK):
                 self._state = _STATE_IDLE
                 self._err = 0
 
         # --state: executing command--
         elif self._state == _STATE_BUSY:
             self._err = 2 # just notify that we're busy
-            stat = self._driver.GetStatus()
+            if cmd_code == OP_STOP or cmd_code == OP_OFF:
+                self.__halt(cmd_code, cmd_id)
+                return self._err
+            if cmd_code == OP_TRACK and self._tracking:
+                # a new speed before the last one was reached. The old
+                # command is superseded, so it finishes here.
+                self.__event(OP_DONE)
+                self._cmd_id = cmd_id
+                self.__track(arg)
+                return self._err # stat is from before the new speed
             if stat & 1<<1: # BUSY flag is bit 1
-                self._state = _STATE_IDLE # change state to accepting new commands
-                self._err = 0 # not busy any longer
+                if self._stopping != OP_NONE and (stat & _MOT_MASK):
+                    self._pin_event = True # still slowing down, check again next time
+                    return self._err
+                stopping = self._stopping
+                self._stopping = OP_NONE
+                if self._cut_id:
+                    self.cancel(self._cut_id) # the move the stop cut short
+                    self._cut_id = 0
+                if (stat & _ERR_CMD_MASK) or ((stat & _ERR_FLAG_MASK) != _ERR_FLAG_MASK):
+                    # the move ended in a fault, eg. a stall
+                    self._state = _STATE_ERR
+                    print('Error in',self._name,'driver:','{0:016b}'.format(stat))
+                    self._err = stat
+                    self.__event(OP_ERROR, stat)
+                else:
+                    self._state = _STATE_IDLE # change state to accepting new commands
+                    self._err = 0 # not busy any longer
+                    if stopping == OP_HOME_SET:
+                        self.__set_and_finish(self._driver.ABS_POS,0)
+                    else:
+                        self.__event(OP_DONE)
 
         # --state: unknown--
         else:
@@ -214,24 +442,32 @@ def main ():
     Handles importing modules and initializing global vars.
     """
     # modules we'll be using.
-    from pyb import USB_VCP, Pin, delay, udelay
+    from pyb import USB_VCP, Pin, delay
     import stmspi
-    from L6470_driver import L6470
+    from scheduler import Scheduler
+    from L6470_driver import L6470, get_status_all
+    from L6470_configure import MOUNT_PROFILE
     
     print('** PyScope booting...')
     delay(1000)
     print('** Initializing motors...')
     
-    # create the motor driver objects.
-    task_altitude = MotorTask('altitude',L6470(stmspi.SPIDevice(2,Pin.cpu.B0 )))
-    task_azimuth  = MotorTask('azimuth', L6470(stmspi.SPIDevice(2,Pin.cpu.B1 )))
-    #task_focuser  = MotorTask('focuser', L6470(stmspi.SPIDevice(1,Pin.cpu.A15)))
+    # create the motor driver objects. To poll the status only when it
+    # changes, wire each driver's BUSY and FLAG outputs to free pins and pass
+    # them in, eg. MotorTask('altitude', ..., busy_pin=Pin.cpu.C0, flag_pin=Pin.cpu.C1)
+    if _DAISY_CHAIN:
+        chain = stmspi.DaisyChain(2,Pin.cpu.B0,2) # 3 with the focuser
+        task_altitude = MotorTask('altitude',L6470(chain.device(0),cache=True))
+        task_azimuth  = MotorTask('azimuth', L6470(chain.device(1),cache=True))
+        #task_focuser  = MotorTask('focuser', L6470(chain.device(2),cache=True))
+    else:
+        task_altitude = MotorTask('altitude',L6470(stmspi.SPIDevice(2,Pin.cpu.B0 ),cache=True))
+        task_azimuth  = MotorTask('azimuth', L6470(stmspi.SPIDevice(2,Pin.cpu.B1 ),cache=True))
+        #task_focuser  = MotorTask('focuser', L6470(stmspi.SPIDevice(1,Pin.cpu.A15),cache=True))
     
     print('** Setting motor parameters...')
-    task_altitude.set_param('STEP_MODE',5) # sets the step mode to 1/32 uStep
-    task_altitude.set_param('MAX_SPEED',0x20) # set the max speed to 1/2 of the default
-    task_azimuth.set_param ('STEP_MODE',5)
-    task_azimuth.set_param('MAX_SPEED',0x20)
+    task_altitude.apply_params(MOUNT_PROFILE)
+    task_azimuth.apply_params(MOUNT_PROFILE)
     
     # load configuration data from the uSD card.
 #    load_config_data();
@@ -240,49 +476,196 @@ def main ():
     usb = USB_VCP()
     if not usb.isconnected():
         print('usb not connected?!')
-    usb_buf = bytearray('>') # incoming text buffer
+    usb_in = StreamParser(256) # incoming commands, text or binary
     
-    # init the command code vars
-    cmd_alt = 'init'
-    cmd_azi = 'init'
-    cmd_foc = 'init'
+    # init the command vars, one slot per axis
+    cmds = [OP_INIT, OP_INIT, OP_INIT]
+    args = [0, 0, 0]
+    ids  = [0, 0, 0] # the host's id for each command, for its ACK and DONE
+
+    # telemetry, with the frame and samples allocated once
+    motors = [task_altitude, task_azimuth] # add task_focuser with the focuser
+    samples = [[0, 0, 0, 0] for motor in motors]
+    telem_buf = bytearray(telemetry_len(len(motors)))
+    telem = [0, _TELEM_PERIOD] # sequence number, period in ms (0 = off)
     print('** Ready for commands.')
 
-    try:
-        while (True):
-            # call tasks based on the commands
-            status_alt = task_altitude.run_task(cmd_alt)
-            status_azi = task_azimuth.run_task(cmd_azi)
-            #status_task_focuser.run_task(cmd_foc)
-
-            # reset the commands to avoid duplicates
-            cmd_alt = 'wait'
-            cmd_azi = 'wait'
-            cmd_foc = 'wait'
-            
-            # check for USB data and set new commands
-            if usb.any():
-                char = usb.read(1) # read and parse 1 byte at a time
-                if char == b'\b':
-                    usb_buf.pop() # delete last character
-                elif char == b'\r':
-                    # parse command
-                    cmd = (''.join(map(chr,usb_buf)))[1:]
-                    if cmd.startswith('alt:'):
-                        cmd_alt = cmd[4:]
-                    elif cmd.startswith('azi:'):
-                        cmd_azi = cmd[4:]
-                    elif cmd.startswith('foc:'):
-                        cmd_foc = cmd[4:]
+    # === TASKS ===
+    # each returns True while it has work, so the scheduler knows to keep it
+    # at its base rate. Idle ones back off.
+    sched = Scheduler()
+
+    def run_altitude ():
+        task_altitude.run_task(cmds[0], None, args[0], ids[0])
+        cmds[0] = OP_NONE # reset the command to avoid duplicates
+        return not task_altitude.is_idle()
+
+    def run_azimuth ():
+        task_azimuth.run_task(cmds[1], None, args[1], ids[1])
+        cmds[1] = OP_NONE
+        return not task_azimuth.is_idle()
+
+    #def run_focuser ():
+    #    task_focuser.run_task(cmds[2], None, args[2], ids[2])
+    #    cmds[2] = OP_NONE
+    #    return not task_focuser.is_idle()
+
+    def run_chain ():
+        # one frame reads the status of every driver on the chain
+        stats = get_status_all(chain)
+        task_altitude.run_task(cmds[0], stats[0], args[0], ids[0])
+        task_azimuth.run_task(cmds[1], stats[1], args[1], ids[1])
+        #task_focuser.run_task(cmds[2], stats[2], args[2], ids[2])
+        cmds[0] = cmds[1] = cmds[2] = OP_NONE
+        return not (task_altitude.is_idle() and task_azimuth.is_idle())
+
+    def send_telemetry ():
+        if not telem[1] or not usb.isconnected():
+            return False
+        for i in range(len(motors)):
+            motors[i].read_telemetry(samples[i])
+        usb.send(encode_telemetry(telem[0], samples, telem_buf), timeout=10)
+        telem[0] = (telem[0] + 1) & 0xFFFF
+        return True
+
+    def set_telemetry_rate (period):
+        telem[1] = max(period, 0)
+        if not _ASYNCIO:
+            sched.set_period(telem_task, telem[1] or _TELEM_OFF)
+
+    # replies and events share one buffer. They are sent from the same loop,
+    # so one is always out before the next is built.
+    event_buf = bytearray(CMD_FRAME_LEN)
+
+    def send_event (op, axis, cmd_id, arg=0):
+        if usb.isconnected():
+            usb.send(encode_command(op, axis, arg, cmd_id, event_buf), timeout=10)
+
+    def event_sender (axis):
+        def on_event (op, cmd_id, arg):
+            send_event(op, axis, cmd_id, arg)
+        return on_event
+
+    for i in range(len(motors)):
+        motors[i].on_event = event_sender(i)
+
+    # hands a command to an axis. Returns 0, or the NAK_ reason it was refused
+    def post_command (axis, op, arg, cmd_id=0):
+        if op == OP_TELEM_RATE:
+            set_telemetry_rate(arg)
+            return 0
+        if axis >= len(motors):
+            return NAK_AXIS
+        if op > OP_OFF:
+            return NAK_OPCODE
+        reason = motors[axis].check_command(op)
+        if reason:
+            return reason
+        # a stop replaces a command that hasn't been picked up yet, anything
+        # else has to wait for it
+        halt = op == OP_STOP or op == OP_OFF
+        if _ASYNCIO:
+            if axes[axis].pending() and not halt:
+                return NAK_BUSY
+            replaced = axes[axis].send(op, arg, cmd_id)
+            if replaced:
+                motors[axis].cancel(replaced)
+            return 0
+        if cmds[axis] != OP_NONE:
+            if not halt:
+                return NAK_BUSY
+            if ids[axis]:
+                motors[axis].cancel(ids[axis])
+        cmds[axis] = op
+        args[axis] = arg
+        ids[axis] = cmd_id
+        if motor_tasks[axis] is not None:
+            sched.wake(motor_tasks[axis]) # don't wait out an idle back-off
+        return 0
+
+    def run_usb ():
+        # drain everything waiting on USB, then act on every complete
+        # command, so back to back commands land in the same tick
+        if not usb.any():
+            return False
+        usb_in.ring.fill(usb)
+        kind = usb_in.poll()
+        while kind != KIND_NONE:
+            if kind == KIND_FRAME:
+                command = decode_command(usb_in.frame)
+                if command is None:
+                    print('Dropped a corrupt command frame')
+                else:
+                    op, axis, cmd_id, arg = command
+                    reason = post_command(axis, op, arg, cmd_id)
+                    if reason:
+                        send_event(OP_NAK, axis, cmd_id, reason)
                     else:
-                        print('Specify a target for the command: "alt:","azi:",or "foc:"')
-                    # echo as an ACK and clear the buffer
-                    usb_buf.extend(b'\r\n')
-                    usb.send(usb_buf)
-                    usb_buf = bytearray(b'>')
+                        send_event(OP_ACK, axis, cmd_id)
+            else:
+                # parse command
+                cmd = bytes(usb_in.line[0:usb_in.line_len]).decode()
+                if cmd[0:3] in AXIS_NAMES and cmd[3:4] == ':':
+                    try:
+                        op, arg = parse_ascii(cmd[4:])
+                        reason = post_command(AXIS_NAMES.index(cmd[0:3]), op, arg)
+                        if reason:
+                            print(cmd[0:3],_NAK_TEXT[reason]+', command ignored')
+                    except ValueError:
+                        print('invalid angle given to',cmd[0:3],':',cmd[4:])
                 else:
-                    usb_buf.extend(char)
-            udelay(_LOOP_DELAY)
+                    print('Specify a target for the command: "alt:","azi:",or "foc:"')
+                # echo typed commands back, binary ones get a real ACK
+                usb.send('>' + cmd + '\r\n')
+            kind = usb_in.poll()
+        return True
+
+    if _ASYNCIO:
+        # the motors are driven by one poller coroutine, and USB commands go
+        # to the AsyncAxis wrappers, so other coroutines can await moves
+        import uasyncio as asyncio
+        from motor_async import AsyncAxis, AxisPoller
+        axes = [AsyncAxis(task_altitude), AsyncAxis(task_azimuth)]
+        for axis in axes:
+            axis.send(OP_INIT)
+        poller = AxisPoller(axes, chain if _DAISY_CHAIN else None, _MOTOR_PERIOD)
+
+        async def usb_loop ():
+            while True:
+                run_usb()
+                await asyncio.sleep_ms(_USB_PERIOD)
+
+        async def telemetry_loop ():
+            while True:
+                send_telemetry()
+                await asyncio.sleep_ms(telem[1] or _TELEM_OFF)
+
+        async def run_all ():
+            asyncio.create_task(poller.run())
+            asyncio.create_task(telemetry_loop())
+            await usb_loop()
+
+        try:
+            asyncio.run(run_all())
+        except KeyboardInterrupt:
+            task_altitude.shut_off()
+            task_azimuth.shut_off()
+            #task_focuser.shut_off()
+        return
+
+    sched.add('usb', run_usb, _USB_PERIOD, 2, _USB_IDLE)
+    telem_task = sched.add('telemetry', send_telemetry, _TELEM_PERIOD, 0)
+    if _DAISY_CHAIN:
+        chain_task = sched.add('motors', run_chain, _MOTOR_PERIOD, 1, _MOTOR_IDLE)
+        motor_tasks = [chain_task, chain_task, None]
+    else:
+        motor_tasks = [sched.add('altitude', run_altitude, _MOTOR_PERIOD, 1, _MOTOR_IDLE),
+                       sched.add('azimuth',  run_azimuth,  _MOTOR_PERIOD, 1, _MOTOR_IDLE),
+                       None]
+        #motor_tasks[2] = sched.add('focuser', run_focuser, _MOTOR_PERIOD, 0, _MOTOR_IDLE)
+
+    try:
+        sched.run()
     except KeyboardInterrupt:
         task_altitude.shut_off()
         task_azimuth.shut_off()
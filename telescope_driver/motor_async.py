@@ -0,0 +1,171 @@
+""" @file motor_async.py
+This module puts a uasyncio front end on MotorTask, so a move can be awaited
+instead of polled, eg. @c err @c = @c await @c axis.slew(10). A single
+AxisPoller coroutine reads the status of every axis and runs their state
+machines, so any number of coroutines can wait on moves without adding SPI
+traffic.
+
+    @authors Anthony Lombardi
+    @authors John Barry
+    @date 8 December 2016
+"""
+import uasyncio as asyncio
+from L6470_driver import get_status_all
+from usb_protocol import (OP_NONE, OP_SLEW, OP_TURN, OP_TRACK, OP_HOME, OP_MARK,
+                          OP_STOP, OP_OFF, deg_to_arg)
+
+_POLL_MS = const(2) # [ms], time between status polls
+_BUSY    = const(2) # MotorTask.run_task's code for a move in progress
+
+class AsyncAxis:
+    """ @details Wraps one MotorTask. Commands are posted here and picked up
+            by the AxisPoller on its next pass, and the awaitable methods
+            return once the axis is idle again.
+    """
+    def __init__(self, task):
+        """ Create the wrapper. The MotorTask should no longer be run by
+        anything else.
+
+        @arg @c task The MotorTask to drive.
+        """
+        self.task = task
+        self._cmd = OP_NONE
+        self._arg = 0
+        self._id = 0
+        self._err = 0
+        self._done = asyncio.Event()
+
+    def send (self, cmd_code, arg=0, cmd_id=0):
+        """ Posts a command without waiting for it. A command that hasn't
+        been picked up yet is replaced.
+
+        @arg @c cmd_code One of the usb_protocol opcodes.
+        @arg @c arg      The fixed-point argument. Angles are in arcseconds.
+        @arg @c cmd_id   The host's id for the command, if it came over USB.
+
+        @return @c replaced The host's id for the command this replaced, or 0.
+        """
+        replaced = self._id if self._cmd != OP_NONE else 0
+        self._cmd = cmd_code
+        self._arg = arg
+        self._id = cmd_id
+        self._done.clear()
+        return replaced
+
+    def pending (self):
+        """ @return @c pending True if a command is waiting to be picked up.
+        """
+        return self._cmd != OP_NONE
+
+    async def wait_idle (self):
+        """ Waits until the axis has taken the last posted command and
+        finished moving.
+
+        @return @c error @c 0 if the move finished, else the driver status
+                         that put the axis in error.
+        """
+        await self._done.wait()
+        return self._err
+
+    async def command (self, cmd_code, arg=0):
+        """ Posts a command and waits for it to finish.
+
+        @return @c error See wait_idle().
+        """
+        self.send(cmd_code, arg)
+        return await self.wait_idle()
+
+    async def slew (self, degrees):
+        """ Goes to an absolute angle, in degrees. """
+        return await self.command(OP_SLEW, deg_to_arg(degrees))
+
+    async def turn (self, degrees):
+        """ Turns by a relative angle, in degrees. """
+        return await self.command(OP_TURN, deg_to_arg(degrees))
+
+    async def home (self):
+        """ Goes to the HOME position. """
+        return await self.command(OP_HOME)
+
+    async def mark (self):
+        """ Goes to the MARK position. """
+        return await self.command(OP_MARK)
+
+    async def track (self, speed):
+        """ Turns at a signed speed, in SPEED register units. Returns once
+        the speed is reached, and can be called again to change it.
+        """
+        return await self.command(OP_TRACK, speed)
+
+    async def stop (self):
+        """ Stops the motor, with a holding torque. """
+        return await self.command(OP_STOP)
+
+    async def off (self):
+        """ Puts the driver in Hi-Z (coast) mode. """
+        return await self.command(OP_OFF)
+
+    def step (self, stat=None):
+        """ Runs the MotorTask once with the pending command. Called by the
+        AxisPoller, not by users.
+
+        @arg @c stat The driver status, if it was already read.
+        """
+        cmd = self._cmd
+        self._cmd = OP_NONE
+        err = self.task.run_task(cmd, stat, self._arg, self._id)
+        if cmd != OP_NONE or self._cmd != OP_NONE:
+            return # let the command show up in the status first
+        if err == _BUSY:
+            return
+        if err:
+            self._err = err # the axis is in error, wake the waiters with it
+            self._done.set()
+        elif self.task.is_idle():
+            self._err = 0
+            self._done.set()
+
+class AxisPoller:
+    """ @details The one coroutine that talks to the drivers. Every pass
+            reads the status of every axis, in one frame for a daisy chain,
+            and steps each AsyncAxis.
+    """
+    def __init__(self, axes, chain=None, period=_POLL_MS):
+        """ Create the poller.
+
+        @arg @c axes   A list of AsyncAxis, in chain order if there is a chain.
+        @arg @c chain  The stmspi.DaisyChain the axes share, or None.
+        @arg @c period The time between passes, in milliseconds.
+        """
+        self._axes = axes
+        self._chain = chain
+        self._period = period
+
+    async def run (self):
+        """ Polls forever. Start it with asyncio.create_task(poller.run()).
+        """
+        while True:
+            if self._chain is not None:
+                stats = get_status_all(self._chain)
+                for i in range(len(self._axes)):
+                    self._axes[i].step(stats[i])
+            else:
+                for axis in self._axes:
+                    axis.step()
+            await asyncio.sleep_ms(self._period)
+
+async def slew_all (axes, angles):
+    """ Starts every axis toward its angle at once, then waits for all of
+    them, so the moves overlap.
+
+    @arg @c axes   A list of AsyncAxis.
+    @arg @c angles The target for each axis, in absolute degrees.
+
+    @return @c errors The wait_idle() result for each axis.
+    """
+    for i in range(len(axes)):
+        axes[i].send(OP_SLEW, deg_to_arg(angles[i]))
+    errors = []
+    for axis in axes:
+        errors.append(await axis.wait_idle())
+    return errors
@@ -0,0 +1,115 @@
+""" @file scheduler.py
+This module implements a small cooperative scheduler for the STM32 tasks.
+Every task declares its own period and priority, tasks with nothing to do
+back off on their own, and the CPU sleeps until the next interrupt when
+nothing is due.
+
+    @authors Anthony Lombardi
+    @authors John Barry
+    @date 8 December 2016
+"""
+import pyb
+from utime import ticks_ms, ticks_add, ticks_diff
+
+class Task:
+    """ @details One entry in the Scheduler. Made by Scheduler.add().
+    """
+    def __init__(self, name, func, period, priority, max_period):
+        """ Create a new task entry.
+
+        @arg @c name       (string): Shown by Scheduler.print_stats().
+        @arg @c func       (func):   Called with no arguments when the task is due.
+                                     Returning a true value means it did work,
+                                     and keeps it at its base period.
+        @arg @c period     (int):    The base period, in milliseconds.
+        @arg @c priority   (int):    Higher runs first when several tasks are due.
+        @arg @c max_period (int):    How far the period may back off while idle, in ms.
+        """
+        self.name = name
+        self.func = func
+        self.period = period
+        self.priority = priority
+        self.max_period = max_period
+        self.cur_period = period
+        self.next_run = ticks_ms()
+        self.runs = 0
+
+class Scheduler:
+    """ @details Runs Tasks at their own rates from a single loop. A task
+            that reports no work has its period doubled, up to its
+            max_period, and wake() brings it back at once when work shows up.
+    """
+    def __init__(self):
+        """ Create a scheduler with no tasks.
+        """
+        self._tasks = []
+
+    def add (self, name, func, period, priority=0, max_period=None):
+        """ Adds a task. See Task for the arguments.
+
+        @return @c task (Task): The new task, for use with wake().
+        """
+        if max_period is None:
+            max_period = period # never back off
+        task = Task(name, func, period, priority, max_period)
+        self._tasks.append(task)
+        # keep the highest priority first, so the loop can just walk the list
+        self._tasks.sort(key=lambda t: -t.priority)
+        return task
+
+    def wake (self, task):
+        """ Makes a task due now and resets it to its base period, eg. when a
+        command arrives for a motor that had backed off.
+
+        @arg @c task (Task): The task to wake.
+        """
+        task.cur_period = task.period
+        task.next_run = ticks_ms()
+
+    def set_period (self, task, period, max_period=None):
+        """ Changes the rate of a task, eg. when the host asks for faster
+        telemetry. Takes effect from the next run.
+
+        @arg @c task       (Task): The task to change.
+        @arg @c period     (int):  The new base period, in milliseconds.
+        @arg @c max_period (int):  The new back-off limit, or None to not back off.
+        """
+        task.period = period
+        task.max_period = max_period if max_period is not None else period
+        task.cur_period = period
+        task.next_run = ticks_add(ticks_ms(), period)
+
+    def run_once (self):
+        """ Runs every task that is due, highest priority first.
+
+        @return @c wait (int): Milliseconds until the next task is due.
+        """
+        now = ticks_ms()
+        wait = None
+        for task in self._tasks:
+            if ticks_diff(task.next_run, now) <= 0:
+                if task.func():
+                    task.cur_period = task.period
+                else:
+                    task.cur_period = min(task.cur_period*2, task.max_period)
+                task.runs += 1
+                task.next_run = ticks_add(now, task.cur_period)
+                now = ticks_ms()
+            due_in = ticks_diff(task.next_run, now)
+            if wait is None or due_in < wait:
+                wait = due_in
+        return wait if wait is not None else 0
+
+    def run (self):
+        """ Runs the tasks forever. Between tasks the CPU waits for an
+        interrupt; the 1 ms SysTick or any USB traffic wakes it again.
+        """
+        while True:
+            if self.run_once() > 0:
+                pyb.wfi()
+
+    def print_stats (self):
+        """ Prints how often each task ran, and its current period.
+        """
+        for task in self._tasks:
+            print('  ', task.name, ':', task.runs, 'runs, every', task.cur_period, 'ms')
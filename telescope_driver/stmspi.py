@@ -6,13 +6,14 @@ This module implements an SPI bus in master mode, with chip select lines.
     @date 8 December 2016
 """
 
-import pyb
 from pyb import SPI,Pin
 
 # stores the pins used already, so we don't double up
 __cs_pins = []
 # references to the buses available to us- a dummy and four real buses
 __spi_buses = ['off', 'off', 'off', 'off', 'off']
+# longest frame send_recieve can build: a 3 byte command plus a 3 byte reply
+_FRAME_LEN = const(6)
 
 def init_bus (bus_num, baudrate=1000000, polarity=1, phase=1, firstbit='MSB'):
     """ Turn on an SPI bus or reinitialize it if it was on already.
@@ -68,8 +69,49 @@ class SPIDevice:
             __cs_pins.append(chip_select_pin)
             self.bus = bus_num
             self.cs = Pin(chip_select_pin, Pin.OUT_PP)
+            self.cs.high()
+        self._alloc_frames(1)
         # done
 
+    def _alloc_frames(self, width):
+        """ (Re)allocates the burst buffers for <width> bytes per chip select
+            pulse. Done once, so a transfer never touches the heap.
+
+            @arg @c width (int): The number of chips sharing the chip select line.
+        """
+        self.width = width
+        self.tx_buf = bytearray(_FRAME_LEN*width)
+        self.rx_buf = bytearray(_FRAME_LEN*width)
+        tx_view = memoryview(self.tx_buf)
+        rx_view = memoryview(self.rx_buf)
+        # one window per CS pulse, so burst() doesn't slice mid-frame
+        self._tx_slots = [tx_view[i*width:(i+1)*width] for i in range(_FRAME_LEN)]
+        self._rx_slots = [rx_view[i*width:(i+1)*width] for i in range(_FRAME_LEN)]
+
+    def burst(self, length):
+        """ Clocks the first <length> bytes of tx_buf out to the device and
+            stores the bytes shifted back in the same positions of rx_buf.
+            On a DaisyChain each of those bytes is really <width> bytes, one
+            per chip.
+            The L6470 latches one byte per chip select pulse, so CS still
+            rises between bytes, but the gap is only as long as the pin
+            toggle itself (well over the 800ns the chip needs) instead of
+            the old fixed microsecond sleeps.
+
+            @arg @c length (int): The number of bytes in the frame. Must be 1-6.
+
+            @return @c rx_buf (bytearray): The buffer holding the replies.
+        """
+        bus = __spi_buses[self.bus]
+        cs = self.cs
+        tx_slots = self._tx_slots
+        rx_slots = self._rx_slots
+        for slot in range(length):
+            cs.low()
+            bus.send_recv(tx_slots[slot], rx_slots[slot])
+            cs.high()
+        return self.rx_buf
+
     def send_recieve(self, send, send_len, recieve_len):
         """ A basic function using micropython's send and recieve SPI commands
             with added chip select.
@@ -81,59 +123,195 @@ class SPIDevice:
             @return @c data (int):     The response from the SPI command
         """
 
-        # breaks 'send' into bytes using a shift and mask.
-        data_bytes = [(send>>8*(send_len-byte-1))&0xff for byte in range(0,send_len)]
-        # prepare to fill this
-        recv_bytes = []
-
-        # send data byte by byte
-        for byte in data_bytes:
-            self.__send_byte(byte)
-            pyb.udelay(1)
-        # recieve data byte by byte
-        for byte in range(0, recieve_len):
-            recv_bytes.append(self.__read_byte())
-            pyb.udelay(1)
-            #print (recv_bytes[byte])
-
-        # convert recieved bytes into a single number
-        return_data = 0
-        for byte in range(0,recieve_len):
-            # shift previous values over to make room
-            return_data = return_data << 8
-            # add the new byte in
-            return_data += recv_bytes[byte]
-        return return_data
-
-## @privatesecton
-
-    # sender helper
-    def __send_byte (self, byte):
-        self.cs.value(0)
-        pyb.udelay(1)
-        __spi_buses[self.bus].send(byte)
-        pyb.udelay(1)
-        self.cs.value(1)
-
-    # reciever helper
-    def __read_byte (self):
-        self.cs.value(0)
-        pyb.udelay(1)
-        data = __spi_buses[self.bus].recv(1)
-        pyb.udelay(1)
-        self.cs.value(1)
-        return (data[0])
+        # breaks 'send' into bytes using a shift and mask, then pads the
+        # reply part of the frame with NOPs.
+        tx = self.tx_buf
+        for byte in range(0,send_len):
+            tx[byte] = (send>>8*(send_len-byte-1))&0xff
+        for byte in range(send_len,send_len+recieve_len):
+            tx[byte] = 0
+        self.burst(send_len+recieve_len)
+
+        # convert recieved bytes into a single number, without slicing
+        rx = self.rx_buf
+        data = 0
+        for byte in range(send_len,send_len+recieve_len):
+            data = (data<<8) + rx[byte]
+        return data
+
+class DaisyChain(SPIDevice):
+    """ A string of L6470s sharing one chip select line, with each chip's SDO
+            wired to the next chip's SDI. Every CS pulse shifts one byte into
+            each chip, so a command for every driver goes out in one frame.
+    """
+    def __init__(self, bus_num, chip_select_pin, length):
+        """ Sets up a daisy chain on one of the SPI buses.
+
+            @arg @c bus_num (int):         Must be 0-4. Selects a bus to use, where 0 is a fake bus for testing.
+            @arg @c chip_select_pin (obj): The pin on the board shared by every chip as chip select.
+            @arg @c length (int):          The number of chips in the chain.
+        """
+        SPIDevice.__init__(self, bus_num, chip_select_pin)
+        self.length = length
+        self._alloc_frames(length)
+        self.replies = [0]*length # reused for every frame
+
+    def device(self, index):
+        """ Gets a handle for one chip in the chain, usable anywhere an
+            SPIDevice is.
+
+            @arg @c index (int): Position in the chain, 0 is the chip wired to the board's MOSI.
+
+            @return @c device (ChainDevice): The handle for that chip.
+        """
+        return ChainDevice(self, index)
+
+    def broadcast(self, send, send_len, recieve_len):
+        """ Sends the same command to every chip in the chain, eg. GetStatus.
+            Unlike send_recieve, which is only meant for a single chip, this
+            returns one reply per chip.
+
+            @arg @c send (int):        The integer amount for the command you want to send
+            @arg @c send_len (int):    The number of bytes being sent in the command
+            @arg @c recieve_len (int): The number of bytes you want to read
+
+            @return @c replies (list): The response from each chip, in chain order.
+                                       The list is reused by the next frame.
+        """
+        width = self.length
+        tx = self.tx_buf
+        for byte in range(0,send_len):
+            value = (send>>8*(send_len-byte-1))&0xff
+            for pos in range(byte*width,(byte+1)*width):
+                tx[pos] = value
+        for pos in range(send_len*width,(send_len+recieve_len)*width):
+            tx[pos] = 0
+        self.burst(send_len+recieve_len)
+        return self.__demux(send_len, recieve_len)
+
+    def send_recieve_all(self, commands):
+        """ Sends a different command to each chip in one frame. Shorter
+            commands are padded with NOPs at the end.
+
+            @arg @c commands (list): One (send, send_len, recieve_len) tuple per chip in chain order, or None to leave that chip alone.
+
+            @return @c replies (list): The response from each chip, in chain order.
+                                       The list is reused by the next frame.
+        """
+        width = self.length
+        tx = self.tx_buf
+        frame_len = 0
+        for chip in range(0,width):
+            if commands[chip] is not None:
+                frame_len = max(frame_len, commands[chip][1]+commands[chip][2])
+        for pos in range(0,frame_len*width):
+            tx[pos] = 0
+        for chip in range(0,width):
+            if commands[chip] is None:
+                continue
+            send, send_len, recieve_len = commands[chip]
+            # bytes come out of the board in reverse chain order
+            col = width-1-chip
+            for byte in range(0,send_len):
+                tx[byte*width+col] = (send>>8*(send_len-byte-1))&0xff
+        self.burst(frame_len)
+        replies = self.replies
+        rx = self.rx_buf
+        for chip in range(0,width):
+            replies[chip] = 0
+            if commands[chip] is None:
+                continue
+            send, send_len, recieve_len = commands[chip]
+            col = width-1-chip
+            for byte in range(send_len,send_len+recieve_len):
+                replies[chip] = (replies[chip]<<8) + rx[byte*width+col]
+        return replies
+
+## @privatesection
+
+    # splits the replies to a broadcast back out per chip
+    def __demux(self, send_len, recieve_len):
+        width = self.length
+        replies = self.replies
+        rx = self.rx_buf
+        for chip in range(0,width):
+            col = width-1-chip
+            value = 0
+            for byte in range(send_len,send_len+recieve_len):
+                value = (value<<8) + rx[byte*width+col]
+            replies[chip] = value
+        return replies
+
+class ChainDevice(SPIDevice):
+    """ One chip's seat on a DaisyChain. Looks like an SPIDevice to the
+            L6470 driver, while the other chips in the chain are sent NOPs.
+    """
+    def __init__(self, chain, index):
+        """ Use DaisyChain.device() rather than building these directly.
+
+            @arg @c chain (DaisyChain): The chain the chip sits on.
+            @arg @c index (int):        Position in the chain, 0 is the chip wired to the board's MOSI.
+        """
+        self.chain = chain
+        self.index = index
+        self._col = chain.length-1-index # bytes come out in reverse chain order
+        self.tx_buf = bytearray(_FRAME_LEN)
+        self.rx_buf = bytearray(_FRAME_LEN)
+
+    def burst(self, length):
+        """ Clocks the first <length> bytes of tx_buf out to this chip through
+            the chain, and copies its replies into rx_buf.
+
+            @arg @c length (int): The number of bytes in the frame. Must be 1-6.
+
+            @return @c rx_buf (bytearray): The buffer holding the replies.
+        """
+        chain = self.chain
+        width = chain.length
+        col = self._col
+        chain_tx = chain.tx_buf
+        for pos in range(0,length*width):
+            chain_tx[pos] = 0 # NOP for everyone else
+        for byte in range(0,length):
+            chain_tx[byte*width+col] = self.tx_buf[byte]
+        chain.burst(length)
+        chain_rx = chain.rx_buf
+        for byte in range(0,length):
+            self.rx_buf[byte] = chain_rx[byte*width+col]
+        return self.rx_buf
 
 class DummyBus:
     """ A simulated SPI bus with no hardware.
             Useful for testing, but recieves 0.
     """
+    def __init__(self):
+        """ Sets up the frame buffers burst() uses.
+        """
+        self.tx_buf = bytearray(_FRAME_LEN)
+        self.rx_buf = bytearray(_FRAME_LEN)
+
+    def burst(self, length):
+        """ A fake command that imitates SPIDevice.
+        """
+        print ("Faked Burst: ", self.tx_buf[0:length])
+        for byte in range(0,length):
+            self.rx_buf[byte] = 0
+        return self.rx_buf
+
     def send_recieve(self, data, send_len, recv_len):
         """ A fake command that imitates SPIDevice.
         """
         print ("faked Send: ", hex(data))
         return recv(recv_len)
 
+    def send_recv(self, send, recv):
+        """ A fake command that imitates pyb.SPI.send_recv.
+        """
+        print ("Faked Send: ", format(send[0], '02X'))
+        for byte in range(0,len(recv)):
+            recv[byte] = 0
+        return recv
+
     def send(self, byte):
         """ A fake command that imitates SPIDevice.
         """
@@ -0,0 +1,404 @@
+""" @file usb_protocol.py
+This module implements the binary command protocol between the Raspberry Pi
+and the stepper driver board over USB serial. It runs under both MicroPython
+and CPython, and the same file is kept in telescope_driver/ and raspberry_pi/.
+
+A frame is laid out as:
+@li @c SYNC    one byte, always 0xA5. Never a printable character, so the
+               board can tell frames apart from typed ASCII commands.
+@li @c LEN     one byte, the number of bytes from OPCODE to the end of the payload.
+@li @c OPCODE  one byte, see the OP_ constants.
+@li @c AXIS    one byte, see the AXIS_ constants.
+@li @c ID      one byte, a command id picked by the sender.
+@li @c ARG     four bytes, a little-endian signed fixed-point argument.
+               Angles are in arcseconds (degrees * ARG_SCALE).
+@li @c CRC     one byte, CRC-8 (polynomial 0x07) over LEN to the end of the payload.
+
+Frames from the board to the host are told apart by their opcode. Replies to
+commands (OP_ACK, OP_NAK) and move events (OP_DONE, OP_ERROR) have the same
+layout as a command, with the ID of the command they answer. A telemetry
+frame has the same SYNC, LEN and CRC around a different body:
+@li @c OPCODE  one byte, OP_TELEMETRY.
+@li @c SEQ     two bytes, little-endian, counts up by one per frame and wraps.
+@li @c COUNT   one byte, the number of axes that follow.
+@li then per axis: ABS_POS (int32, signed microsteps), SPEED (uint32, the raw
+               register), STATUS (uint16, read without clearing the flags) and
+               STATE (uint8, see the STATE_ constants).
+
+A busy axis refuses new commands with NAK_BUSY, except OP_STOP and OP_OFF,
+which are always taken once the axis has initialized. They finish with
+OP_DONE once the motor has come to rest, not when the stop is sent, and so
+does a running command they cut short, at the angle reached. A queued
+command they replace finishes with OP_DONE straight away.
+
+    @authors Anthony Lombardi
+    @authors John Barry
+    @date 8 December 2016
+"""
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+SYNC = 0xA5
+
+# command opcodes, host to board
+OP_NONE     = 0x00 # nothing to do
+OP_INIT     = 0x01 # (re-)initialize the axis
+OP_SLEW     = 0x02 # go to ARG arcseconds, absolute
+OP_TURN     = 0x03 # go ARG arcseconds, relative
+OP_TRACK    = 0x04 # turn at ARG SPEED register units, signed. Can be resent to change speed
+OP_MARK     = 0x05 # go to the MARK position
+OP_MARK_SET = 0x06 # set the current position as MARK
+OP_HOME     = 0x07 # go to the HOME position
+OP_HOME_SET = 0x08 # set the current position as HOME
+OP_STOP     = 0x09 # stop, with holding torque. Taken even while busy, see above
+OP_OFF      = 0x0A # Hi-Z (coast). Taken even while busy, see above
+OP_TELEM_RATE = 0x0B # send telemetry every ARG ms, 0 to stop. AXIS is ignored
+
+# frame opcodes, board to host
+OP_TELEMETRY = 0x80 # periodic position and status of every axis
+OP_ACK       = 0x81 # command ID was accepted. ARG is 0
+OP_NAK       = 0x82 # command ID was refused. ARG is one of the NAK_ reasons
+OP_DONE      = 0x83 # command ID has finished. ARG is the axis angle, in arcseconds
+OP_ERROR     = 0x84 # command ID (0 if none) ended in a driver error. ARG is STATUS
+
+# reasons for an OP_NAK
+NAK_AXIS   = 1 # no such axis
+NAK_OPCODE = 2 # unknown opcode
+NAK_BUSY   = 3 # the axis is moving, or already has a command waiting
+NAK_STATE  = 4 # the axis is initializing or in error
+
+AXIS_ALT = 0
+AXIS_AZI = 1
+AXIS_FOC = 2
+AXIS_NAMES = ('alt', 'azi', 'foc') # the ASCII command prefixes, by axis
+
+# MotorTask states, as sent in telemetry
+STATE_INIT = 0
+STATE_IDLE = 1
+STATE_BUSY = 2
+STATE_ERR  = 3
+
+TRACK_DEFAULT = 1000 # SPEED units for a typed 'track' with no speed
+
+ARG_SCALE = 3600 # fixed-point units per degree, ie. arcseconds
+
+CMD_LEN       = 7  # OPCODE, AXIS, ID and a 4 byte ARG
+CMD_FRAME_LEN = 10 # SYNC, LEN, the command and CRC
+MAX_FRAME_LEN = 64 # longest frame a StreamParser will hold
+TELEM_AXIS_LEN = 11 # bytes per axis in a telemetry frame
+
+# what StreamParser.poll() found
+KIND_NONE  = 0 # nothing complete yet
+KIND_FRAME = 1 # a binary frame, in StreamParser.frame
+KIND_LINE  = 2 # a \r terminated text line, in StreamParser.line
+
+# ASCII command words and the opcodes they map to
+_ASCII_OPS = (('init', OP_INIT), ('slew', OP_SLEW), ('turn', OP_TURN),
+              ('track', OP_TRACK), ('mark', OP_MARK), ('home', OP_HOME),
+              ('stop', OP_STOP), ('off', OP_OFF))
+
+def _crc_table ():
+    # CRC-8, polynomial x^8 + x^2 + x + 1, one entry per byte value
+    table = bytearray(256)
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+        table[byte] = crc
+    return table
+
+_CRC_TABLE = _crc_table()
+
+def crc8 (buf, start, end):
+    """ Computes the frame checksum.
+
+        @arg @c buf (bytearray): The buffer holding the frame.
+        @arg @c start (int):     Index of the first byte to check.
+        @arg @c end (int):       Index one past the last byte to check.
+
+        @return @c crc (int): The CRC-8 of buf[start:end].
+    """
+    crc = 0
+    for i in range(start, end):
+        crc = _CRC_TABLE[crc ^ buf[i]]
+    return crc
+
+def deg_to_arg (degrees):
+    """ @arg @c degrees (float): An angle, in degrees.
+
+        @return @c arg (int): The angle as a fixed-point frame argument.
+    """
+    return int(round(degrees * ARG_SCALE))
+
+def encode_command (op, axis, arg=0, cmd_id=0, buf=None):
+    """ Builds a command frame.
+
+        @arg @c op (int):     One of the OP_ constants.
+        @arg @c axis (int):   One of the AXIS_ constants.
+        @arg @c arg (int):    The fixed-point argument, eg. from deg_to_arg().
+        @arg @c cmd_id (int): An id for the command, 0-255.
+        @arg @c buf (bytearray): Optional buffer of CMD_FRAME_LEN bytes to reuse.
+
+        @return @c frame (bytearray): The encoded frame.
+    """
+    if buf is None:
+        buf = bytearray(CMD_FRAME_LEN)
+    struct.pack_into('<BBBBBi', buf, 0, SYNC, CMD_LEN, op, axis, cmd_id & 0xFF, arg)
+    buf[CMD_FRAME_LEN-1] = crc8(buf, 1, CMD_FRAME_LEN-1)
+    return buf
+
+def decode_command (buf):
+    """ Checks and unpacks a command frame.
+
+        @arg @c buf (bytearray): A buffer holding CMD_FRAME_LEN bytes, starting with SYNC.
+
+        @return @c command (tuple): (op, axis, cmd_id, arg), or None if the frame is corrupt.
+    """
+    if buf[0] != SYNC or buf[1] != CMD_LEN:
+        return None
+    if crc8(buf, 1, CMD_FRAME_LEN-1) != buf[CMD_FRAME_LEN-1]:
+        return None
+    sync, length, op, axis, cmd_id, arg = struct.unpack_from('<BBBBBi', buf, 0)
+    return (op, axis, cmd_id, arg)
+
+def telemetry_len (count):
+    """ @arg @c count (int): The number of axes in the frame.
+
+        @return @c length (int): The size of the whole telemetry frame, in bytes.
+    """
+    return 7 + TELEM_AXIS_LEN*count # SYNC, LEN, OPCODE, SEQ, COUNT, axes, CRC
+
+def encode_telemetry (seq, samples, buf=None):
+    """ Builds a telemetry frame.
+
+        @arg @c seq (int):      The frame sequence number, kept to 16 bits.
+        @arg @c samples (list): One (abs_pos, speed, status, state) sequence per axis.
+        @arg @c buf (bytearray): Optional buffer of telemetry_len(len(samples)) bytes to reuse.
+
+        @return @c frame (bytearray): The encoded frame.
+    """
+    count = len(samples)
+    length = telemetry_len(count)
+    if buf is None:
+        buf = bytearray(length)
+    struct.pack_into('<BBBHB', buf, 0, SYNC, length-3, OP_TELEMETRY, seq & 0xFFFF, count)
+    offset = 6
+    for sample in samples:
+        struct.pack_into('<iIHB', buf, offset, sample[0], sample[1], sample[2], sample[3])
+        offset += TELEM_AXIS_LEN
+    buf[length-1] = crc8(buf, 1, length-1)
+    return buf
+
+def decode_telemetry (buf):
+    """ Checks and unpacks a telemetry frame.
+
+        @arg @c buf (bytearray): A buffer holding the frame, starting with SYNC.
+
+        @return @c telemetry (tuple): (seq, samples), samples holding one
+                (abs_pos, speed, status, state) tuple per axis, or None if
+                the frame is corrupt or not telemetry.
+    """
+    if buf[0] != SYNC or buf[2] != OP_TELEMETRY:
+        return None
+    count = buf[5]
+    length = telemetry_len(count)
+    if buf[1] != length-3 or len(buf) < length:
+        return None
+    if crc8(buf, 1, length-1) != buf[length-1]:
+        return None
+    seq = struct.unpack_from('<H', buf, 3)[0]
+    samples = []
+    for i in range(count):
+        samples.append(struct.unpack_from('<iIHB', buf, 6 + i*TELEM_AXIS_LEN))
+    return (seq, samples)
+
+def parse_ascii (cmd):
+    """ Turns a typed command (without its axis prefix) into an opcode and
+            argument, eg. 'slew 10.5' into (OP_SLEW, 37800).
+
+        @arg @c cmd (string): The command, eg. 'slew 10', 'track -500', 'home set' or 'stop'.
+
+        @return @c command (tuple): (op, arg). op is OP_NONE for an unknown command.
+
+        @throws ValueError if a slew or turn angle, or a track speed, is not a number.
+    """
+    for word, op in _ASCII_OPS:
+        if cmd.startswith(word):
+            rest = cmd[len(word):].strip()
+            if op == OP_SLEW or op == OP_TURN:
+                return (op, deg_to_arg(float(rest)))
+            if op == OP_TRACK:
+                return (op, int(rest) if rest else TRACK_DEFAULT)
+            if (op == OP_MARK or op == OP_HOME) and 'set' in rest:
+                return (op+1, 0) # the _SET variant
+            return (op, 0)
+    return (OP_NONE, 0)
+
+class RingBuffer:
+    """ @details A fixed-size byte FIFO. It is filled from a stream with
+            readinto, through windows made once up front, so draining a
+            port never allocates, and bytes can be looked at in place
+            before they are consumed.
+    """
+    def __init__(self, size=256):
+        """ Create an empty ring buffer.
+
+        @arg @c size (int): The capacity, in bytes.
+        """
+        self._buf = bytearray(size)
+        self._size = size
+        # readinto only takes a whole buffer, so reads land in one of these
+        # power-of-two windows on a staging buffer and are copied in from
+        # there; slicing the storage at the tail would allocate every read
+        self._stage = bytearray(size)
+        stage = memoryview(self._stage)
+        self._windows = []
+        length = 1
+        while length <= size:
+            self._windows.append(stage[0:length])
+            length <<= 1
+        self._head = 0  # index of the oldest byte
+        self._count = 0 # bytes held
+
+    def __len__ (self):
+        return self._count
+
+    def free (self):
+        """ @return @c free (int): The number of bytes that still fit.
+        """
+        return self._size - self._count
+
+    def fill (self, stream):
+        """ Moves bytes from <stream> into the buffer for as long as it has
+        some waiting and there is room for them.
+
+        @arg @c stream (obj): Anything with any and readinto, eg. pyb.USB_VCP.
+                any only has to say whether bytes are waiting, and readinto
+                must return what is waiting without blocking.
+
+        @return @c count (int): The number of bytes moved.
+        """
+        moved = 0
+        while self._count < self._size and stream.any():
+            free = self._size - self._count
+            window = len(self._windows) - 1
+            while len(self._windows[window]) > free:
+                window -= 1
+            got = stream.readinto(self._windows[window])
+            if not got:
+                break
+            tail = (self._head + self._count) % self._size
+            for i in range(got):
+                self._buf[tail] = self._stage[i]
+                tail += 1
+                if tail == self._size:
+                    tail = 0
+            self._count += got
+            moved += got
+        return moved
+
+    def extend (self, data):
+        """ Appends bytes that were already read, eg. by pyserial.
+
+        @arg @c data (bytes): The bytes to add. Whatever doesn't fit is dropped.
+
+        @return @c count (int): The number of bytes added.
+        """
+        count = min(len(data), self._size - self._count)
+        for i in range(count):
+            self._buf[(self._head + self._count) % self._size] = data[i]
+            self._count += 1
+        return count
+
+    def peek (self, offset):
+        """ @arg @c offset (int): Position from the oldest byte.
+
+        @return @c byte (int): The byte at that position, without consuming it.
+        """
+        return self._buf[(self._head + offset) % self._size]
+
+    def find (self, byte):
+        """ @arg @c byte (int): The value to look for.
+
+        @return @c offset (int): Position of its first occurrence, or -1.
+        """
+        for offset in range(self._count):
+            if self._buf[(self._head + offset) % self._size] == byte:
+                return offset
+        return -1
+
+    def consume (self, count, dest=None):
+        """ Removes the oldest <count> bytes, optionally copying them out.
+
+        @arg @c count (int):        The number of bytes to remove.
+        @arg @c dest (bytearray):   Where to copy them to, or None to drop them.
+        """
+        if dest is not None:
+            for i in range(count):
+                dest[i] = self._buf[(self._head + i) % self._size]
+        self._head = (self._head + count) % self._size
+        self._count -= count
+
+class StreamParser:
+    """ @details Splits a byte stream into binary frames and \\r terminated
+            text lines. Call poll() until it returns KIND_NONE to take out
+            every complete message that has arrived.
+    """
+    def __init__(self, size=256):
+        """ Create a parser with its own ring buffer.
+
+        @arg @c size (int): The capacity of the ring buffer, in bytes.
+        """
+        self.ring = RingBuffer(size)
+        self.frame = bytearray(MAX_FRAME_LEN)
+        self.line = bytearray(size)
+        self.line_len = 0
+
+    def poll (self):
+        """ Takes the next complete message out of the ring buffer.
+
+        @return @c kind (int): KIND_FRAME if self.frame holds a frame,
+                KIND_LINE if self.line holds line_len bytes of text, or
+                KIND_NONE if nothing complete is waiting.
+        """
+        ring = self.ring
+        while len(ring):
+            first = ring.peek(0)
+            if first == 0x0A: # stray \n from a \r\n line ending
+                ring.consume(1)
+                continue
+            if first == SYNC:
+                if len(ring) < 2:
+                    return KIND_NONE
+                length = ring.peek(1) + 3 # SYNC, LEN and CRC around the body
+                if length > MAX_FRAME_LEN:
+                    ring.consume(1) # can't be a real frame, resync
+                    continue
+                if len(ring) < length:
+                    return KIND_NONE
+                ring.consume(length, self.frame)
+                return KIND_FRAME
+            end = ring.find(0x0D)
+            if end < 0:
+                if not ring.free():
+                    ring.consume(len(ring)) # a line longer than the buffer, drop it
+                return KIND_NONE
+            # copy the line out, applying any backspaces on the way
+            line = self.line
+            count = 0
+            for i in range(end):
+                byte = ring.peek(i)
+                if byte == 0x08:
+                    count = max(count-1, 0)
+                else:
+                    line[count] = byte
+                    count += 1
+            ring.consume(end+1)
+            self.line_len = count
+            return KIND_LINE
+        return KIND_NONE
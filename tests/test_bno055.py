@@ -0,0 +1,120 @@
+""" @file test_bno055.py
+Host-side checks that the batched fusion reads of BNO055 decode the same as
+the one-register-at-a-time read_* functions. The sensor is replaced by a fake
+I2C device holding random register contents. Skipped without pyserial and
+NumPy.
+"""
+
+import os
+import random
+import sys
+
+import pytest
+
+pytest.importorskip('serial')
+np = pytest.importorskip('numpy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+import BNO055
+from BNO055 import (BNO055_ACCEL_DATA_X_LSB_ADDR, FUSION_BLOCK_SIZE, FUSION_NAMES,
+                    decode_fusion_stream)
+
+
+class FakeDevice(object):
+    """ The register map of a BNO055, read the way Adafruit_GPIO.I2C reads it. """
+    def __init__(self):
+        self.registers = bytearray(0x80)
+        self.reads = 0
+
+    def readList(self, address, length):
+        self.reads += 1
+        return self.registers[address:address+length]
+
+    def readU8(self, address):
+        self.reads += 1
+        return self.registers[address]
+
+
+class FakeBus(object):
+    def __init__(self):
+        self.device = FakeDevice()
+
+    def get_i2c_device(self, address, **kwargs):
+        return self.device
+
+
+def random_block(rng):
+    return bytes(bytearray(rng.randrange(256) for i in range(FUSION_BLOCK_SIZE)))
+
+
+def sensor():
+    bus = FakeBus()
+    return BNO055.BNO055(i2c=bus), bus.device
+
+
+def load(device, block):
+    start = BNO055_ACCEL_DATA_X_LSB_ADDR
+    device.registers[start:start+FUSION_BLOCK_SIZE] = block
+
+
+def test_read_fusion_matches_single_reads():
+    rng = random.Random(3)
+    bno, device = sensor()
+    for trial in range(20):
+        load(device, random_block(rng))
+        device.reads = 0
+        fused = bno.read_fusion()
+        assert device.reads == 1
+        assert fused['accelerometer'] == bno.read_accelerometer()
+        assert fused['magnetometer'] == bno.read_magnetometer()
+        assert fused['gyroscope'] == bno.read_gyroscope()
+        assert fused['euler'] == bno.read_euler()
+        assert fused['quaternion'] == bno.read_quaternion()
+        assert fused['linear_acceleration'] == bno.read_linear_acceleration()
+        assert fused['gravity'] == bno.read_gravity()
+        assert fused['temp'] == bno.read_temp()
+        assert fused['calibration'] == bno.get_calibration_status()
+
+
+def test_read_fusion_subset():
+    rng = random.Random(4)
+    bno, device = sensor()
+    load(device, random_block(rng))
+    everything = bno.read_fusion()
+    for names in (('gyroscope',), ('euler', 'quaternion'), ('temp', 'calibration'), ()):
+        part = bno.read_fusion(names)
+        assert sorted(part) == sorted(names)
+        for name in names:
+            assert part[name] == everything[name]
+
+
+def test_decode_fusion_stream_matches_read_fusion():
+    rng = random.Random(5)
+    bno, device = sensor()
+    blocks = [random_block(rng) for i in range(50)]
+    expected = []
+    for block in blocks:
+        load(device, block)
+        assert bno.read_fusion_block() == block
+        expected.append(bno.read_fusion())
+    # a partial block at the end of a recording is ignored
+    decoded = decode_fusion_stream(b''.join(blocks) + blocks[0][:7])
+    assert sorted(decoded) == sorted(FUSION_NAMES)
+    for name in FUSION_NAMES:
+        assert len(decoded[name]) == len(blocks)
+        for row, fused in zip(decoded[name], expected):
+            if np.ndim(row):
+                assert tuple(row.tolist()) == fused[name]
+            else:
+                assert int(row) == fused[name]
+
+
+def test_decode_fusion_stream_subset():
+    rng = random.Random(6)
+    data = b''.join(random_block(rng) for i in range(4))
+    decoded = decode_fusion_stream(data, names=('euler', 'temp'))
+    assert sorted(decoded) == ['euler', 'temp']
+    assert decoded['euler'].shape == (4, 3)
+    assert decode_fusion_stream(b'')['gyroscope'].shape == (0, 3)
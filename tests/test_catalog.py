@@ -0,0 +1,55 @@
+""" @file test_catalog.py
+Host-side checks of the vectorized catalog transforms against PyEphem.
+Skipped without NumPy and PyEphem.
+"""
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+ephem = pytest.importorskip('ephem')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+from catalog import Catalog, check_against_ephem
+
+ARCMINUTE = 60.0 # [arcsec], the accuracy catalog.py promises
+
+# north, south and far north, so the pole and the horizon both get sampled
+SITES = [('35.28', '-120.66'), ('-33.92', '18.42'), ('64.13', '-21.90')]
+# 2000-01-01, 2017-07-14, 2025-10-09 and 2033-05-18
+TIMES = [946728000.0, 1500000000.0, 1760000000.0, 2000000000.0]
+
+
+def observer(lat, lon):
+    obs = ephem.Observer()
+    obs.lat = lat
+    obs.lon = lon
+    obs.elevation = 0
+    return obs
+
+
+@pytest.fixture(scope='module')
+def stars():
+    return Catalog.from_ephem_stars()
+
+
+@pytest.mark.parametrize('site', SITES)
+@pytest.mark.parametrize('when', TIMES)
+def test_altaz_within_an_arcminute(stars, site, when):
+    errors = check_against_ephem(stars, observer(*site), count=len(stars), when=when)
+    assert len(errors) == len(stars)
+    assert errors.max() < ARCMINUTE
+
+
+@pytest.mark.parametrize('site', SITES)
+def test_j2000_inverts_altaz(stars, site):
+    obs = observer(*site)
+    alt, az = stars.altaz(obs, TIMES[2])
+    ra, dec = stars.j2000(obs, alt, az, TIMES[2])
+    ra_error = np.abs((ra - stars.ra + np.pi) % (2 * np.pi) - np.pi) * np.cos(stars.dec)
+    assert np.degrees(ra_error).max() * 3600 < 0.01
+    assert np.degrees(np.abs(dec - stars.dec)).max() * 3600 < 0.01
@@ -0,0 +1,79 @@
+""" @file test_catalog_file.py
+Host-side checks that a text catalog survives conversion to the binary
+format and memory-mapping back. Skipped without NumPy.
+"""
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+from catalog_file import (HEADER, MAGIC, RECORD_DTYPE, convert_text, load_catalog,
+                          map_records, read_text, write_catalog)
+
+# a few HYG-style rows, with RA in hours, and rows a converter has to skip
+HYG_TEXT = """id,proper,ra,dec,mag
+0,Sol,0.000000,0.000000,-26.700
+32263,Sirius,6.752481,-16.716116,-1.440
+69451,Arcturus,14.261030,19.182410,-0.050
+91262,Vega,18.615649,38.783692,0.030
+11734,Polaris,2.529750,89.264109,1.970
+5,,23.999,-89.9,12.1
+6,blank,,12.0,3.0
+7,bad,1.0,2.0,bright
+"""
+
+
+def write_text(tmp_path, text, name='hyg.csv'):
+    path = str(tmp_path / name)
+    with open(path, 'w') as out:
+        out.write(text)
+    return path
+
+
+def test_text_binary_memmap_round_trip(tmp_path):
+    text_path = write_text(tmp_path, HYG_TEXT)
+    binary_path = str(tmp_path / 'stars.cat')
+    assert convert_text(text_path, binary_path) == 6
+
+    ra, dec, mag, ids = read_text(text_path)
+    catalog = load_catalog(binary_path)
+    assert len(catalog) == 6
+    assert isinstance(map_records(binary_path), np.memmap)
+    assert np.array_equal(catalog.ra, ra)
+    assert np.array_equal(catalog.dec, dec)
+    assert np.array_equal(catalog.mag, mag)
+    assert list(catalog.ids) == [0, 32263, 69451, 91262, 11734, 5]
+    # spot check the units: hours and degrees in, radians out
+    assert np.isclose(np.degrees(catalog.ra[1]), 6.752481 * 15)
+    assert np.isclose(np.degrees(catalog.dec[4]), 89.264109)
+    assert np.isclose(catalog.mag[2], -0.05)
+
+
+def test_file_layout(tmp_path):
+    path = str(tmp_path / 'two.cat')
+    write_catalog(path, [0.5, 1.5], [-0.25, 0.75], [1.0, 2.0], [10, 20])
+    with open(path, 'rb') as src:
+        data = src.read()
+    assert HEADER.unpack(data[:HEADER.size]) == (MAGIC, 2, RECORD_DTYPE.itemsize)
+    assert len(data) == HEADER.size + 2 * RECORD_DTYPE.itemsize
+    records = np.frombuffer(data[HEADER.size:], dtype=RECORD_DTYPE)
+    assert list(records['ra']) == [0.5, 1.5]
+    assert list(records['id']) == [10, 20]
+
+
+def test_empty_catalog(tmp_path):
+    path = str(tmp_path / 'empty.cat')
+    write_catalog(path, [], [], [], [])
+    assert len(load_catalog(path)) == 0
+
+
+def test_rejects_other_files(tmp_path):
+    path = write_text(tmp_path, HYG_TEXT)
+    with pytest.raises(ValueError):
+        map_records(path)
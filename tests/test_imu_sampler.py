@@ -0,0 +1,119 @@
+""" @file test_imu_sampler.py
+Host-side checks of SettleDetector, on synthetic samples written into an
+ImuSampler's ring the way its thread would. Skipped without pyserial, which
+BNO055 imports.
+"""
+
+import math
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('serial')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+from imu_sampler import (GYRO_TO_DPS, SAMPLE_RATE, SETTLE_ANGLE, SETTLE_RATE, SETTLE_WINDOW,
+                         ImuSampler, SettleDetector, quaternion_angle)
+
+PERIOD = 1.0 / SAMPLE_RATE
+
+
+def turned(degrees):
+    """ @return @c quaternion X, Y, Z, W for a turn of <degrees> about Z """
+    half = math.radians(degrees) / 2.0
+    return (0.0, 0.0, math.sin(half), math.cos(half))
+
+
+def gyro(rate):
+    """ @return @c gyroscope A read_fusion gyroscope reading for <rate> deg/s about Z """
+    return (0.0, 0.0, rate / GYRO_TO_DPS)
+
+
+def push(sampler, when, angle=0.0, rate=0.0):
+    # what ImuSampler._run does with a successful read
+    sample = {'quaternion': turned(angle), 'gyroscope': gyro(rate)}
+    sampler._ring[sampler._count % sampler._size] = (when, sample)
+    sampler._count += 1
+
+
+def detector():
+    sampler = ImuSampler(None)
+    settle = SettleDetector(sampler)
+    # samples are stamped from a little after the detector starts watching
+    return sampler, settle, time.time() + 1.0
+
+
+def test_still_scope_settles():
+    sampler, settle, start = detector()
+    for i in range(40):
+        push(sampler, start + i*PERIOD, angle=30.0)
+    assert settle.settled()
+
+
+def test_needs_a_whole_window():
+    sampler, settle, start = detector()
+    steps = int(SETTLE_WINDOW * 0.8 / PERIOD)
+    for i in range(steps):
+        push(sampler, start + i*PERIOD)
+    assert not settle.settled()
+    for i in range(steps, steps + int(SETTLE_WINDOW / PERIOD)):
+        push(sampler, start + i*PERIOD)
+    assert settle.settled()
+
+
+def test_needs_enough_samples():
+    sampler, settle, start = detector()
+    # a whole window, but only a few reads got through
+    for i in range(5):
+        push(sampler, start + i*SETTLE_WINDOW/4)
+    assert not settle.settled()
+
+
+def test_gyroscope_spike():
+    sampler, settle, start = detector()
+    for i in range(40):
+        push(sampler, start + i*PERIOD, rate=SETTLE_RATE * (2.0 if i == 30 else 0.5))
+    assert not settle.settled()
+    # once the spike is older than the window, it no longer counts
+    for i in range(40, 80):
+        push(sampler, start + i*PERIOD, rate=SETTLE_RATE * 0.5)
+    assert settle.settled()
+
+
+def test_slow_drift():
+    # too slow for the gyroscope limit, but it adds up over the window
+    sampler, settle, start = detector()
+    drift = SETTLE_ANGLE * 2.0 / SETTLE_WINDOW # [deg/s]
+    for i in range(60):
+        push(sampler, start + i*PERIOD, angle=drift * i*PERIOD, rate=drift)
+    assert drift < SETTLE_RATE
+    assert not settle.settled()
+
+
+def test_reset_forgets_old_samples(monkeypatch):
+    sampler, settle, start = detector()
+    for i in range(40):
+        push(sampler, start + i*PERIOD)
+    assert settle.settled()
+    # a move is commanded just after the last sample: what came before it is
+    # no evidence the scope is still
+    clock = start + 40*PERIOD
+    monkeypatch.setattr('imu_sampler.time.time', lambda: clock)
+    settle.reset()
+    assert not settle.settled()
+    for i in range(1, 40):
+        push(sampler, clock + i*PERIOD)
+    assert settle.settled()
+
+
+def test_quaternion_angle():
+    assert quaternion_angle(turned(10.0), turned(10.0)) == pytest.approx(0.0, abs=1e-6)
+    assert quaternion_angle(turned(10.0), turned(-80.0)) == pytest.approx(90.0)
+    # q and -q are the same orientation
+    assert quaternion_angle(turned(20.0), tuple(-q for q in turned(20.0))) \
+        == pytest.approx(0.0, abs=1e-6)
+    assert quaternion_angle((0.0, 0.0, 0.0, 0.0), turned(0.0)) == 180.0
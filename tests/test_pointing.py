@@ -0,0 +1,116 @@
+""" @file test_pointing.py
+Host-side checks that the pointing filter learns a mount's offset and
+backlash from noisy IMU readings. Skipped without pyserial, which the IMU
+modules import.
+"""
+
+import os
+import random
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('serial')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+from mount import AXES, AXIS_ALT, AXIS_AZI
+from pointing import IMU_NOISE, AxisEstimator, PointingEstimator
+
+PERIOD = 0.05 # [sec], the board's default telemetry period
+
+
+def sweep(legs, leg_steps=400, step=0.025, start=10.0):
+    """ Motor angles turning back and forth over leg_steps*step degrees. """
+    motor = start
+    direction = 1
+    for leg in range(legs):
+        for i in range(leg_steps):
+            motor += direction * step
+            yield motor, direction
+        direction = -direction
+
+
+def imu_reading(motor, direction, offset, backlash, rng):
+    # the filter's model, plus the IMU's noise
+    return motor + offset - direction * backlash / 2.0 + rng.gauss(0.0, IMU_NOISE)
+
+
+@pytest.mark.parametrize('offset, backlash', [(2.0, 0.6), (-7.5, 0.2), (179.5, 1.0)])
+def test_converges_on_offset_and_backlash(offset, backlash):
+    rng = random.Random(7)
+    axis = AxisEstimator()
+    when = 1000.0
+    for motor, direction in sweep(12):
+        axis.update(motor, imu_reading(motor, direction, offset, backlash, rng), when)
+        when += PERIOD
+    offset_sigma, backlash_sigma = axis.uncertainty()
+    # the offset may come out wrapped, eg. -180.5 for 179.5
+    assert abs((axis.offset - offset + 180.0) % 360.0 - 180.0) < 0.05
+    assert abs(axis.backlash - backlash) < 0.05
+    assert offset_sigma < 0.05 and backlash_sigma < 0.05
+    # and where it says the axis points, both ways round
+    assert abs((axis.estimate(20.0) - (20.0 + offset - axis.direction * backlash / 2.0)
+                + 180.0) % 360.0 - 180.0) < 0.05
+
+
+def test_backlash_unseen_without_reversals():
+    rng = random.Random(8)
+    axis = AxisEstimator()
+    when = 0.0
+    for motor, direction in sweep(1, leg_steps=2000):
+        axis.update(motor, imu_reading(motor, direction, 3.0, 0.8, rng), when)
+        when += PERIOD
+    # turning one way only, offset and backlash can't be told apart: the
+    # estimate is right, but how it splits between the two is still unsure
+    assert abs(axis.estimate(motor) - (motor + 3.0 - 0.4)) < 0.05
+    assert axis.uncertainty()[1] > 0.5
+
+
+def test_deadband_ignores_jitter():
+    axis = AxisEstimator(deadband=0.01)
+    axis.update(10.0, 10.0, 0.0)
+    axis.update(10.5, 10.5, 0.1)
+    assert axis.direction == 1
+    # jitter back and forth within the deadband doesn't count as turning round
+    for i in range(20):
+        axis.update(10.5 - 0.005 * (i % 2), 10.5, 0.2 + i*0.1)
+        assert axis.direction == 1
+    axis.update(10.4, 10.4, 3.0)
+    assert axis.direction == -1
+
+
+def test_reset():
+    axis = AxisEstimator()
+    rng = random.Random(9)
+    for i, (motor, direction) in enumerate(sweep(4)):
+        axis.update(motor, imu_reading(motor, direction, 5.0, 0.5, rng), i * PERIOD)
+    axis.reset()
+    assert (axis.offset, axis.backlash, axis.direction, axis.updates) == (0.0, 0.0, 0, 0)
+
+
+class FakeSampler(object):
+    """ Hands out one fixed, fresh IMU sample, like ImuSampler.latest(). """
+    def __init__(self, heading, roll):
+        self.fusion = {'euler': (heading, roll, 0.0), 'gyroscope': (0.0, 0.0, 0.0)}
+
+    def latest(self):
+        return (time.time(), self.fusion)
+
+
+def test_pointing_position_is_motor_plus_correction():
+    pointing = PointingEstimator(FakeSampler(heading=12.0, roll=34.0))
+    assert pointing.position() is None
+    # one microstep is 202.5", so 1600 of them is 90 degrees
+    pointing.on_telemetry(1, [(1600, 0, 0, 1), (-800, 0, 0, 1)])
+    motor = pointing.motor
+    assert motor == [90.0, -45.0]
+    position = pointing.position()
+    assert position[AXIS_ALT] == pytest.approx(34.0)
+    assert position[AXIS_AZI] == pytest.approx(12.0)
+    correction = pointing.correction()
+    for axis in AXES:
+        assert position[axis] == pytest.approx(motor[axis] + correction[axis])
+        assert pointing.position([0.0, 0.0])[axis] == pytest.approx(correction[axis])
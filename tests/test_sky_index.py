@@ -0,0 +1,73 @@
+""" @file test_sky_index.py
+Host-side checks of the sky_index grid against a brute-force scan.
+Skipped without NumPy.
+"""
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'raspberry_pi'))
+
+from catalog import Catalog
+from sky_index import SkyIndex, chord_to_degrees, unit_vectors
+
+
+def random_sky(count, seed=1):
+    """ A catalog spread evenly over the sphere, plus objects on both poles
+    and on the RA seam.
+    """
+    rng = np.random.RandomState(seed)
+    ra = np.concatenate((rng.uniform(0, 2*np.pi, count), [0.0, 1.0, 0.0, 2*np.pi - 1e-9]))
+    dec = np.concatenate((np.arcsin(rng.uniform(-1, 1, count)),
+                          [np.pi/2, -np.pi/2, 0.1, -0.1]))
+    return Catalog(ra, dec, rng.uniform(-1, 8, len(ra)))
+
+
+def angles_from(catalog, ra, dec):
+    point = unit_vectors(ra, dec)[0]
+    vectors = unit_vectors(catalog.ra, catalog.dec)
+    return chord_to_degrees(np.sqrt(np.maximum(2.0 - 2.0 * vectors.dot(point), 0.0)))
+
+
+POINTS = [(0.0, 0.0), (6.28, 0.2), (3.0, 1.5707), (1.0, -1.5707), (-0.05, 0.7), (4.0, -0.9)]
+
+
+@pytest.mark.parametrize('count', [1, 500, 20000])
+@pytest.mark.parametrize('radius', [0.5, 5.0, 30.0, 100.0, 179.0])
+def test_cone_matches_scan(count, radius):
+    catalog = random_sky(count)
+    index = SkyIndex(catalog)
+    for ra, dec in POINTS:
+        # compared away from the edge, where rounding may go either way
+        angles = angles_from(catalog, ra, dec)
+        found = set(index.cone(ra, dec, radius).tolist())
+        assert set(np.nonzero(angles < radius - 1e-9)[0]) <= found
+        assert found <= set(np.nonzero(angles <= radius + 1e-9)[0])
+
+
+@pytest.mark.parametrize('count', [3, 500, 20000])
+def test_nearest_matches_scan(count):
+    catalog = random_sky(count)
+    index = SkyIndex(catalog)
+    for ra, dec in POINTS:
+        angles = np.sort(angles_from(catalog, ra, dec))
+        for want in (1, 3, 10):
+            found, distance = index.nearest(ra, dec, want)
+            assert len(found) == min(want, len(catalog))
+            assert np.allclose(distance, angles[:len(found)])
+
+
+def test_whole_sky_cone():
+    catalog = random_sky(100)
+    assert len(SkyIndex(catalog).cone(1.0, 0.5, 180.0)) == len(catalog)
+
+
+def test_cell_size_follows_catalog():
+    small = SkyIndex(random_sky(100))
+    large = SkyIndex(random_sky(50000))
+    assert large._band_deg < small._band_deg
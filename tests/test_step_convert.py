@@ -0,0 +1,190 @@
+""" @file test_step_convert.py
+Host-side checks of step_convert, run with plain CPython:
+    python -m pytest tests
+
+The board and the Pi keep identical copies of the module, so the board's
+copy is tested and the Pi's is checked to match it.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'telescope_driver'))
+
+import step_convert
+from step_convert import (ABS_POS_BITS, ARCSEC_PER_REV, SPEED_MAX, StepConverter,
+                          to_abs_pos, to_signed)
+
+STEP_MODES = range(8)
+HALF_RANGE = 1 << (ABS_POS_BITS-1)
+SMALL_INT = 1 << 30 # MicroPython small ints on the board are 31 bit signed
+
+# the mount (1.8 degrees, 1:1), a geared axis, and a coarse 0.9 degree motor
+AXES = [(1.8, 1, 1), (1.8, 1, 5), (0.9, 3, 4)]
+
+
+def sample_steps(limit):
+    """ Step counts spread over -limit..limit, plus the edges and the
+    values around zero.
+    """
+    values = set(range(-1000, 1001))
+    values.update(range(-limit, limit, 7919)) # a prime stride hits every residue pattern
+    values.update((-limit, -limit+1, limit-2, limit-1))
+    return sorted(values)
+
+
+def largest_int(func, *args):
+    """ Calls func, and returns the largest magnitude of any int a
+    step_convert function held in a variable or returned meanwhile.
+    """
+    largest = [0]
+
+    def check(value):
+        if isinstance(value, int):
+            largest[0] = max(largest[0], abs(value))
+
+    def trace_lines(frame, event, arg):
+        for value in frame.f_locals.values():
+            check(value)
+        if event == 'return':
+            check(arg)
+        return trace_lines
+
+    def trace_calls(frame, event, arg):
+        if frame.f_code.co_filename == step_convert.__file__:
+            return trace_lines
+        return None
+
+    sys.settrace(trace_calls)
+    try:
+        func(*args)
+    finally:
+        sys.settrace(None)
+    return largest[0]
+
+
+def microstep_arcsec(step_degrees, teeth_driver, teeth_follower, step_mode):
+    full_steps = int(round(360.0/step_degrees))
+    return float(ARCSEC_PER_REV * teeth_driver) / ((full_steps * teeth_follower) << step_mode)
+
+
+def test_copies_match():
+    with open(os.path.join(ROOT, 'telescope_driver', 'step_convert.py')) as board:
+        with open(os.path.join(ROOT, 'raspberry_pi', 'step_convert.py')) as pi:
+            assert board.read() == pi.read()
+
+
+@pytest.mark.parametrize('axis', AXES)
+@pytest.mark.parametrize('step_mode', STEP_MODES)
+def test_steps_arcsec_round_trip(axis, step_mode):
+    conv = StepConverter(*axis, step_mode=step_mode)
+    assert microstep_arcsec(*axis, step_mode=step_mode) >= 1.0
+    for steps in sample_steps(HALF_RANGE):
+        assert conv.arcsec_to_steps(conv.steps_to_arcsec(steps)) == steps
+
+
+@pytest.mark.parametrize('axis', AXES)
+@pytest.mark.parametrize('step_mode', STEP_MODES)
+def test_steps_deg_round_trip(axis, step_mode):
+    conv = StepConverter(*axis, step_mode=step_mode)
+    for steps in sample_steps(HALF_RANGE):
+        assert conv.deg_to_steps(conv.steps_to_deg(steps)) == steps
+
+
+@pytest.mark.parametrize('axis', AXES)
+@pytest.mark.parametrize('step_mode', STEP_MODES)
+def test_nearest(axis, step_mode):
+    # every result is the nearest whole unit, checked against exact fractions
+    conv = StepConverter(*axis, step_mode=step_mode)
+    size = microstep_arcsec(*axis, step_mode=step_mode)
+    for steps in sample_steps(HALF_RANGE)[::50]:
+        assert abs(conv.steps_to_arcsec(steps) - steps * size) <= 0.5 + 1e-6
+    for arcsec in range(-ARCSEC_PER_REV, ARCSEC_PER_REV, 997):
+        assert abs(conv.arcsec_to_steps(arcsec) - arcsec / size) <= 0.5 + 1e-6
+
+
+@pytest.mark.parametrize('step_mode', STEP_MODES)
+def test_whole_turn(step_mode):
+    conv = StepConverter(1.8, 1, 1, step_mode)
+    assert conv.deg_to_steps(360) == 200 << step_mode
+    assert conv.deg_to_steps(-90) == -(50 << step_mode)
+    assert conv.steps_to_deg(200 << step_mode) == 360.0
+
+
+def test_set_step_mode():
+    conv = StepConverter(1.8, 1, 1, 0)
+    conv.set_step_mode(5 | 0x70) # the register's other bits are ignored
+    assert conv.step_mode == 5
+    assert conv.deg_to_steps(1.8) == 32
+
+
+def test_below_one_arcsec_is_nearest_only():
+    # 1:100 at 1/128 is 0.5" per microstep, so angles only hold to the arcsecond
+    conv = StepConverter(1.8, 1, 100, 7)
+    assert conv.steps_to_arcsec(conv.arcsec_to_steps(12345)) == 12345
+    assert conv.arcsec_to_steps(conv.steps_to_arcsec(3)) != 3
+
+
+@pytest.mark.parametrize('steps', [0, 1, -1, HALF_RANGE-1, -HALF_RANGE, 12345, -12345])
+def test_abs_pos_round_trip(steps):
+    abs_pos = to_abs_pos(steps)
+    assert 0 <= abs_pos < 1 << ABS_POS_BITS
+    assert to_signed(abs_pos) == steps
+
+
+def test_abs_pos_wraparound():
+    # one step past either end wraps to the other, like the register
+    assert to_signed(to_abs_pos(HALF_RANGE)) == -HALF_RANGE
+    assert to_signed(to_abs_pos(-HALF_RANGE-1)) == HALF_RANGE-1
+    assert to_abs_pos(-1) == (1 << ABS_POS_BITS) - 1
+    assert to_signed((1 << ABS_POS_BITS) - 1) == -1
+    assert to_signed(1 << (ABS_POS_BITS-1)) == -HALF_RANGE
+    assert to_signed((1 << (ABS_POS_BITS-1)) - 1) == HALF_RANGE-1
+    # bits above the register are ignored
+    assert to_signed(0xFFC00005) == 5
+
+
+@pytest.mark.parametrize('axis', AXES)
+def test_speed_round_trip(axis):
+    conv = StepConverter(*axis)
+    for speed in list(range(-2000, 2001)) + [SPEED_MAX, -SPEED_MAX]:
+        assert conv.rate_to_speed(conv.speed_to_rate(speed)) == speed
+
+
+def test_speed_units():
+    conv = StepConverter(1.8, 1, 1, 5)
+    # one full step per second is 2^28 / 4000000 = 67.1 SPEED units
+    assert conv.rate_to_speed(6480 * 1000) == 67
+    assert conv.rate_to_speed(-6480 * 1000) == -67
+    # so one unit is about 96.6"/s, and the sidereal rate rounds to nothing
+    assert abs(conv.speed_to_rate(1) - 96560) <= 1
+    assert conv.rate_to_speed(15041) == 0
+    assert conv.rate_to_speed(48281) == 1 # just over half a unit rounds up
+    assert conv.rate_to_speed(48279) == 0
+
+
+def test_speed_step_mode_independent():
+    rates = [StepConverter(1.8, 1, 1, mode).rate_to_speed(123456789) for mode in STEP_MODES]
+    assert len(set(rates)) == 1
+
+
+def test_mount_stays_in_small_ints():
+    # the board converts angles over the whole ABS_POS range, the host
+    # converts tracking rates up to 2^30 mas/s
+    conv = StepConverter(1.8, 1, 1, 5)
+    top_arcsec = conv.steps_to_arcsec(HALF_RANGE)
+    top_speed = conv.rate_to_speed(SMALL_INT - 1) - 1 # rounds up past 2^30 mas/s otherwise
+    checks = []
+    for steps in sample_steps(HALF_RANGE)[::20]:
+        checks.append((conv.steps_to_arcsec, steps))
+    for arcsec in range(-top_arcsec, top_arcsec, 104729):
+        checks.append((conv.arcsec_to_steps, arcsec))
+    for mas_per_sec in list(range(-SMALL_INT+1, SMALL_INT, 7654321)) + [15041, -15041]:
+        checks.append((conv.rate_to_speed, mas_per_sec))
+    for speed in range(-top_speed, top_speed+1, 37):
+        checks.append((conv.speed_to_rate, speed))
+    for func, value in checks:
+        assert largest_int(func, value) < SMALL_INT, (func.__name__, value)
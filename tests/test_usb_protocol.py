@@ -0,0 +1,278 @@
+""" @file test_usb_protocol.py
+Host-side checks of usb_protocol, run with plain CPython:
+    python -m pytest tests
+
+The board and the Pi keep identical copies of the module, so the board's
+copy is tested and the Pi's is checked to match it.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'telescope_driver'))
+
+import usb_protocol
+from usb_protocol import (AXIS_ALT, AXIS_AZI, AXIS_FOC, CMD_FRAME_LEN, CMD_LEN, KIND_FRAME,
+                          KIND_NONE, OP_DONE, OP_HOME_SET, OP_INIT, OP_MARK, OP_MARK_SET,
+                          OP_NONE, OP_OFF, OP_SLEW, OP_STOP, OP_TELEMETRY, OP_TRACK, OP_TURN,
+                          RingBuffer, STATE_BUSY, STATE_ERR, STATE_IDLE, STATE_INIT, SYNC,
+                          StreamParser, TRACK_DEFAULT, crc8, decode_command, decode_telemetry,
+                          deg_to_arg, encode_command, encode_telemetry, parse_ascii,
+                          telemetry_len)
+
+
+class FakePort:
+    """ Stands in for pyb.USB_VCP: any() only says whether bytes are waiting,
+    and readinto() hands over at most <burst> of them without blocking.
+    """
+    def __init__(self, burst=1000):
+        self.waiting = bytearray()
+        self.burst = burst
+        self.reads = 0
+
+    def send(self, data):
+        self.waiting.extend(data)
+
+    def any(self):
+        return len(self.waiting) > 0
+
+    def readinto(self, buf):
+        self.reads += 1
+        count = min(len(buf), len(self.waiting), self.burst)
+        if not count:
+            return None
+        buf[0:count] = self.waiting[0:count]
+        del self.waiting[0:count]
+        return count
+
+
+def test_pi_copy_matches():
+    with open(os.path.join(ROOT, 'telescope_driver', 'usb_protocol.py'), 'rb') as board:
+        with open(os.path.join(ROOT, 'raspberry_pi', 'usb_protocol.py'), 'rb') as pi:
+            assert board.read() == pi.read()
+
+
+def test_crc8():
+    # the standard CRC-8 (poly 0x07, no reflection, init 0) check value
+    check = bytearray(b'x123456789x')
+    assert crc8(check, 1, 10) == 0xF4
+    assert crc8(check, 1, 1) == 0
+    # one flipped bit always changes the checksum
+    for i in range(1, 10):
+        for bit in range(8):
+            check[i] ^= 1 << bit
+            assert crc8(check, 1, 10) != 0xF4
+            check[i] ^= 1 << bit
+
+
+@pytest.mark.parametrize('op', [OP_INIT, OP_SLEW, OP_TRACK, OP_STOP, OP_DONE])
+@pytest.mark.parametrize('axis', [AXIS_ALT, AXIS_AZI, AXIS_FOC])
+@pytest.mark.parametrize('arg', [0, 1, -1, 37800, -1296000, (1 << 31) - 1, -(1 << 31)])
+def test_command_round_trip(op, axis, arg):
+    for cmd_id in (0, 1, 255):
+        frame = encode_command(op, axis, arg, cmd_id)
+        assert len(frame) == CMD_FRAME_LEN
+        assert frame[0] == SYNC and frame[1] == CMD_LEN
+        assert decode_command(frame) == (op, axis, cmd_id, arg)
+
+
+def test_command_id_wraps():
+    assert decode_command(encode_command(OP_SLEW, AXIS_ALT, 5, 256 + 7))[2] == 7
+
+
+def test_command_reuses_buffer():
+    buf = bytearray(CMD_FRAME_LEN)
+    assert encode_command(OP_TURN, AXIS_AZI, -5, 3, buf) is buf
+    assert decode_command(buf) == (OP_TURN, AXIS_AZI, 3, -5)
+
+
+def test_corrupt_command_rejected():
+    frame = encode_command(OP_SLEW, AXIS_AZI, deg_to_arg(12.5), 42)
+    for i in range(CMD_FRAME_LEN):
+        for bit in range(8):
+            bad = bytearray(frame)
+            bad[i] ^= 1 << bit
+            assert decode_command(bad) is None
+
+
+SAMPLES = [(0, 0, 0x7E03, STATE_IDLE),
+           (-(1 << 21), 0xFFFFF, 0xFFFF, STATE_BUSY),
+           ((1 << 21) - 1, 1, 0x0002, STATE_INIT),
+           (-1, 12345, 0x8000, STATE_ERR)]
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 3, 4])
+def test_telemetry_round_trip(count):
+    samples = SAMPLES[:count]
+    for seq in (0, 1, 0xFFFF):
+        frame = encode_telemetry(seq, samples)
+        assert len(frame) == telemetry_len(count)
+        assert frame[0] == SYNC and frame[2] == OP_TELEMETRY
+        assert decode_telemetry(frame) == (seq, samples)
+
+
+def test_telemetry_seq_wraps():
+    assert decode_telemetry(encode_telemetry(0x10005, SAMPLES))[0] == 5
+
+
+def test_telemetry_reuses_buffer():
+    buf = bytearray(telemetry_len(2))
+    assert encode_telemetry(9, SAMPLES[:2], buf) is buf
+    assert decode_telemetry(buf) == (9, SAMPLES[:2])
+
+
+def test_corrupt_telemetry_rejected():
+    frame = encode_telemetry(300, SAMPLES[:3])
+    for i in range(len(frame)):
+        for bit in range(8):
+            bad = bytearray(frame)
+            bad[i] ^= 1 << bit
+            assert decode_telemetry(bad) is None
+    assert decode_telemetry(frame[:-1]) is None # cut short
+
+
+def test_command_is_not_telemetry():
+    assert decode_telemetry(encode_command(OP_DONE, AXIS_ALT, 0, 1)) is None
+
+
+@pytest.mark.parametrize('text, command', [
+    ('init', (OP_INIT, 0)),
+    ('slew 10.5', (OP_SLEW, 37800)),
+    ('slew -0.5', (OP_SLEW, -1800)),
+    ('turn 1', (OP_TURN, 3600)),
+    ('track', (OP_TRACK, TRACK_DEFAULT)),
+    ('track -500', (OP_TRACK, -500)),
+    ('mark', (OP_MARK, 0)),
+    ('mark set', (OP_MARK_SET, 0)),
+    ('home set', (OP_HOME_SET, 0)),
+    ('stop', (OP_STOP, 0)),
+    ('off', (OP_OFF, 0)),
+    ('dance', (OP_NONE, 0)),
+])
+def test_parse_ascii(text, command):
+    assert parse_ascii(text) == command
+
+
+@pytest.mark.parametrize('text', ['slew', 'slew north', 'turn 1x', 'track fast'])
+def test_parse_ascii_bad_number(text):
+    with pytest.raises(ValueError):
+        parse_ascii(text)
+
+
+def test_opcodes_fit_the_frame():
+    ops = [value for name, value in vars(usb_protocol).items() if name.startswith('OP_')]
+    assert len(set(ops)) == len(ops)
+    assert all(0 <= op <= 0xFF for op in ops)
+
+
+def test_ring_wraps_around():
+    ring = RingBuffer(16)
+    port = FakePort()
+    data = bytes(bytearray(i % 251 for i in range(1000)))
+    out = bytearray(16)
+    got = bytearray()
+    take = 1
+    for start in range(0, len(data), 5):
+        port.send(data[start:start+5])
+        ring.fill(port)
+        # consume odd amounts so the head lands everywhere in the storage
+        take = take % 7 + 1
+        count = min(take, len(ring))
+        ring.consume(count, out)
+        got.extend(out[0:count])
+    while len(ring) or port.any():
+        ring.fill(port)
+        count = len(ring)
+        ring.consume(count, out)
+        got.extend(out[0:count])
+    assert bytes(got) == data
+
+
+def test_ring_fill_stops_when_full():
+    ring = RingBuffer(16)
+    port = FakePort()
+    port.send(bytes(bytearray(range(40))))
+    assert ring.fill(port) == 16
+    assert ring.free() == 0 and len(port.waiting) == 24
+    assert ring.fill(port) == 0
+    ring.consume(10)
+    assert ring.peek(0) == 10 and ring.find(15) == 5 and ring.find(16) == -1
+    assert ring.fill(port) == 10
+    assert [ring.peek(i) for i in range(16)] == list(range(10, 26))
+
+
+def test_ring_fill_drains_short_reads():
+    ring = RingBuffer(64)
+    port = FakePort(burst=3)
+    port.send(b'0123456789')
+    assert ring.fill(port) == 10
+    assert not port.any()
+
+
+def test_ring_extend():
+    ring = RingBuffer(8)
+    assert ring.extend(b'abcdef') == 6
+    ring.consume(4)
+    assert ring.extend(b'ghijklmn') == 6
+    out = bytearray(8)
+    ring.consume(8, out)
+    assert bytes(out) == b'efghijkl'
+
+
+def poll_all(parser):
+    found = []
+    kind = parser.poll()
+    while kind != KIND_NONE:
+        if kind == KIND_FRAME:
+            found.append(bytes(parser.frame[0:parser.frame[1] + 3]))
+        else:
+            found.append(bytes(parser.line[0:parser.line_len]))
+        kind = parser.poll()
+    return found
+
+
+def test_parser_mixed_frames_and_lines():
+    slew = bytes(encode_command(OP_SLEW, AXIS_ALT, 3600, 1))
+    telemetry = bytes(encode_telemetry(7, SAMPLES[:3]))
+    stream = (b'alt:slew 1\r\n' + slew + slew + b'azi:stop\r' + telemetry
+              + b'\nfoc:off\r')
+    parser = StreamParser(64)
+    port = FakePort()
+    # byte at a time, so every message is seen half-arrived first
+    found = []
+    for i in range(len(stream)):
+        port.send(stream[i:i+1])
+        parser.ring.fill(port)
+        found.extend(poll_all(parser))
+    assert found == [b'alt:slew 1', slew, slew, b'azi:stop', telemetry, b'foc:off']
+    assert decode_command(bytearray(found[1])) == (OP_SLEW, AXIS_ALT, 1, 3600)
+    assert decode_telemetry(bytearray(found[4])) == (7, SAMPLES[:3])
+
+
+def test_parser_backspace():
+    parser = StreamParser(64)
+    parser.ring.extend(b'alt:slw\x08\x08lew 5\r\x08\x08ab\r')
+    assert poll_all(parser) == [b'alt:slew 5', b'ab']
+
+
+def test_parser_resyncs_after_garbage():
+    slew = bytes(encode_command(OP_SLEW, AXIS_AZI, -7200, 9))
+    parser = StreamParser(64)
+    # a SYNC whose LEN is too long for any frame, then a real command
+    parser.ring.extend(bytes(bytearray([SYNC, 0xF0])) + b'\r' + slew)
+    # the SYNC is skipped, the rest up to \r comes out as a junk line
+    found = poll_all(parser)
+    assert found == [bytes(bytearray([0xF0])), slew]
+    assert decode_command(bytearray(found[1])) == (OP_SLEW, AXIS_AZI, 9, -7200)
+
+
+def test_parser_drops_overlong_line():
+    parser = StreamParser(16)
+    parser.ring.extend(b'x' * 16)
+    assert parser.poll() == KIND_NONE
+    assert len(parser.ring) == 0
+    parser.ring.extend(b'azi:off\r')
+    assert poll_all(parser) == [b'azi:off']